@@ -16,6 +16,7 @@ from datetime import datetime
 from diffusion.data.datasets import ASPECT_RATIO_512_TEST
 from diffusion.model.utils import resize_and_crop_img
 from diffusion.sa_solver_diffusers import SASolverScheduler
+from diffusion.model.prompt_cache import PromptEmbeddingCache
 
 
 DESCRIPTION = """![Logo](https://raw.githubusercontent.com/PixArt-alpha/PixArt-alpha.github.io/master/static/images/logo.png)
@@ -126,6 +127,8 @@ if torch.cuda.is_available():
 
     # speed-up T5
     pipe.text_encoder.to_bettertransformer()
+    # repeated prompts and the constant negative prompt skip T5
+    prompt_cache = PromptEmbeddingCache.for_pipeline(pipe, "PixArt-alpha/PixArt-XL-2-512x512", device, max_bytes=int(os.getenv('PROMPT_CACHE_MB', '1024')) << 20, disk_dir=os.getenv('PROMPT_CACHE_DIR'))
 
     if USE_TORCH_COMPILE:
         pipe.transformer = torch.compile(pipe.transformer, mode="reduce-overhead", fullgraph=True)
@@ -202,11 +205,15 @@ def generate(
         orig_height, orig_width = height, width
         height, width = classify_height_width_bin(height, width, ratios=ASPECT_RATIO_512_TEST)
 
+    prompt_embeds, prompt_attention_mask = prompt_cache([prompt, negative_prompt])
     images = pipe(
-        prompt=prompt,
+        prompt_embeds=prompt_embeds[:1],
+        prompt_attention_mask=prompt_attention_mask[:1],
+        negative_prompt_embeds=prompt_embeds[1:],
+        negative_prompt_attention_mask=prompt_attention_mask[1:],
         width=width,
         height=height,
-        negative_prompt=negative_prompt,
+        negative_prompt=None,
         guidance_scale=guidance_scale,
         num_inference_steps=num_inference_steps,
         generator=generator,
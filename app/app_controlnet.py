@@ -26,10 +26,13 @@ from diffusers import PixArtAlphaPipeline
 from diffusion import DPMS, SASolverSampler
 from diffusion.data.datasets import *
 from diffusion.model.hed import HEDdetector
-from diffusion.model.nets import PixArt_XL_2, PixArtMS_XL_2, ControlPixArtHalf, ControlPixArtMSHalf
+from diffusion.model.prompt_cache import PromptEmbeddingCache
+from diffusion.model.builder import build_model
+from diffusion.model.nets import ControlPixArtHalf, ControlPixArtMSHalf
 from diffusion.model.utils import resize_and_crop_tensor
+from diffusion.utils.checkpoint import load_model_weights
 from diffusion.utils.misc import read_config
-from tools.download import find_model
+from tools.download import find_model_path
 
 
 DESCRIPTION = """![Logo](https://raw.githubusercontent.com/PixArt-alpha/PixArt-alpha.github.io/master/static/images/logo.png)
@@ -171,9 +174,9 @@ def generate(
         negative_prompt = None  # type: ignore
     prompt, negative_prompt = apply_style(style, prompt, negative_prompt)
 
-    prompt_embeds, prompt_attention_mask, negative_prompt_embeds, negative_prompt_attention_mask\
-        = pipe.encode_prompt(prompt=prompt, negative_prompt=negative_prompt)
-    prompt_embeds, negative_prompt_embeds = prompt_embeds[:, None], negative_prompt_embeds[:, None]
+    prompt_embeds, prompt_attention_mask = prompt_cache([prompt, negative_prompt])
+    prompt_embeds, negative_prompt_embeds = prompt_embeds[:1, None], prompt_embeds[1:, None]
+    prompt_attention_mask = prompt_attention_mask[:1]
     torch.cuda.empty_cache()
 
     # condition process
@@ -283,27 +286,26 @@ if torch.cuda.is_available():
     vae = pipe.vae
     text_encoder = pipe.text_encoder
     tokenizer = pipe.tokenizer
+    # repeated prompts and the constant negative prompt skip T5
+    prompt_cache = PromptEmbeddingCache.for_pipeline(pipe, "PixArt-alpha/PixArt-XL-2-1024-MS", device, clean_caption=False,
+                                                     max_bytes=int(os.getenv('PROMPT_CACHE_MB', '1024')) << 20, disk_dir=os.getenv('PROMPT_CACHE_DIR'))
 
     assert args.image_size == config.image_size
+    # the base model and its copied blocks are filled straight from the checkpoint
     if config.image_size == 512:
-        model = PixArt_XL_2(input_size=latent_size, lewei_scale=lewei_scale[config.image_size])
+        model = build_model('PixArt_XL_2', init_weights=False, device='meta', input_size=latent_size, lewei_scale=lewei_scale[config.image_size])
         print('model architecture ControlPixArtHalf and image size is 512')
-        model = ControlPixArtHalf(model).to(device)
+        model = ControlPixArtHalf(model)
     elif config.image_size == 1024:
-        model = PixArtMS_XL_2(input_size=latent_size, lewei_scale=lewei_scale[config.image_size])
+        model = build_model('PixArtMS_XL_2', init_weights=False, device='meta', input_size=latent_size, lewei_scale=lewei_scale[config.image_size])
         print('model architecture ControlPixArtMSHalf and image size is 1024')
-        model = ControlPixArtMSHalf(model).to(device)
-
-    state_dict = find_model(args.model_path)['state_dict']
-    if 'pos_embed' in state_dict:
-        del state_dict['pos_embed']
-    elif 'base_model.pos_embed' in state_dict:
-        del state_dict['base_model.pos_embed']
-    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+        model = ControlPixArtMSHalf(model)
+
+    missing, unexpected = load_model_weights(find_model_path(args.model_path), model)
     print('Missing keys (missing pos_embed is normal): ', missing)
     print('Unexpected keys', unexpected)
     model.eval()
-    model.to(weight_dtype)
+    model.to(device, weight_dtype)
     base_ratios = eval(f'ASPECT_RATIO_{args.image_size}_TEST')
 
 with gr.Blocks(css="app/style_controlnet.css") as demo:
@@ -16,6 +16,8 @@ from typing import Tuple
 from datetime import datetime
 import argparse
 
+from diffusion.model.prompt_cache import PromptEmbeddingCache
+
 DESCRIPTION = """![Logo](https://raw.githubusercontent.com/PixArt-alpha/PixArt-alpha.github.io/master/static/images/pixart-lcm.png)
         # PixArt-LCM 1024px
         #### [PixArt-Alpha 1024px](https://github.com/PixArt-alpha/PixArt-alpha) is a transformer-based text-to-image diffusion system trained on text embeddings from T5. This demo uses the [PixArt-alpha/PixArt-LCM-XL-2-1024-MS](https://huggingface.co/PixArt-alpha/PixArt-LCM-XL-2-1024-MS) checkpoint.
@@ -138,6 +140,8 @@ if torch.cuda.is_available():
 
     # speed-up T5
     pipe.text_encoder.to_bettertransformer()
+    # repeated prompts skip T5
+    prompt_cache = PromptEmbeddingCache.for_pipeline(pipe, args.repo_id, device, max_bytes=int(os.getenv('PROMPT_CACHE_MB', '1024')) << 20, disk_dir=os.getenv('PROMPT_CACHE_DIR'))
 
     if USE_TORCH_COMPILE:
         pipe.transformer = torch.compile(pipe.transformer, mode="reduce-overhead", fullgraph=True)
@@ -179,11 +183,13 @@ def generate(
         negative_prompt = None  # type: ignore
     prompt, negative_prompt = apply_style(style, prompt, negative_prompt)
 
+    prompt_embeds, prompt_attention_mask = prompt_cache([prompt])
     images = pipe(
-        prompt=prompt,
+        prompt_embeds=prompt_embeds,
+        prompt_attention_mask=prompt_attention_mask,
         width=width,
         height=height,
-        negative_prompt=negative_prompt,
+        negative_prompt=None,
         guidance_scale=0.,
         num_inference_steps=inference_steps,
         generator=generator,
@@ -32,11 +32,14 @@ lr_schedule_args = dict(num_warmup_steps=500)
 save_image_epochs = 1
 save_model_epochs = 1
 save_model_steps=1000000
+keep_last_checkpoints = None  # number of newest checkpoints to keep, None keeps all
 
 sample_posterior = True
 mixed_precision = 'fp16'
 scale_factor = 0.18215
 ema_rate = 0.9999
+ema_update_every = 1  # EMA update cadence in optimizer steps, decay rate ** N
+ema_offload = False  # keep the EMA weights on the CPU
 tensorboard_mox_interval = 50
 log_interval = 50
 cfg_scale = 4
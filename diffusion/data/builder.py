@@ -38,12 +38,15 @@ def build_dataset(cfg, resolution=224, **kwargs):
 
 
 def build_dataloader(dataset, batch_size=256, num_workers=4, shuffle=True, **kwargs):
+    # datasets returning variable-length samples (e.g. unpadded caption features) batch them themselves
+    kwargs.setdefault('collate_fn', getattr(dataset, 'collate_fn', None))
     return (
         DataLoader(
             dataset,
             batch_sampler=kwargs['batch_sampler'],
             num_workers=num_workers,
             pin_memory=True,
+            collate_fn=kwargs['collate_fn'],
         )
         if 'batch_sampler' in kwargs
         else DataLoader(
@@ -5,9 +5,12 @@ import numpy as np
 import torch
 from torchvision.datasets.folder import default_loader, IMG_EXTENSIONS
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from diffusers.utils.torch_utils import randn_tensor
 from torchvision import transforms as T
 from diffusion.data.builder import get_data_path, DATASETS
+from diffusion.data.packed import PackedFeatureReader, MetaIndex, IndexColumn
+from diffusion.data.datasets.utils import get_closest_ratio_ids, sorted_ratio_keys, ASPECT_RATIO_256, ASPECT_RATIO_512, ASPECT_RATIO_1024
 from diffusion.utils.logger import get_root_logger
 
 import json
@@ -15,6 +18,9 @@ import json
 
 @DATASETS.register_module()
 class InternalData(Dataset):
+    partition_dir = 'partition'
+    vae_feat_dir = 'img_vae_features_{}resolution/noflip'
+
     def __init__(self,
                  root,
                  image_list_json='data_info.json',
@@ -28,6 +34,9 @@ class InternalData(Dataset):
                  load_mask_index=False,
                  max_length=120,
                  config=None,
+                 packed_txt_feat=None,
+                 packed_vae_feat=None,
+                 meta_index=None,
                  **kwargs):
         self.root = get_data_path(root)
         self.transform = transform
@@ -44,22 +53,30 @@ class InternalData(Dataset):
         self.vae_feat_samples = []
         self.mask_index_samples = []
         self.prompt_samples = []
-
-        image_list_json = image_list_json if isinstance(image_list_json, list) else [image_list_json]
-        for json_file in image_list_json:
-            meta_data = self.load_json(os.path.join(self.root, 'partition', json_file))
-            self.ori_imgs_nums += len(meta_data)
-            meta_data_clean = [item for item in meta_data if item['ratio'] <= 4]
-            self.meta_data_clean.extend(meta_data_clean)
-            self.img_samples.extend([os.path.join(self.root.replace('InternData', "InternImgs"), item['path']) for item in meta_data_clean])
-            self.txt_feat_samples.extend([os.path.join(self.root, 'caption_feature_wmask', '_'.join(item['path'].rsplit('/', 1)).replace('.png', '.npz')) for item in meta_data_clean])
-            self.vae_feat_samples.extend([os.path.join(self.root, f'img_vae_features_{resolution}resolution/noflip', '_'.join(item['path'].rsplit('/', 1)).replace('.png', '.npy')) for item in meta_data_clean])
-            self.prompt_samples.extend([item['prompt'] for item in meta_data_clean])
+        # packed, memory-mapped caption features (see tools/convert_features_to_packed.py)
+        self.txt_feat_store = PackedFeatureReader(os.path.join(self.root, packed_txt_feat)) if packed_txt_feat else None
+        self.vae_feat_store = PackedFeatureReader(os.path.join(self.root, packed_vae_feat)) if packed_vae_feat else None
+
+        self.meta_index = None
+        if meta_index is not None:
+            # prebuilt columnar index (see tools/build_meta_index.py), replaces image_list_json
+            self.load_meta_index(os.path.join(self.root, meta_index))
+        else:
+            image_list_json = image_list_json if isinstance(image_list_json, list) else [image_list_json]
+            for json_file in image_list_json:
+                meta_data = self.load_json(os.path.join(self.root, self.partition_dir, json_file))
+                self.ori_imgs_nums += len(meta_data)
+                meta_data_clean = [item for item in meta_data if item['ratio'] <= 4]
+                self.meta_data_clean.extend(meta_data_clean)
+                self.img_samples.extend([self.img_path(item['path']) for item in meta_data_clean])
+                self.txt_feat_samples.extend([self.txt_feat_path(item['path']) for item in meta_data_clean])
+                self.vae_feat_samples.extend([self.vae_feat_path(item['path']) for item in meta_data_clean])
+                self.prompt_samples.extend([item['prompt'] for item in meta_data_clean])
 
         # Set loader and extensions
         if load_vae_feat:
             self.transform = None
-            self.loader = self.vae_feat_loader
+            self.loader = self.vae_feat_loader if self.vae_feat_store is None else self.packed_vae_feat_loader
         else:
             self.loader = default_loader
 
@@ -68,6 +85,26 @@ class InternalData(Dataset):
         logger = get_root_logger() if config is None else get_root_logger(os.path.join(config.work_dir, 'train_log.log'))
         logger.info(f"T5 max token length: {self.max_lenth}")
 
+    def img_path(self, path):
+        return os.path.join(self.root.replace('InternData', "InternImgs"), path)
+
+    def txt_feat_path(self, path):
+        return os.path.join(self.root, 'caption_feature_wmask', '_'.join(path.rsplit('/', 1)).replace('.png', '.npz'))
+
+    def vae_feat_path(self, path):
+        return os.path.join(self.root, self.vae_feat_dir.format(self.resolution), '_'.join(path.rsplit('/', 1)).replace('.png', '.npy'))
+
+    def load_meta_index(self, index_dir):
+        # every per-sample list becomes a lazy view into the memory-mapped index: O(1) construction,
+        # and DataLoader workers share the index pages instead of copy-on-write copies of python lists
+        self.meta_index = MetaIndex(index_dir)
+        self.ori_imgs_nums = self.meta_index.meta['ori_imgs_nums']
+        self.meta_data_clean = self.meta_index
+        self.img_samples = IndexColumn(self.meta_index, 'path', self.img_path)
+        self.txt_feat_samples = IndexColumn(self.meta_index, 'path', self.txt_feat_path)
+        self.vae_feat_samples = IndexColumn(self.meta_index, 'path', self.vae_feat_path)
+        self.prompt_samples = IndexColumn(self.meta_index, 'prompt')
+
     def getdata(self, index):
         img_path = self.img_samples[index]
         npz_path = self.txt_feat_samples[index]
@@ -79,14 +116,7 @@ class InternalData(Dataset):
         }
 
         img = self.loader(npy_path) if self.load_vae_feat else self.loader(img_path)
-        txt_info = np.load(npz_path)
-        txt_fea = torch.from_numpy(txt_info['caption_feature'])     # 1xTx4096
-        attention_mask = torch.ones(1, 1, txt_fea.shape[1])     # 1x1xT
-        if 'attention_mask' in txt_info.keys():
-            attention_mask = torch.from_numpy(txt_info['attention_mask'])[None]
-        if txt_fea.shape[1] != self.max_lenth:
-            txt_fea = torch.cat([txt_fea, txt_fea[:, -1:].repeat(1, self.max_lenth-txt_fea.shape[1], 1)], dim=1)
-            attention_mask = torch.cat([attention_mask, torch.zeros(1, 1, self.max_lenth-attention_mask.shape[-1])], dim=-1)
+        txt_fea, attention_mask = self.load_txt_feat(npz_path)     # padded to max_lenth in collate_fn
 
         if self.transform:
             img = self.transform(img)
@@ -103,9 +133,67 @@ class InternalData(Dataset):
                 idx = np.random.randint(len(self))
         raise RuntimeError('Too many bad data.')
 
-    def get_data_info(self, idx):
+    def load_txt_feat(self, npz_path):
+        if self.txt_feat_store is not None:
+            # stored without padding: zero-copy 1xLxC view into the shard, in the stored dtype
+            feat = self.txt_feat_store.get(os.path.splitext(os.path.basename(npz_path))[0])
+            return torch.from_numpy(feat)[None], torch.ones(1, 1, feat.shape[0])
+
+        txt_info = np.load(npz_path)
+        txt_fea = torch.from_numpy(txt_info['caption_feature'])     # 1xTx4096
+        attention_mask = torch.ones(1, 1, txt_fea.shape[1])     # 1x1xT
+        if 'attention_mask' in txt_info.keys():
+            attention_mask = torch.from_numpy(txt_info['attention_mask'])[None]
+        return txt_fea, attention_mask
+
+    def collate_fn(self, batch):
+        """Batches samples, padding caption features and masks to `max_lenth` with one copy into the batch tensor.
+
+        Features keep their stored dtype; the model casts them to its own.
+        """
+        imgs, txt_feas, attention_masks, data_infos = zip(*batch)
+        txt_fea = txt_feas[0].new_zeros(len(batch), 1, self.max_lenth, txt_feas[0].shape[-1])
+        attention_mask = attention_masks[0].new_zeros(len(batch), 1, 1, self.max_lenth)
+        for i, (fea, mask) in enumerate(zip(txt_feas, attention_masks)):
+            num_tokens = min(fea.shape[1], self.max_lenth)
+            txt_fea[i, :, :num_tokens] = fea[:, :num_tokens]
+            attention_mask[i, ..., :num_tokens] = mask[..., :num_tokens]
+        return default_collate(imgs), txt_fea, attention_mask, default_collate(data_infos)
+
+    def get_hw(self, idx):
+        """(height, width) of a sample, read from the numeric columns of the meta index when there is one."""
+        if self.meta_index is not None:
+            return int(self.meta_index.height[idx]), int(self.meta_index.width[idx])
         data_info = self.meta_data_clean[idx]
-        return {'height': data_info['height'], 'width': data_info['width']}
+        return data_info['height'], data_info['width']
+
+    def get_data_info(self, idx):
+        height, width = self.get_hw(idx)
+        return {'height': height, 'width': width}
+
+    def get_bucket_ids(self, aspect_ratios):
+        """Closest aspect-ratio bucket of every sample, as an index into `sorted_ratio_keys(aspect_ratios)`.
+
+        Computed once per ratio table (or taken from the meta index when it was prebuilt) and cached on the dataset,
+        so batch samplers never call `get_data_info` per sample.
+        """
+        cache = self.__dict__.setdefault('_bucket_ids', {})
+        key = tuple(sorted_ratio_keys(aspect_ratios))
+        if key not in cache:
+            meta_index = getattr(self, 'meta_index', None)
+            if meta_index is not None:
+                prebuilt = [meta_index.bucket_ids(name) for name, ratios in (('ASPECT_RATIO_256', ASPECT_RATIO_256), ('ASPECT_RATIO_512', ASPECT_RATIO_512),
+                            ('ASPECT_RATIO_1024', ASPECT_RATIO_1024)) if ratios == aspect_ratios]
+                if prebuilt and prebuilt[0] is not None:
+                    cache[key] = prebuilt[0]
+                else:
+                    cache[key] = get_closest_ratio_ids(meta_index.height, meta_index.width, aspect_ratios)
+            else:
+                num = len(self.meta_data_clean)
+                height = np.fromiter((item['height'] for item in self.meta_data_clean), dtype=np.float64, count=num)
+                width = np.fromiter((item['width'] for item in self.meta_data_clean), dtype=np.float64, count=num)
+                cache[key] = get_closest_ratio_ids(height, width, aspect_ratios)
+        return cache[key]
 
     @staticmethod
     def vae_feat_loader(path):
@@ -114,6 +202,13 @@ class InternalData(Dataset):
         sample = randn_tensor(mean.shape, generator=None, device=mean.device, dtype=mean.dtype)
         return mean + std * sample
 
+    def packed_vae_feat_loader(self, path):
+        # [mean, std] in fp16, read from a memory-mapped shard instead of one .npy per image
+        latent = self.vae_feat_store.get(os.path.splitext(os.path.basename(path))[0])
+        mean, std = torch.from_numpy(latent).float().chunk(2)
+        sample = randn_tensor(mean.shape, generator=None, device=mean.device, dtype=mean.dtype)
+        return mean + std * sample
+
     def load_ori_img(self, img_path):
         # 加载图像并转换为Tensor
         transform = T.Compose([
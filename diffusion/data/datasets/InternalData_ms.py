@@ -1,10 +1,14 @@
 import os
+import json
+import shutil
+import hashlib
 import numpy as np
 import torch
 import random
 from torchvision.datasets.folder import default_loader
 from diffusion.data.datasets.InternalData import InternalData
 from diffusion.data.builder import get_data_path, DATASETS
+from diffusion.data.packed import PackedFeatureReader
 from diffusion.utils.logger import get_root_logger
 import torchvision.transforms as T
 from torchvision.transforms.functional import InterpolationMode
@@ -18,6 +22,9 @@ def get_closest_ratio(height: float, width: float, ratios: dict):
 
 @DATASETS.register_module()
 class InternalDataMS(InternalData):
+    partition_dir = 'partition_filter'
+    vae_feat_dir = 'img_vae_fatures_{}_multiscale/ms'
+
     def __init__(self,
                  root,
                  image_list_json='data_info.json',
@@ -32,6 +39,9 @@ class InternalDataMS(InternalData):
                  load_mask_index=False,
                  max_length=120,
                  config=None,
+                 packed_txt_feat=None,
+                 packed_vae_feat=None,
+                 meta_index=None,
                  **kwargs):
         self.root = get_data_path(root)
         self.transform = transform
@@ -50,62 +60,96 @@ class InternalDataMS(InternalData):
         self.txt_feat_samples = []
         self.vae_feat_samples = []
         self.mask_index_samples = []
-        self.ratio_index = {}
-        self.ratio_nums = {}
-        for k, v in self.aspect_ratio.items():
-            self.ratio_index[float(k)] = []     # used for self.getitem
-            self.ratio_nums[float(k)] = 0      # used for batch-sampler
-
-        image_list_json = image_list_json if isinstance(image_list_json, list) else [image_list_json]
-        for json_file in image_list_json:
-            meta_data = self.load_json(os.path.join(self.root, 'partition_filter', json_file))
-            self.ori_imgs_nums += len(meta_data)
-            meta_data_clean = [item for item in meta_data if item['ratio'] <= 4]
-            self.meta_data_clean.extend(meta_data_clean)
-            self.img_samples.extend([os.path.join(self.root.replace('InternData', "InternImgs"), item['path']) for item in meta_data_clean])
-            self.txt_feat_samples.extend([os.path.join(self.root, 'caption_feature_wmask', '_'.join(item['path'].rsplit('/', 1)).replace('.png', '.npz')) for item in meta_data_clean])
-            self.vae_feat_samples.extend([os.path.join(self.root, f'img_vae_fatures_{resolution}_multiscale/ms', '_'.join(item['path'].rsplit('/', 1)).replace('.png', '.npy')) for item in meta_data_clean])
+        self.txt_feat_store = PackedFeatureReader(os.path.join(self.root, packed_txt_feat)) if packed_txt_feat else None
+        self.vae_feat_store = PackedFeatureReader(os.path.join(self.root, packed_vae_feat)) if packed_vae_feat else None
+
+        self.meta_index = None
+        if meta_index is not None:
+            self.load_meta_index(os.path.join(self.root, meta_index))
+            sources = self.meta_index.meta.get('sources') or {'meta.json': file_md5(os.path.join(self.root, meta_index, 'meta.json'))}
+        else:
+            sources = {}
+            image_list_json = image_list_json if isinstance(image_list_json, list) else [image_list_json]
+            for json_file in image_list_json:
+                json_path = os.path.join(self.root, self.partition_dir, json_file)
+                sources[json_file] = file_md5(json_path)
+                meta_data = self.load_json(json_path)
+                self.ori_imgs_nums += len(meta_data)
+                meta_data_clean = [item for item in meta_data if item['ratio'] <= 4]
+                self.meta_data_clean.extend(meta_data_clean)
+                self.img_samples.extend([self.img_path(item['path']) for item in meta_data_clean])
+                self.txt_feat_samples.extend([self.txt_feat_path(item['path']) for item in meta_data_clean])
+                self.vae_feat_samples.extend([self.vae_feat_path(item['path']) for item in meta_data_clean])
 
         # Set loader and extensions
         if load_vae_feat:
             self.transform = None
-            self.loader = self.vae_feat_loader
+            self.loader = self.vae_feat_loader if self.vae_feat_store is None else self.packed_vae_feat_loader
         else:
             self.loader = default_loader
 
         if sample_subset is not None:
             self.sample_subset(sample_subset)  # sample dataset for local debug
 
-        # scan the dataset for ratio static
-        for i, info in enumerate(self.meta_data_clean[:len(self.meta_data_clean)//3]):
-            ori_h, ori_w = info['height'], info['width']
-            closest_size, closest_ratio = get_closest_ratio(ori_h, ori_w, self.aspect_ratio)
-            self.ratio_nums[closest_ratio] += 1
-            if len(self.ratio_index[closest_ratio]) == 0:
-                self.ratio_index[closest_ratio].append(i)
-        # print(self.ratio_nums)
         logger = get_root_logger() if config is None else get_root_logger(os.path.join(config.work_dir, 'train_log.log'))
+        self.load_ratio_statistics(sources, logger)
         logger.info(f"T5 max token length: {self.max_lenth}")
 
+    def load_ratio_statistics(self, sources, logger):
+        """Per-bucket sample counts (`ratio_nums`, used by the batch samplers) and complete per-bucket index
+        arrays (`ratio_index`, used to resample bad data) over the whole dataset.
+
+        Everything derives from the vectorized bucket ids. They are cached under `{root}/ratio_stats/`, keyed by the
+        hashes of the partition files and the ratio table, and memory-mapped back on later runs.
+        """
+        self.ratio_keys = sorted_ratio_keys(self.aspect_ratio)
+        key = hashlib.md5(json.dumps({'sources': sources, 'ratios': self.ratio_keys, 'num_samples': len(self.meta_data_clean)},
+                                     sort_keys=True).encode()).hexdigest()
+        cache_dir = os.path.join(self.root, 'ratio_stats', key)
+        if os.path.exists(os.path.join(cache_dir, 'bucket_starts.npy')):
+            bucket_ids, order, bucket_starts = (np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r')
+                                                for name in ('bucket_ids', 'order', 'bucket_starts'))
+            logger.info(f"Loaded ratio statistics from {cache_dir}")
+        else:
+            bucket_ids = self.get_bucket_ids(self.aspect_ratio)
+            order = np.argsort(bucket_ids, kind='stable')      # sample indices grouped by bucket, ascending inside each
+            bucket_starts = np.searchsorted(bucket_ids[order], np.arange(len(self.ratio_keys) + 1))
+            tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+            try:
+                os.makedirs(tmp_dir, exist_ok=True)
+                for name, array in (('bucket_ids', bucket_ids), ('order', order), ('bucket_starts', bucket_starts)):
+                    np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+                os.replace(tmp_dir, cache_dir)
+            except OSError as e:     # read-only root, or another rank finished first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not os.path.exists(cache_dir):
+                    logger.warning(f"Failed to cache ratio statistics to {cache_dir}: {e}")
+        self.bucket_ids = bucket_ids
+        self.__dict__.setdefault('_bucket_ids', {})[tuple(self.ratio_keys)] = bucket_ids
+        self.ratio_index = {float(k): order[bucket_starts[i]:bucket_starts[i + 1]] for i, k in enumerate(self.ratio_keys)}     # used for self.getitem
+        self.ratio_nums = {float(k): int(bucket_starts[i + 1] - bucket_starts[i]) for i, k in enumerate(self.ratio_keys)}      # used for batch-sampler
+
+    def resample_index(self, index):
+        """A uniformly drawn sample of the same aspect-ratio bucket as `index`, to replace a bad sample."""
+        return int(random.choice(self.ratio_index[float(self.ratio_keys[self.bucket_ids[index]])]))
+
     def getdata(self, index):
         img_path = self.img_samples[index]
         npz_path = self.txt_feat_samples[index]
         npy_path = self.vae_feat_samples[index]
-        ori_h, ori_w = self.meta_data_clean[index]['height'], self.meta_data_clean[index]['width']
+        ori_h, ori_w = self.get_hw(index)
 
-        # Calculate the closest aspect ratio and resize & crop image[w, h]
-        closest_size, closest_ratio = get_closest_ratio(ori_h, ori_w, self.aspect_ratio)
+        # Closest aspect ratio (precomputed bucket), then resize & crop image[w, h]
+        bucket = self.ratio_keys[self.bucket_ids[index]]
+        closest_size, closest_ratio = self.aspect_ratio[bucket], float(bucket)
         closest_size = list(map(lambda x: int(x), closest_size))
         self.closest_ratio = closest_ratio
 
         if self.load_vae_feat:
             try:
                 img = self.loader(npy_path)
-                if index not in self.ratio_index[closest_ratio]:
-                    self.ratio_index[closest_ratio].append(index)
             except Exception:
-                index = random.choice(self.ratio_index[closest_ratio])
-                return self.getdata(index)
+                return self.getdata(self.resample_index(index))
             h, w = (img.shape[1], img.shape[2])
             assert h, w == (ori_h//8, ori_w//8)
         else:
@@ -117,11 +161,7 @@ class InternalDataMS(InternalData):
         data_info['aspect_ratio'] = closest_ratio
         data_info["mask_type"] = self.mask_type
 
-        txt_info = np.load(npz_path)
-        txt_fea = torch.from_numpy(txt_info['caption_feature'])
-        attention_mask = torch.ones(1, 1, txt_fea.shape[1])
-        if 'attention_mask' in txt_info.keys():
-            attention_mask = torch.from_numpy(txt_info['attention_mask'])[None]
+        txt_fea, attention_mask = self.load_txt_feat(npz_path)
 
         if not self.load_vae_feat:
             if closest_size[0] / ori_h > closest_size[1] / ori_w:
@@ -147,5 +187,5 @@ class InternalDataMS(InternalData):
                 return self.getdata(idx)
             except Exception as e:
                 print(f"Error details: {str(e)}")
-                idx = random.choice(self.ratio_index[self.closest_ratio])
+                idx = self.resample_index(idx)
         raise RuntimeError('Too many bad data.')
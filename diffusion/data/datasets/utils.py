@@ -1,3 +1,7 @@
+import hashlib
+
+import numpy as np
+
 
 
 ASPECT_RATIO_1024 = {
@@ -82,3 +86,29 @@ ASPECT_RATIO_1024_TEST = {
 def get_chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
+
+
+def get_closest_ratio_ids(height, width, ratios: dict):
+    """Vectorized closest aspect-ratio lookup.
+
+    Returns, for every (height, width) pair, the index of its closest ratio in `sorted_ratio_keys(ratios)`.
+    Ties go to the smaller ratio, matching `min(ratios.keys(), key=...)` over the ascending ASPECT_RATIO_* tables.
+    """
+    keys = np.array([float(k) for k in sorted_ratio_keys(ratios)], dtype=np.float64)
+    aspect_ratio = np.asarray(height, dtype=np.float64) / np.asarray(width, dtype=np.float64)
+    right = np.clip(np.searchsorted(keys, aspect_ratio), 1, len(keys) - 1)
+    left = right - 1
+    use_left = np.abs(keys[left] - aspect_ratio) <= np.abs(keys[right] - aspect_ratio)
+    return np.where(use_left, left, right).astype(np.int16)
+
+
+def sorted_ratio_keys(ratios: dict):
+    return sorted(ratios.keys(), key=float)
+
+
+def file_md5(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
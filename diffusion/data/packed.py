@@ -0,0 +1,327 @@
+"""
+Packed, memory-mapped storage for precomputed per-sample features.
+
+A store is a directory of raw shard files plus a sorted index:
+
+    root/
+        meta.json               dtype, ndim and sample counts
+        shard_00000.bin         concatenated, uncompressed sample arrays
+        shard_00000.idx.npz     per-shard index (keys, offsets, shapes); its presence marks the shard as complete
+        ...
+        index/keys.npy          sorted sample keys (fixed-width bytes)
+        index/shard.npy         shard id of every key
+        index/offset.npy        element offset of every key inside its shard
+        index/shape.npy         array shape of every key
+
+Samples are stored with their true (unpadded) shape, so a T5 caption feature only occupies
+`num_tokens x 4096` elements and a VAE latent keeps its per-bucket `H x W`.
+
+`MetaIndex` applies the same idea to the `data_info.json` metadata: numeric columns as .npy arrays and
+strings (paths, prompts) as one byte blob plus an offsets table, all memory-mapped and shared by every worker.
+"""
+import glob
+import json
+import os
+
+import numpy as np
+
+SHARD_NAME = 'shard_{:05d}.bin'
+SHARD_INDEX_NAME = 'shard_{:05d}.idx.npz'
+
+
+def _encode_keys(keys):
+    return np.array([k.encode('utf-8') if isinstance(k, str) else k for k in keys], dtype=np.bytes_)
+
+
+class PackedFeatureWriter:
+    """Append arrays of a fixed rank into fixed-size, uncompressed shards.
+
+    A shard's index is written only when the shard is closed, so a crashed run leaves at most one
+    incomplete shard behind. Re-opening the same root drops that shard and continues with a new one;
+    `done_keys` returns the keys that are already safely stored.
+
+    Args:
+        root (str): Output directory of the store.
+        ndim (int): Rank of every stored array, e.g. 2 for (L, C) caption features.
+        dtype (str): Storage dtype. Arrays are cast on write.
+        shard_size (int): Approximate shard size in bytes before a new shard is started.
+    """
+
+    def __init__(self, root, ndim, dtype='float16', shard_size=1 << 30):
+        self.root = root
+        self.ndim = ndim
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+
+        completed = self.completed_shards(root)
+        for path in glob.glob(os.path.join(root, 'shard_*.bin')):
+            shard_id = int(os.path.basename(path)[6:11])
+            if shard_id not in completed:
+                os.remove(path)     # incomplete shard from an interrupted run
+        self.shard_id = max(completed, default=-1) + 1
+        self._file = None
+        self._reset_shard()
+
+    @staticmethod
+    def completed_shards(root):
+        return sorted(int(os.path.basename(p)[6:11]) for p in glob.glob(os.path.join(root, 'shard_*.idx.npz')))
+
+    def done_keys(self):
+        keys = set()
+        for shard_id in self.completed_shards(self.root):
+            with np.load(os.path.join(self.root, SHARD_INDEX_NAME.format(shard_id))) as idx:
+                keys.update(k.decode('utf-8') for k in idx['keys'])
+        return keys
+
+    def _reset_shard(self):
+        self._keys, self._offsets, self._shapes = [], [], []
+        self._offset = 0
+
+    def add(self, key, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        assert array.ndim == self.ndim, f'expected a {self.ndim}-d array for {key}, got shape {array.shape}'
+        if self._file is None:
+            self._file = open(os.path.join(self.root, SHARD_NAME.format(self.shard_id)), 'wb')
+        self._file.write(array.tobytes())
+        self._keys.append(key)
+        self._offsets.append(self._offset)
+        self._shapes.append(array.shape)
+        self._offset += array.size
+        if self._offset * self.dtype.itemsize >= self.shard_size:
+            self.flush_shard()
+
+    def flush_shard(self):
+        """Close the current shard and commit its index. Returns the committed shard id or None."""
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        tmp_path = os.path.join(self.root, f'.tmp_{SHARD_INDEX_NAME.format(self.shard_id)}')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=_encode_keys(self._keys),
+                     offset=np.asarray(self._offsets, dtype=np.int64),
+                     shape=np.asarray(self._shapes, dtype=np.int32).reshape(-1, self.ndim))
+        os.replace(tmp_path, os.path.join(self.root, SHARD_INDEX_NAME.format(self.shard_id)))
+        shard_id = self.shard_id
+        self.shard_id += 1
+        self._reset_shard()
+        return shard_id
+
+    def close(self):
+        self.flush_shard()
+        build_packed_index(self.root, self.ndim, self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+
+
+def build_packed_index(root, ndim, dtype):
+    """Merge all per-shard indexes under `root` into the sorted global index used by `PackedFeatureReader`."""
+    keys, shards, offsets, shapes = [], [], [], []
+    for shard_id in PackedFeatureWriter.completed_shards(root):
+        with np.load(os.path.join(root, SHARD_INDEX_NAME.format(shard_id))) as idx:
+            keys.append(idx['keys'])
+            offsets.append(idx['offset'])
+            shapes.append(idx['shape'])
+            shards.append(np.full(len(idx['keys']), shard_id, dtype=np.int32))
+    if keys:
+        keys, shards = np.concatenate(keys), np.concatenate(shards)
+        offsets, shapes = np.concatenate(offsets), np.concatenate(shapes)
+    else:
+        keys, shards = np.array([], dtype='S1'), np.array([], dtype=np.int32)
+        offsets, shapes = np.array([], dtype=np.int64), np.zeros((0, ndim), dtype=np.int32)
+    order = np.argsort(keys, kind='stable')
+
+    index_dir = os.path.join(root, 'index')
+    os.makedirs(index_dir, exist_ok=True)
+    for name, value in (('keys', keys[order]), ('shard', shards[order]), ('offset', offsets[order]), ('shape', shapes[order])):
+        np.save(os.path.join(index_dir, f'{name}.npy'), value)
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump({'dtype': np.dtype(dtype).name, 'ndim': ndim, 'num_samples': int(len(keys)),
+                   'num_shards': int(len(np.unique(shards)))}, f)
+
+
+class PackedFeatureReader:
+    """Read-only, memory-mapped view of a store written by `PackedFeatureWriter`.
+
+    Index arrays and shards are mapped lazily, so the object is cheap to create and to pickle into
+    DataLoader workers; every worker shares the page cache instead of holding its own copy.
+    Returned arrays are copy-on-write views into the shard, so `torch.from_numpy` does not copy.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.dtype = np.dtype(self.meta['dtype'])
+        self._index = None
+        self._shards = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            index_dir = os.path.join(self.root, 'index')
+            self._index = {name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+                           for name in ('keys', 'shard', 'offset', 'shape')}
+        return self._index
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(os.path.join(self.root, SHARD_NAME.format(shard_id)), dtype=self.dtype, mode='c')
+        return self._shards[shard_id]
+
+    def find(self, key):
+        """Return the index row of `key`, or -1 when it is not stored."""
+        keys = self.index['keys']
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        row = int(np.searchsorted(keys, key))
+        if row < len(keys) and keys[row] == key:
+            return row
+        return -1
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def get_row(self, row):
+        shape = tuple(int(s) for s in self.index['shape'][row])
+        offset = int(self.index['offset'][row])
+        shard = self._shard(int(self.index['shard'][row]))
+        return shard[offset: offset + int(np.prod(shape))].reshape(shape)
+
+    def get(self, key):
+        row = self.find(key)
+        if row < 0:
+            raise KeyError(f'{key} not found in packed store {self.root}')
+        return self.get_row(row)
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def __getstate__(self):
+        # mappings are re-opened lazily in each worker process
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_shards'] = {}
+        return state
+
+
+def _write_blob(path_prefix, strings):
+    encoded = [x.encode('utf-8') for x in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    with open(f'{path_prefix}_blob.bin', 'wb') as f:
+        for x in encoded:
+            f.write(x)
+    np.save(f'{path_prefix}_offsets.npy', offsets)
+
+
+def build_meta_index(meta_data, out_dir, ori_imgs_nums=None, bucket_ids=None, extra_meta=None):
+    """Write a `MetaIndex` for a list of `data_info.json` items.
+
+    Args:
+        meta_data (list[dict]): Items with `path`, `prompt`, `height`, `width` and `ratio` keys.
+        out_dir (str): Output directory.
+        ori_imgs_nums (int): Number of items before filtering, reported by the dataset.
+        bucket_ids (dict): Optional {aspect_ratio_type: int array} of precomputed aspect-ratio buckets.
+        extra_meta (dict): Extra fields stored in meta.json, e.g. the source partition files.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, 'height.npy'), np.array([item['height'] for item in meta_data], dtype=np.int32))
+    np.save(os.path.join(out_dir, 'width.npy'), np.array([item['width'] for item in meta_data], dtype=np.int32))
+    np.save(os.path.join(out_dir, 'ratio.npy'), np.array([item['ratio'] for item in meta_data], dtype=np.float32))
+    _write_blob(os.path.join(out_dir, 'path'), [item['path'] for item in meta_data])
+    _write_blob(os.path.join(out_dir, 'prompt'), [item.get('prompt', '') for item in meta_data])
+    for name, ids in (bucket_ids or {}).items():
+        np.save(os.path.join(out_dir, f'bucket_{name}.npy'), np.asarray(ids, dtype=np.int16))
+    meta = {'num_samples': len(meta_data), 'ori_imgs_nums': len(meta_data) if ori_imgs_nums is None else ori_imgs_nums}
+    meta.update(extra_meta or {})
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+class MetaIndex:
+    """Columnar, memory-mapped replacement for the per-sample metadata lists of `InternalData`.
+
+    Opening an index only reads meta.json; columns are mapped on first access, so dataset construction
+    takes O(1) time and memory and DataLoader workers share one copy through the page cache.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self._columns = {}
+
+    def column(self, name):
+        if name not in self._columns:
+            path = os.path.join(self.root, name)
+            if name.endswith('_blob'):
+                self._columns[name] = np.memmap(f'{path}.bin', dtype=np.uint8, mode='r')
+            else:
+                self._columns[name] = np.load(f'{path}.npy', mmap_mode='r')
+        return self._columns[name]
+
+    @property
+    def height(self):
+        return self.column('height')
+
+    @property
+    def width(self):
+        return self.column('width')
+
+    @property
+    def ratio(self):
+        return self.column('ratio')
+
+    def bucket_ids(self, aspect_ratio_type):
+        """Precomputed bucket ids for an ASPECT_RATIO_* table name, or None if the index was built without them."""
+        if not os.path.exists(os.path.join(self.root, f'bucket_{aspect_ratio_type}.npy')):
+            return None
+        return self.column(f'bucket_{aspect_ratio_type}')
+
+    def string(self, name, idx):
+        offsets = self.column(f'{name}_offsets')
+        return bytes(self.column(f'{name}_blob')[offsets[idx]: offsets[idx + 1]]).decode('utf-8')
+
+    def __getitem__(self, idx):
+        # same fields as a data_info.json item
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return {'path': self.string('path', idx), 'prompt': self.string('prompt', idx), 'height': int(self.height[idx]),
+                'width': int(self.width[idx]), 'ratio': float(self.ratio[idx])}
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = {}
+        return state
+
+
+class IndexColumn:
+    """Lazy list-like view over one string column of a `MetaIndex`, optionally mapped through `fn`.
+
+    Stands in for the per-sample lists of paths and prompts without materializing them.
+    """
+
+    def __init__(self, index, name, fn=None):
+        self.index = index
+        self.name = name
+        self.fn = fn
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        value = self.index.string(self.name, idx)
+        return value if self.fn is None else self.fn(value)
+
+    def __len__(self):
+        return len(self.index)
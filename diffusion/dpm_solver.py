@@ -1,9 +1,18 @@
 import torch
 from .model import gaussian_diffusion as gd
 from .model.dpm_solver import model_wrapper, DPM_Solver, NoiseScheduleVP
+from .model.utils import with_cond_cache
 
 
-def DPMS(model, condition, uncondition, cfg_scale, model_type='noise', noise_schedule="linear", guidance_type='classifier-free', model_kwargs=None, diffusion_steps=1000):
+def DPMS(model, condition, uncondition, cfg_scale, model_type='noise', noise_schedule="linear", guidance_type='classifier-free', model_kwargs=None, diffusion_steps=1000, guidance_interval=None):
+    """
+    DPM-Solver++ for one sampling call. If `model` takes a `cond_cache` (e.g. `forward_with_dpmsolver`), the
+    timestep-invariant conditioning is computed once and reused by every step: create a new solver per call.
+    guidance_interval: `(t_min, t_max)` continuous-time window of classifier-free guidance, see `model_wrapper`.
+    The evaluation counts are in `guidance_stats` of the returned solver.
+    DPM-Solver++ is deterministic given its initial noise: draw it with `StackedRandomGenerator(device, seeds).randn`
+    for outputs that do not depend on the batch a sample runs in.
+    """
     if model_kwargs is None:
         model_kwargs = {}
     betas = torch.tensor(gd.get_named_beta_schedule(noise_schedule, diffusion_steps))
@@ -15,7 +24,7 @@ def DPMS(model, condition, uncondition, cfg_scale, model_type='noise', noise_sch
     ## noise prediction model. Here is an example for a diffusion model
     ## `model` with the noise prediction type ("noise") .
     model_fn = model_wrapper(
-        model,
+        with_cond_cache(model),
         noise_schedule,
         model_type=model_type,
         model_kwargs=model_kwargs,
@@ -23,6 +32,9 @@ def DPMS(model, condition, uncondition, cfg_scale, model_type='noise', noise_sch
         condition=condition,
         unconditional_condition=uncondition,
         guidance_scale=cfg_scale,
+        guidance_interval=guidance_interval,
     )
     ## 3. Define dpm-solver and sample by multistep DPM-Solver.
-    return DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++")
\ No newline at end of file
+    dpm_solver = DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++")
+    dpm_solver.guidance_stats = model_fn.guidance_stats
+    return dpm_solver
@@ -1,3 +1,7 @@
+from contextlib import nullcontext
+
+import torch
+from accelerate import init_on_device
 from mmcv import Registry
 
 from diffusion.model.utils import set_grad_checkpoint
@@ -5,10 +9,17 @@ from diffusion.model.utils import set_grad_checkpoint
 MODELS = Registry('models')
 
 
-def build_model(cfg, use_grad_checkpoint=False, use_fp32_attention=False, gc_step=1, **kwargs):
+def build_model(cfg, use_grad_checkpoint=False, use_fp32_attention=False, gc_step=1, init_weights=True, device=None, **kwargs):
+    """
+    Args:
+        init_weights (bool): False skips the weight initialization, for weights that are loaded right after.
+        device (str, optional): Device the parameters are created on. 'meta' allocates nothing; load the weights with
+            `diffusion.utils.checkpoint.load_model_weights`, which fills them straight from the checkpoint.
+    """
     if isinstance(cfg, str):
         cfg = dict(type=cfg)
-    model = MODELS.build(cfg, default_args=kwargs)
+    with init_on_device(torch.device(device)) if device is not None else nullcontext():
+        model = MODELS.build(cfg, default_args=dict(kwargs, init_weights=init_weights))
     if use_grad_checkpoint:
         set_grad_checkpoint(model, use_fp32_attention=use_fp32_attention, gc_step=gc_step)
     return model
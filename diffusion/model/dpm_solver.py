@@ -181,6 +181,7 @@ def model_wrapper(
         guidance_scale=1.,
         classifier_fn=None,
         classifier_kwargs={},
+        guidance_interval=None,
 ):
     """Create a wrapper function for the noise prediction model.
 
@@ -267,8 +268,13 @@ def model_wrapper(
         guidance_scale: A `float`. The scale for the guided sampling.
         classifier_fn: A classifier function. Only used for the classifier guidance.
         classifier_kwargs: A `dict`. A dict for the other inputs of the classifier function.
+        guidance_interval: A tuple `(t_min, t_max)` of continuous times (t = T is pure noise). Only used for
+                    "classifier-free" guidance type: guidance is applied for t in [t_min, t_max] only, outside of it
+                    just the conditional branch is evaluated. None applies guidance at every step.
     Returns:
         A noise prediction model that accepts the noised data and the continuous time as the inputs.
+        Its `guidance_stats` dict counts the per-sample network evaluations run (`evals`) and the unconditional
+        ones skipped by `guidance_interval` (`skipped`).
     """
 
     def get_model_input_time(t_continuous):
@@ -324,15 +330,26 @@ def model_wrapper(
             return noise - guidance_scale * expand_dims(sigma_t, x.dim()) * cond_grad
         elif guidance_type == "classifier-free":
             if guidance_scale == 1. or unconditional_condition is None:
+                guidance_stats['evals'] += x.shape[0]
                 return noise_pred_fn(x, t_continuous, cond=condition)
+            if guidance_interval is not None and not guidance_interval[0] <= t_continuous.reshape(-1)[0].item() <= guidance_interval[1]:
+                guidance_stats['evals'] += x.shape[0]
+                guidance_stats['skipped'] += x.shape[0]
+                return noise_pred_fn(x, t_continuous, cond=condition)
+            guidance_stats['evals'] += 2 * x.shape[0]
             x_in = torch.cat([x] * 2)
             t_in = torch.cat([t_continuous] * 2)
-            c_in = torch.cat([unconditional_condition, condition])
-            noise_uncond, noise = noise_pred_fn(x_in, t_in, cond=c_in).chunk(2)
+            noise_uncond, noise = noise_pred_fn(x_in, t_in, cond=cfg_condition).chunk(2)
             return noise_uncond + guidance_scale * (noise - noise_uncond)
 
     assert model_type in ["noise", "x_start", "v", "score"]
     assert guidance_type in ["uncond", "classifier", "classifier-free"]
+    # the same condition tensor at every step, so per-call conditioning caches of the model hit without a comparison
+    cfg_condition = None
+    if guidance_type == "classifier-free" and unconditional_condition is not None:
+        cfg_condition = torch.cat([unconditional_condition, condition])
+    guidance_stats = {'evals': 0, 'skipped': 0}
+    model_fn.guidance_stats = guidance_stats
     return model_fn
 
 
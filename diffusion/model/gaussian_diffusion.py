@@ -387,6 +387,7 @@ class GaussianDiffusion:
         denoised_fn=None,
         cond_fn=None,
         model_kwargs=None,
+        randn_like=th.randn_like,
     ):
         """
         Sample x_{t-1} from the model at the given timestep.
@@ -400,6 +401,7 @@ class GaussianDiffusion:
                         similarly to the model.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
+        :param randn_like: the noise source, e.g. `StackedRandomGenerator.randn_like` for per-sample seeds.
         :return: a dict containing the following keys:
                  - 'sample': a random sample from the model.
                  - 'pred_xstart': a prediction of x_0.
@@ -412,7 +414,7 @@ class GaussianDiffusion:
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
         )
-        noise = th.randn_like(x)
+        noise = randn_like(x)
         nonzero_mask = (
             (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
         )  # no noise when t == 0
@@ -432,6 +434,7 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        randn_like=th.randn_like,
     ):
         """
         Generate samples from the model.
@@ -449,6 +452,8 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
+        :param randn_like: the noise source of the initial and per-step noise, e.g.
+                           `StackedRandomGenerator.randn_like` so that a sample does not depend on its batch.
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -462,6 +467,7 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
             device=device,
             progress=progress,
+            randn_like=randn_like,
         ):
             final = sample
         return final["sample"]
@@ -477,6 +483,7 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        randn_like=th.randn_like,
     ):
         """
         Generate samples from the model and yield intermediate samples from
@@ -488,7 +495,7 @@ class GaussianDiffusion:
         if device is None:
             device = next(model.parameters()).device
         assert isinstance(shape, (tuple, list))
-        img = noise if noise is not None else th.randn(*shape, device=device)
+        img = noise if noise is not None else randn_like(th.empty(*shape, device=device))
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -508,6 +515,7 @@ class GaussianDiffusion:
                     denoised_fn=denoised_fn,
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
+                    randn_like=randn_like,
                 )
                 yield out
                 img = out["sample"]
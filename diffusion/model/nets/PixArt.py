@@ -9,6 +9,8 @@
 # MAE: https://github.com/facebookresearch/mae/blob/main/models_mae.py
 # --------------------------------------------------------
 import math
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import os
@@ -17,8 +19,9 @@ from timm.models.layers import DropPath
 from timm.models.vision_transformer import PatchEmbed, Mlp
 
 from diffusion.model.builder import MODELS
-from diffusion.model.utils import auto_grad_checkpoint, to_2tuple
-from diffusion.model.nets.PixArt_blocks import t2i_modulate, CaptionEmbedder, WindowAttention, MultiHeadCrossAttention, T2IFinalLayer, TimestepEmbedder, LabelEmbedder, FinalLayer
+from diffusion.model.utils import auto_grad_checkpoint, cached_condition, to_2tuple
+from diffusion.model.tome import compute_merge, in_range
+from diffusion.model.nets.PixArt_blocks import t2i_modulate, t2i_norm_modulate, gated_residual, CaptionEmbedder, WindowAttention, MultiHeadCrossAttention, T2IFinalLayer, TimestepEmbedder, LabelEmbedder, FinalLayer
 from diffusion.utils.logger import get_root_logger
 
 
@@ -43,13 +46,22 @@ class PixArtBlock(nn.Module):
         self.window_size = window_size
         self.scale_shift_table = nn.Parameter(torch.randn(6, hidden_size) / hidden_size ** 0.5)
 
-    def forward(self, x, y, t, mask=None, **kwargs):
+    def forward(self, x, y, t, mask=None, cross_kv=None, merge_ratio=0., merge_hw=None, merge_seed=0, **kwargs):
         B, N, C = x.shape
 
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (self.scale_shift_table[None] + t.reshape(B, 6, -1)).chunk(6, dim=1)
-        x = x + self.drop_path(gate_msa * self.attn(t2i_modulate(self.norm1(x), shift_msa, scale_msa)).reshape(B, N, C))
-        x = x + self.cross_attn(x, y, mask)
-        x = x + self.drop_path(gate_mlp * self.mlp(t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)))
+        if self.training and not isinstance(self.drop_path, nn.Identity):
+            x = x + self.drop_path(gate_msa * self.attn(t2i_modulate(self.norm1(x), shift_msa, scale_msa)).reshape(B, N, C))
+            x = x + self.cross_attn(x, y, mask, kv=cross_kv)
+            x = x + self.drop_path(gate_mlp * self.mlp(t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)))
+            return x
+
+        # fused path: norm+modulate and gate+residual without the (B, N, C) temporaries of the ops above;
+        # with token merging (inference), self-attention and MLP run on the merged tokens
+        merge, unmerge = compute_merge(x, merge_hw, merge_ratio, merge_seed)
+        x = gated_residual(x, unmerge(self.attn(merge(t2i_norm_modulate(self.norm1, x, shift_msa, scale_msa))).reshape(B, -1, C)), gate_msa)
+        x = gated_residual(x, self.cross_attn(x, y, mask, kv=cross_kv))
+        x = gated_residual(x, unmerge(self.mlp(merge(t2i_norm_modulate(self.norm2, x, shift_mlp, scale_mlp)))), gate_mlp)
 
         return x
 
@@ -62,8 +74,10 @@ class PixArt(nn.Module):
     """
     Diffusion model with a Transformer backbone.
     """
+    # multi-scale pos embeds kept by `get_pos_embed`: one entry per bucket of an ASPECT_RATIO_* table
+    pos_embed_cache_size = 40
 
-    def __init__(self, input_size=32, patch_size=2, in_channels=4, hidden_size=1152, depth=28, num_heads=16, mlp_ratio=4.0, class_dropout_prob=0.1, pred_sigma=True, drop_path: float = 0., window_size=0, window_block_indexes=None, use_rel_pos=False, caption_channels=4096, lewei_scale=1.0, config=None, model_max_length=120, **kwargs):
+    def __init__(self, input_size=32, patch_size=2, in_channels=4, hidden_size=1152, depth=28, num_heads=16, mlp_ratio=4.0, class_dropout_prob=0.1, pred_sigma=True, drop_path: float = 0., window_size=0, window_block_indexes=None, use_rel_pos=False, caption_channels=4096, lewei_scale=1.0, config=None, model_max_length=120, init_weights=True, **kwargs):
         if window_block_indexes is None:
             window_block_indexes = []
         super().__init__()
@@ -80,6 +94,8 @@ class PixArt(nn.Module):
         self.base_size = input_size // self.patch_size
         # Will use fixed sin-cos embedding:
         self.register_buffer("pos_embed", torch.zeros(1, num_patches, hidden_size))
+        self._pos_embed_cache = OrderedDict()
+        self.token_merging = None     # see `set_token_merging`
 
         approx_gelu = lambda: nn.GELU(approximate="tanh")
         self.t_block = nn.Sequential(
@@ -97,7 +113,11 @@ class PixArt(nn.Module):
         ])
         self.final_layer = T2IFinalLayer(hidden_size, patch_size, self.out_channels)
 
-        self.initialize_weights()
+        # init_weights=False for weights that are loaded right after; pos_embed is never loaded from checkpoints
+        if init_weights:
+            self.initialize_weights()
+        else:
+            self.initialize_pos_embed()
 
         if config:
             logger = get_root_logger(os.path.join(config.work_dir, 'train_log.log'))
@@ -105,43 +125,79 @@ class PixArt(nn.Module):
         else:
             print(f'Warning: lewei scale: {self.lewei_scale}, base size: {self.base_size}')
 
-    def forward(self, x, timestep, y, mask=None, data_info=None, **kwargs):
+    def forward(self, x, timestep, y, mask=None, data_info=None, cond_cache=None, **kwargs):
         """
         Forward pass of PixArt.
         x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
         t: (N,) tensor of diffusion timesteps
         y: (N, 1, 120, C) tensor of class labels
+        cond_cache: dict shared by the steps of one sampling call (inference only), see `embed_caption`
         """
         x = x.to(self.dtype)
         timestep = timestep.to(self.dtype)
-        y = y.to(self.dtype)
         pos_embed = self.pos_embed.to(self.dtype)
         self.h, self.w = x.shape[-2]//self.patch_size, x.shape[-1]//self.patch_size
         x = self.x_embedder(x) + pos_embed  # (N, T, D), where T = H * W / patch_size ** 2
         t = self.t_embedder(timestep.to(x.dtype))  # (N, D)
         t0 = self.t_block(t)
-        y = self.y_embedder(y, self.training)  # (N, 1, L, D)
+        y, y_lens, blocks_kwargs = cached_condition(cond_cache, 'caption', (y, mask), lambda: self.embed_caption(y, mask, cond_cache is not None))
+        for block, block_kwargs, merge_kwargs in zip(self.blocks, blocks_kwargs, self.token_merging_kwargs(timestep)):
+            x = auto_grad_checkpoint(block, x, y, t0, y_lens, **block_kwargs, **merge_kwargs)  # (N, T, D) #support grad checkpoint
+        x = self.final_layer(x, t)  # (N, T, patch_size ** 2 * out_channels)
+        x = self.unpatchify(x)  # (N, out_channels, H, W)
+        return x
+
+    def set_token_merging(self, rules=None):
+        """
+        Inference-only token merging (ToMe): before the self-attention and MLP of a block, `ratio` of the image tokens
+        are merged into similar ones and unmerged after, see `diffusion.model.tome`.
+        rules: list of dicts with a `ratio` and optional half-open `blocks` (start, end) and `timesteps` (min, max)
+            ranges, the model timestep being in [0, 1000); the first matching rule applies. None disables merging.
+            e.g. [dict(ratio=0.5, blocks=(0, 14), timesteps=(200, 1000))]
+        """
+        assert all(0 <= rule['ratio'] <= 0.75 for rule in rules or []), 'at most 3/4 of the tokens can be merged'
+        self.token_merging = [dict(rule) for rule in rules] if rules else None
+
+    def token_merging_kwargs(self, timestep):
+        """Per-block token-merging arguments of one forward pass."""
+        if not self.token_merging or self.training:
+            return [{}] * len(self.blocks)
+        t = float(timestep.flatten()[0])    # one host sync per forward, only with token merging
+        merge_kwargs = []
+        for i in range(len(self.blocks)):
+            ratio = next((rule['ratio'] for rule in self.token_merging
+                          if in_range(i, rule.get('blocks')) and in_range(t, rule.get('timesteps'))), 0.)
+            merge_kwargs.append(dict(merge_ratio=ratio, merge_hw=(self.h, self.w), merge_seed=i * 1000 + int(t)) if ratio else {})
+        return merge_kwargs
+
+    def embed_caption(self, y, mask=None, precompute_kv=False):
+        """
+        Timestep-invariant caption conditioning: caption embedding and packing of the valid tokens.
+        y: (N, 1, 120, C) caption features; mask: (N, 120) or None
+        precompute_kv: also run the cross-attention kv_linear of every block, to reuse it across solver steps
+        return: packed tokens (1, sum(y_lens), D), y_lens, per-block keyword arguments
+        """
+        y = self.y_embedder(y.to(self.dtype), self.training)  # (N, 1, L, D)
         if mask is not None:
             if mask.shape[0] != y.shape[0]:
                 mask = mask.repeat(y.shape[0] // mask.shape[0], 1)
             mask = mask.squeeze(1).squeeze(1)
-            y = y.squeeze(1).masked_select(mask.unsqueeze(-1) != 0).view(1, -1, x.shape[-1])
+            y = y.squeeze(1).masked_select(mask.unsqueeze(-1) != 0).view(1, -1, y.shape[-1])
             y_lens = mask.sum(dim=1).tolist()
         else:
             y_lens = [y.shape[2]] * y.shape[0]
-            y = y.squeeze(1).view(1, -1, x.shape[-1])
-        for block in self.blocks:
-            x = auto_grad_checkpoint(block, x, y, t0, y_lens)  # (N, T, D) #support grad checkpoint
-        x = self.final_layer(x, t)  # (N, T, patch_size ** 2 * out_channels)
-        x = self.unpatchify(x)  # (N, out_channels, H, W)
-        return x
+            y = y.squeeze(1).view(1, -1, y.shape[-1])
+        if precompute_kv:
+            return y, y_lens, [{'cross_kv': block.cross_attn.kv_linear(y)} for block in self.blocks]
+        return y, y_lens, [{}] * len(self.blocks)
 
-    def forward_with_dpmsolver(self, x, timestep, y, mask=None, **kwargs):
+    def forward_with_dpmsolver(self, x, timestep, y, mask=None, cond_cache=None, **kwargs):
         """
         dpm solver donnot need variance prediction
+        cond_cache: a dict per sampling call to compute the timestep-invariant conditioning once (see `with_cond_cache`)
         """
         # https://github.com/openai/glide-text2im/blob/main/notebooks/text2im.ipynb
-        model_out = self.forward(x, timestep, y, mask)
+        model_out = self.forward(x, timestep, y, mask, cond_cache=cond_cache)
         return model_out.chunk(2, dim=1)[0]
 
     def forward_with_cfg(self, x, timestep, y, cfg_scale, mask=None, **kwargs):
@@ -183,9 +239,7 @@ class PixArt(nn.Module):
 
         self.apply(_basic_init)
 
-        # Initialize (and freeze) pos_embed by sin-cos embedding:
-        pos_embed = get_2d_sincos_pos_embed(self.pos_embed.shape[-1], int(self.x_embedder.num_patches ** 0.5), lewei_scale=self.lewei_scale, base_size=self.base_size)
-        self.pos_embed.data.copy_(torch.from_numpy(pos_embed).float().unsqueeze(0))
+        self.initialize_pos_embed()
 
         # Initialize patch_embed like nn.Linear (instead of nn.Conv2d):
         w = self.x_embedder.proj.weight.data
@@ -209,6 +263,29 @@ class PixArt(nn.Module):
         nn.init.constant_(self.final_layer.linear.weight, 0)
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
+    def initialize_pos_embed(self):
+        # Initialize (and freeze) pos_embed by sin-cos embedding:
+        pos_embed = get_2d_sincos_pos_embed(self.pos_embed.shape[-1], int(self.x_embedder.num_patches ** 0.5), lewei_scale=self.lewei_scale, base_size=self.base_size)
+        self.pos_embed.data.copy_(torch.from_numpy(pos_embed).float().unsqueeze(0))
+
+    def get_pos_embed(self, h, w, device, dtype):
+        """
+        Fixed sin-cos pos embed of an (h, w) patch grid, (1, h * w, D), for multi-scale inputs.
+        Cached per (h, w, lewei_scale, base_size, device, dtype), so repeated sampling steps do not rebuild the grid
+        or copy it to the device again.
+        """
+        key = (h, w, self.lewei_scale, self.base_size, torch.device(device), dtype)
+        pos_embed = self._pos_embed_cache.get(key)
+        if pos_embed is None:
+            pos_embed = get_2d_sincos_pos_embed_torch(self.pos_embed.shape[-1], (h, w), lewei_scale=self.lewei_scale, base_size=self.base_size)
+            pos_embed = pos_embed.unsqueeze(0).to(device=device, dtype=dtype)
+            self._pos_embed_cache[key] = pos_embed
+            if len(self._pos_embed_cache) > self.pos_embed_cache_size:
+                self._pos_embed_cache.popitem(last=False)
+        else:
+            self._pos_embed_cache.move_to_end(key)
+        return pos_embed
+
     @property
     def dtype(self):
         return next(self.parameters()).dtype
@@ -264,6 +341,34 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
     return np.concatenate([emb_sin, emb_cos], axis=1)
 
 
+def get_2d_sincos_pos_embed_torch(embed_dim, grid_size, lewei_scale=1.0, base_size=16):
+    """
+    Torch version of `get_2d_sincos_pos_embed` (without cls token), computed in float64 like the numpy one.
+    return:
+    pos_embed: [grid_size[0]*grid_size[1], embed_dim] float64 tensor
+    """
+    if isinstance(grid_size, int):
+        grid_size = to_2tuple(grid_size)
+    if isinstance(lewei_scale, (tuple, list)):
+        lewei_scale = lewei_scale[0]
+    grid_h = (torch.arange(grid_size[0], dtype=torch.float32) / (grid_size[0]/base_size)).double() / lewei_scale
+    grid_w = (torch.arange(grid_size[1], dtype=torch.float32) / (grid_size[1]/base_size)).double() / lewei_scale
+    grid = torch.meshgrid(grid_w, grid_h, indexing='xy')  # here w goes first, same layout as np.meshgrid
+
+    assert embed_dim % 2 == 0
+    emb_h = get_1d_sincos_pos_embed_torch(embed_dim // 2, grid[0])  # (H*W, D/2)
+    emb_w = get_1d_sincos_pos_embed_torch(embed_dim // 2, grid[1])  # (H*W, D/2)
+    return torch.cat([emb_h, emb_w], dim=1)
+
+
+def get_1d_sincos_pos_embed_torch(embed_dim, pos):
+    assert embed_dim % 2 == 0
+    omega = torch.arange(embed_dim // 2, dtype=torch.float64) / (embed_dim / 2.)
+    omega = 1. / 10000 ** omega  # (D/2,)
+    out = pos.reshape(-1, 1) * omega  # (M, D/2), outer product
+    return torch.cat([torch.sin(out), torch.cos(out)], dim=1)
+
+
 #################################################################################
 #                                   PixArt Configs                                  #
 #################################################################################
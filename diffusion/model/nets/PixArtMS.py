@@ -10,13 +10,15 @@
 # --------------------------------------------------------
 import torch
 import torch.nn as nn
+from accelerate import init_empty_weights
 from timm.models.layers import DropPath
 from timm.models.vision_transformer import Mlp
 
 from diffusion.model.builder import MODELS
-from diffusion.model.utils import auto_grad_checkpoint, to_2tuple
-from diffusion.model.nets.PixArt_blocks import t2i_modulate, CaptionEmbedder, WindowAttention, MultiHeadCrossAttention, T2IFinalLayer, TimestepEmbedder, SizeEmbedder
-from diffusion.model.nets.PixArt import PixArt, get_2d_sincos_pos_embed
+from diffusion.model.utils import auto_grad_checkpoint, cached_condition, to_2tuple
+from diffusion.model.tome import compute_merge
+from diffusion.model.nets.PixArt_blocks import t2i_modulate, t2i_norm_modulate, gated_residual, CaptionEmbedder, WindowAttention, MultiHeadCrossAttention, T2IFinalLayer, TimestepEmbedder, SizeEmbedder
+from diffusion.model.nets.PixArt import PixArt
 
 
 class PatchEmbed(nn.Module):
@@ -67,13 +69,22 @@ class PixArtMSBlock(nn.Module):
         self.window_size = window_size
         self.scale_shift_table = nn.Parameter(torch.randn(6, hidden_size) / hidden_size ** 0.5)
 
-    def forward(self, x, y, t, mask=None, **kwargs):
+    def forward(self, x, y, t, mask=None, cross_kv=None, merge_ratio=0., merge_hw=None, merge_seed=0, **kwargs):
         B, N, C = x.shape
 
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (self.scale_shift_table[None] + t.reshape(B, 6, -1)).chunk(6, dim=1)
-        x = x + self.drop_path(gate_msa * self.attn(t2i_modulate(self.norm1(x), shift_msa, scale_msa)))
-        x = x + self.cross_attn(x, y, mask)
-        x = x + self.drop_path(gate_mlp * self.mlp(t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)))
+        if self.training and not isinstance(self.drop_path, nn.Identity):
+            x = x + self.drop_path(gate_msa * self.attn(t2i_modulate(self.norm1(x), shift_msa, scale_msa)))
+            x = x + self.cross_attn(x, y, mask, kv=cross_kv)
+            x = x + self.drop_path(gate_mlp * self.mlp(t2i_modulate(self.norm2(x), shift_mlp, scale_mlp)))
+            return x
+
+        # fused path: norm+modulate and gate+residual without the (B, N, C) temporaries of the ops above;
+        # with token merging (inference), self-attention and MLP run on the merged tokens
+        merge, unmerge = compute_merge(x, merge_hw, merge_ratio, merge_seed)
+        x = gated_residual(x, unmerge(self.attn(merge(t2i_norm_modulate(self.norm1, x, shift_msa, scale_msa)))), gate_msa)
+        x = gated_residual(x, self.cross_attn(x, y, mask, kv=cross_kv))
+        x = gated_residual(x, unmerge(self.mlp(merge(t2i_norm_modulate(self.norm2, x, shift_mlp, scale_mlp)))), gate_mlp)
 
         return x
 
@@ -87,30 +98,34 @@ class PixArtMS(PixArt):
     Diffusion model with a Transformer backbone.
     """
 
-    def __init__(self, input_size=32, patch_size=2, in_channels=4, hidden_size=1152, depth=28, num_heads=16, mlp_ratio=4.0, class_dropout_prob=0.1, learn_sigma=True, pred_sigma=True, drop_path: float = 0., window_size=0, window_block_indexes=None, use_rel_pos=False, caption_channels=4096, lewei_scale=1., config=None, model_max_length=120, **kwargs):
+    def __init__(self, input_size=32, patch_size=2, in_channels=4, hidden_size=1152, depth=28, num_heads=16, mlp_ratio=4.0, class_dropout_prob=0.1, learn_sigma=True, pred_sigma=True, drop_path: float = 0., window_size=0, window_block_indexes=None, use_rel_pos=False, caption_channels=4096, lewei_scale=1., config=None, model_max_length=120, init_weights=True, **kwargs):
         if window_block_indexes is None:
             window_block_indexes = []
-        super().__init__(
-            input_size=input_size,
-            patch_size=patch_size,
-            in_channels=in_channels,
-            hidden_size=hidden_size,
-            depth=depth,
-            num_heads=num_heads,
-            mlp_ratio=mlp_ratio,
-            class_dropout_prob=class_dropout_prob,
-            learn_sigma=learn_sigma,
-            pred_sigma=pred_sigma,
-            drop_path=drop_path,
-            window_size=window_size,
-            window_block_indexes=window_block_indexes,
-            use_rel_pos=use_rel_pos,
-            lewei_scale=lewei_scale,
-            config=config,
-            model_max_length=model_max_length,
-            **kwargs,
-        )
+        # the layers of PixArt replaced below are built without allocating or initializing their weights
+        with init_empty_weights():
+            super().__init__(
+                input_size=input_size,
+                patch_size=patch_size,
+                in_channels=in_channels,
+                hidden_size=hidden_size,
+                depth=depth,
+                num_heads=num_heads,
+                mlp_ratio=mlp_ratio,
+                class_dropout_prob=class_dropout_prob,
+                learn_sigma=learn_sigma,
+                pred_sigma=pred_sigma,
+                drop_path=drop_path,
+                window_size=window_size,
+                window_block_indexes=window_block_indexes,
+                use_rel_pos=use_rel_pos,
+                lewei_scale=lewei_scale,
+                config=config,
+                model_max_length=model_max_length,
+                init_weights=False,
+                **kwargs,
+            )
         self.h = self.w = 0
+        self.t_embedder = TimestepEmbedder(hidden_size)
         approx_gelu = lambda: nn.GELU(approximate="tanh")
         self.t_block = nn.Sequential(
             nn.SiLU(),
@@ -130,50 +145,47 @@ class PixArtMS(PixArt):
         ])
         self.final_layer = T2IFinalLayer(hidden_size, patch_size, self.out_channels)
 
-        self.initialize()
+        if init_weights:
+            self.initialize()
 
-    def forward(self, x, timestep, y, mask=None, data_info=None, **kwargs):
+    def forward(self, x, timestep, y, mask=None, data_info=None, cond_cache=None, **kwargs):
         """
         Forward pass of PixArt.
         x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
         t: (N,) tensor of diffusion timesteps
         y: (N, 1, 120, C) tensor of class labels
+        cond_cache: dict shared by the steps of one sampling call (inference only), see `embed_caption`
         """
         bs = x.shape[0]
         x = x.to(self.dtype)
         timestep = timestep.to(self.dtype)
-        y = y.to(self.dtype)
-        c_size, ar = data_info['img_hw'].to(self.dtype), data_info['aspect_ratio'].to(self.dtype)
         self.h, self.w = x.shape[-2]//self.patch_size, x.shape[-1]//self.patch_size
-        pos_embed = torch.from_numpy(get_2d_sincos_pos_embed(self.pos_embed.shape[-1], (self.h, self.w), lewei_scale=self.lewei_scale, base_size=self.base_size)).unsqueeze(0).to(x.device).to(self.dtype)
+        pos_embed = self.get_pos_embed(self.h, self.w, x.device, self.dtype)
         x = self.x_embedder(x) + pos_embed  # (N, T, D), where T = H * W / patch_size ** 2
         t = self.t_embedder(timestep)  # (N, D)
-        csize = self.csize_embedder(c_size, bs)  # (N, D)
-        ar = self.ar_embedder(ar, bs)  # (N, D)
-        t = t + torch.cat([csize, ar], dim=1)
+        t = t + cached_condition(cond_cache, 'size', (data_info['img_hw'], data_info['aspect_ratio'], bs),
+                                 lambda: self.embed_size(data_info['img_hw'], data_info['aspect_ratio'], bs))
         t0 = self.t_block(t)
-        y = self.y_embedder(y, self.training)  # (N, D)
-        if mask is not None:
-            if mask.shape[0] != y.shape[0]:
-                mask = mask.repeat(y.shape[0] // mask.shape[0], 1)
-            mask = mask.squeeze(1).squeeze(1)
-            y = y.squeeze(1).masked_select(mask.unsqueeze(-1) != 0).view(1, -1, x.shape[-1])
-            y_lens = mask.sum(dim=1).tolist()
-        else:
-            y_lens = [y.shape[2]] * y.shape[0]
-            y = y.squeeze(1).view(1, -1, x.shape[-1])
-        for block in self.blocks:
-            x = auto_grad_checkpoint(block, x, y, t0, y_lens, **kwargs)  # (N, T, D) #support grad checkpoint
+        y, y_lens, blocks_kwargs = cached_condition(cond_cache, 'caption', (y, mask), lambda: self.embed_caption(y, mask, cond_cache is not None))
+        for block, block_kwargs, merge_kwargs in zip(self.blocks, blocks_kwargs, self.token_merging_kwargs(timestep)):
+            x = auto_grad_checkpoint(block, x, y, t0, y_lens, **kwargs, **block_kwargs, **merge_kwargs)  # (N, T, D) #support grad checkpoint
         x = self.final_layer(x, t)  # (N, T, patch_size ** 2 * out_channels)
         x = self.unpatchify(x)  # (N, out_channels, H, W)
         return x
 
-    def forward_with_dpmsolver(self, x, timestep, y, data_info, **kwargs):
+    def embed_size(self, c_size, ar, bs):
+        """Timestep-invariant micro-conditioning: image size and aspect ratio embeddings, (N, D)"""
+        csize = self.csize_embedder(c_size.to(self.dtype), bs)  # (N, D)
+        ar = self.ar_embedder(ar.to(self.dtype), bs)  # (N, D)
+        return torch.cat([csize, ar], dim=1)
+
+    def forward_with_dpmsolver(self, x, timestep, y, data_info, cond_cache=None, **kwargs):
         """
         dpm solver donnot need variance prediction
+        cond_cache: a dict per sampling call to compute the timestep-invariant conditioning once (see `with_cond_cache`)
         """
         # https://github.com/openai/glide-text2im/blob/main/notebooks/text2im.ipynb
-        model_out = self.forward(x, timestep, y, data_info=data_info, **kwargs)
+        model_out = self.forward(x, timestep, y, data_info=data_info, cond_cache=cond_cache, **kwargs)
         return model_out.chunk(2, dim=1)[0]
 
     def forward_with_cfg(self, x, timestep, y, cfg_scale, data_info, **kwargs):
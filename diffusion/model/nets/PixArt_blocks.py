@@ -9,11 +9,12 @@
 # MAE: https://github.com/facebookresearch/mae/blob/main/models_mae.py
 # --------------------------------------------------------
 import math
+import os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.models.vision_transformer import Mlp, Attention as Attention_
 from einops import rearrange, repeat
-import xformers.ops
 
 from diffusion.model.utils import add_decomposed_rel_pos
 
@@ -26,6 +27,129 @@ def t2i_modulate(x, shift, scale):
     return x * (1 + scale) + shift
 
 
+def t2i_norm_modulate(norm, x, shift, scale):
+    """
+    `t2i_modulate(norm(x), shift, scale)` without the intermediate (B, N, C) temporaries: outside autograd the
+    modulation runs in place on the fresh norm output, otherwise (or when the result needs a wider dtype than the
+    norm output, e.g. under autocast) as a single addcmul.
+    """
+    x = norm(x)
+    if torch.is_grad_enabled() or x.dtype != torch.promote_types(x.dtype, torch.result_type(shift, scale)):
+        return torch.addcmul(shift, x, 1 + scale)
+    return x.mul_(1 + scale).add_(shift)
+
+
+def gated_residual(x, h, gate=None):
+    """
+    `x + gate * h` (or `x + h`) for a fresh block output `h`: outside autograd `h` is overwritten with the result,
+    otherwise it is a single addcmul. `x` is never modified, and neither is `h` when the result is promoted to a
+    wider dtype (e.g. an fp32 residual stream with fp16 block outputs under autocast).
+    """
+    dtype = torch.result_type(x, h) if gate is None else torch.promote_types(torch.result_type(x, h), gate.dtype)
+    if torch.is_grad_enabled() or h.dtype != dtype:
+        return x + h if gate is None else torch.addcmul(x, gate, h)
+    return h.add_(x) if gate is None else h.mul_(gate).add_(x)
+
+
+#################################################################################
+#                               Attention Backends                              #
+#################################################################################
+# "xformers": memory_efficient_attention, imported on first use; "sdpa": torch.nn.functional.scaled_dot_product_attention;
+# "math": explicit softmax(q @ k^T) @ v; "auto": xformers for CUDA tensors if it is installed, else sdpa, else math.
+ATTENTION_BACKENDS = ('auto', 'xformers', 'sdpa', 'math')
+_attention_backend = os.environ.get('PIXART_ATTENTION_BACKEND', 'auto')
+_xformers_ops = None
+
+
+def set_attention_backend(name):
+    global _attention_backend
+    assert name in ATTENTION_BACKENDS, f'unknown attention backend {name}, expected one of {ATTENTION_BACKENDS}'
+    _attention_backend = name
+
+
+def get_attention_backend(device=None):
+    """The backend used for tensors on `device`, with "auto" resolved."""
+    if _attention_backend != 'auto':
+        return _attention_backend
+    if device is not None and torch.device(device).type == 'cuda' and import_xformers() is not None:
+        return 'xformers'
+    return 'sdpa' if hasattr(F, 'scaled_dot_product_attention') else 'math'
+
+
+def import_xformers():
+    """`xformers.ops`, or None if xformers is not installed."""
+    global _xformers_ops
+    if _xformers_ops is None:
+        try:
+            import xformers.ops
+            _xformers_ops = xformers.ops
+        except ImportError:
+            _xformers_ops = False
+    return _xformers_ops or None
+
+
+def _math_attention(q, k, v, p=0., attn_mask=None):
+    # q, k, v: (B, H, M, K); attn_mask: boolean, True for the keys to attend
+    attn = (q * q.shape[-1] ** -0.5) @ k.transpose(-2, -1)
+    if attn_mask is not None:
+        attn = attn.masked_fill(~attn_mask, float('-inf'))
+    attn = F.dropout(attn.softmax(dim=-1), p=p)
+    return attn @ v
+
+
+def _sdpa(q, k, v, p=0., attn_mask=None):
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=p)
+
+
+def self_attention(q, k, v, p=0., mask=None):
+    """
+    q, k, v: (B, N, H, K) in the xformers layout; mask: optional (B, 1, N, N), zero for the pairs to skip.
+    return: (B, N, H, K)
+    """
+    backend = get_attention_backend(q.device)
+    if backend == 'xformers':
+        attn_bias = None
+        if mask is not None:
+            B, N, H, _ = q.shape
+            attn_bias = torch.zeros([B * H, N, k.shape[1]], dtype=q.dtype, device=q.device)
+            attn_bias.masked_fill_(mask.squeeze(1).repeat(H, 1, 1) == 0, float('-inf'))
+        return import_xformers().memory_efficient_attention(q, k, v, p=p, attn_bias=attn_bias)
+    # sdpa/math take a boolean (B, 1, N, N) mask broadcast over the heads instead of a dense float bias per head
+    attn_mask = mask.view(mask.shape[0], 1, *mask.shape[-2:]) != 0 if mask is not None else None
+    fn = _sdpa if backend == 'sdpa' else _math_attention
+    return fn(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), p=p, attn_mask=attn_mask).transpose(1, 2)
+
+
+def varlen_cross_attention(q, k, v, kv_seqlens=None, p=0.):
+    """
+    Cross-attention of a batch of queries to packed, variable-length keys and values.
+    q: (B, N, H, K); k, v: (1, sum(kv_seqlens), H, K), the valid caption tokens of every sample back to back.
+    kv_seqlens: tokens per sample; None lets every query attend to all the keys.
+    return: (B, N, H, K)
+    """
+    B, N, H, K = q.shape
+    backend = get_attention_backend(q.device)
+    if backend == 'xformers':
+        xops = import_xformers()
+        attn_bias = xops.fmha.BlockDiagonalMask.from_seqlens([N] * B, kv_seqlens) if kv_seqlens is not None else None
+        return xops.memory_efficient_attention(q.reshape(1, B * N, H, K), k, v, p=p, attn_bias=attn_bias).view(B, N, H, K)
+
+    attn_mask = None
+    if kv_seqlens is None:
+        q = q.reshape(1, B * N, H, K)
+    elif len(set(kv_seqlens)) == 1:
+        k, v = k.view(B, -1, H, K), v.view(B, -1, H, K)
+    else:
+        # pad the packed tokens to the longest caption and mask the padding keys
+        k = nn.utils.rnn.pad_sequence(k[0].split(kv_seqlens), batch_first=True)
+        v = nn.utils.rnn.pad_sequence(v[0].split(kv_seqlens), batch_first=True)
+        lens = torch.tensor(kv_seqlens, device=q.device)
+        attn_mask = (torch.arange(k.shape[1], device=q.device) < lens[:, None])[:, None, None]   # (B, 1, 1, L)
+    fn = _sdpa if backend == 'sdpa' else _math_attention
+    x = fn(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), p=p, attn_mask=attn_mask).transpose(1, 2)
+    return x.reshape(B, N, H, K)
+
+
 class MultiHeadCrossAttention(nn.Module):
     def __init__(self, d_model, num_heads, attn_drop=0., proj_drop=0., **block_kwargs):
         super(MultiHeadCrossAttention, self).__init__()
@@ -41,18 +165,17 @@ class MultiHeadCrossAttention(nn.Module):
         self.proj = nn.Linear(d_model, d_model)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x, cond, mask=None):
-        # query: img tokens; key/value: condition; mask: if padding tokens
+    def forward(self, x, cond, mask=None, kv=None):
+        # query: img tokens; key/value: condition; mask: if padding tokens; kv: precomputed kv_linear(cond)
         B, N, C = x.shape
 
-        q = self.q_linear(x).view(1, -1, self.num_heads, self.head_dim)
-        kv = self.kv_linear(cond).view(1, -1, 2, self.num_heads, self.head_dim)
+        q = self.q_linear(x).view(B, N, self.num_heads, self.head_dim)
+        if kv is None:
+            kv = self.kv_linear(cond)
+        kv = kv.view(1, -1, 2, self.num_heads, self.head_dim)
         k, v = kv.unbind(2)
-        attn_bias = None
-        if mask is not None:
-            attn_bias = xformers.ops.fmha.BlockDiagonalMask.from_seqlens([N] * B, mask)
-        x = xformers.ops.memory_efficient_attention(q, k, v, p=self.attn_drop.p, attn_bias=attn_bias)
-        x = x.view(B, -1, C)
+        x = varlen_cross_attention(q, k, v, kv_seqlens=mask, p=self.attn_drop.p if self.training else 0.)
+        x = x.reshape(B, -1, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -113,13 +236,9 @@ class WindowAttention(Attention_):
         if use_fp32_attention := getattr(self, 'fp32_attention', False):
             q, k, v = q.float(), k.float(), v.float()
 
-        attn_bias = None
-        if mask is not None:
-            attn_bias = torch.zeros([B * self.num_heads, q.shape[1], k.shape[1]], dtype=q.dtype, device=q.device)
-            attn_bias.masked_fill_(mask.squeeze(1).repeat(self.num_heads, 1, 1) == 0, float('-inf'))
-        x = xformers.ops.memory_efficient_attention(q, k, v, p=self.attn_drop.p, attn_bias=attn_bias)
+        x = self_attention(q, k, v, p=self.attn_drop.p if self.training else 0., mask=mask)
 
-        x = x.view(B, N, C)
+        x = x.reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
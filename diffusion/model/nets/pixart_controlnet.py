@@ -8,7 +8,6 @@ from torch.nn import Module, Linear, init
 from typing import Any, Mapping
 
 from diffusion.model.nets import PixArtMSBlock, PixArtMS, PixArt
-from diffusion.model.nets.PixArt import get_2d_sincos_pos_embed
 from diffusion.model.utils import auto_grad_checkpoint
 
 
@@ -23,7 +22,6 @@ class ControlT2IDitBlockHalf(Module):
         for p in self.copied_block.parameters():
             p.requires_grad_(True)
 
-        self.copied_block.load_state_dict(base_block.state_dict())
         self.copied_block.train()
         
         self.hidden_size = hidden_size = base_block.hidden_size
@@ -77,7 +75,7 @@ class ControlPixArtHalf(Module):
 
     def forward_c(self, c):
         self.h, self.w = c.shape[-2]//self.patch_size, c.shape[-1]//self.patch_size
-        pos_embed = torch.from_numpy(get_2d_sincos_pos_embed(self.pos_embed.shape[-1], (self.h, self.w), lewei_scale=self.lewei_scale, base_size=self.base_size)).unsqueeze(0).to(c.device).to(self.dtype)
+        pos_embed = self.get_pos_embed(self.h, self.w, c.device, self.dtype)
         return self.x_embedder(c) + pos_embed if c is not None else c
 
     # def forward(self, x, t, c, **kwargs):
@@ -142,9 +140,9 @@ class ControlPixArtHalf(Module):
     def forward_with_cfg(self, x, t, y, cfg_scale, data_info, c, **kwargs):
         return self.base_model.forward_with_cfg(x, t, y, cfg_scale, data_info, c=self.forward_c(c), **kwargs)
 
-    def load_state_dict(self, state_dict: Mapping[str, Any], strict: bool = True):
+    def load_state_dict(self, state_dict: Mapping[str, Any], strict: bool = True, **kwargs):
         if all((k.startswith('base_model') or k.startswith('controlnet')) for k in state_dict.keys()):
-            return super().load_state_dict(state_dict, strict)
+            return super().load_state_dict(state_dict, strict, **kwargs)
         else:
             new_key = {}
             for k in state_dict.keys():
@@ -154,7 +152,13 @@ class ControlPixArtHalf(Module):
                     print(f"replace {k} to {v}")
                     state_dict[v] = state_dict.pop(k)
 
-            return self.base_model.load_state_dict(state_dict, strict)
+            result = self.base_model.load_state_dict(state_dict, strict, **kwargs)
+            # a base model checkpoint: the ControlNet blocks start as copies of the loaded base blocks (with a model
+            # built on the meta device they were copied before any weights existed)
+            for block in self.controlnet:
+                base_state = self.base_model.blocks[block.block_index].state_dict()
+                block.copied_block.load_state_dict({k: v.clone() for k, v in base_state.items()}, **kwargs)
+            return result
     
     def unpatchify(self, x):
         """
@@ -200,7 +204,7 @@ class ControlPixArtMSHalf(ControlPixArtHalf):
         c_size, ar = data_info['img_hw'].to(self.dtype), data_info['aspect_ratio'].to(self.dtype)
         self.h, self.w = x.shape[-2]//self.patch_size, x.shape[-1]//self.patch_size
 
-        pos_embed = torch.from_numpy(get_2d_sincos_pos_embed(self.pos_embed.shape[-1], (self.h, self.w), lewei_scale=self.lewei_scale, base_size=self.base_size)).unsqueeze(0).to(x.device).to(self.dtype)
+        pos_embed = self.get_pos_embed(self.h, self.w, x.device, self.dtype)
         x = self.x_embedder(x) + pos_embed  # (N, T, D), where T = H * W / patch_size ** 2
         t = self.t_embedder(timestep)  # (N, D)
         csize = self.csize_embedder(c_size, bs)  # (N, D)
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import torch
+
+
+class PromptEmbeddingCache:
+    """LRU cache of text-encoder outputs, keyed by (model id, max length, cleaned prompt).
+
+    Every entry keeps only the valid tokens of one prompt (L x C) on the CPU; the in-memory tier is bounded by
+    `max_bytes`. With `disk_dir`, entries are also written as .npy files and memory-mapped back after a memory miss,
+    so they survive restarts and are shared by every process on the node.
+
+    Outputs have the layout of `T5Embedder.get_text_embeddings`: (B, max_length, C) embeddings and a (B, max_length)
+    mask. Positions past each prompt's length are zero and masked out.
+
+    Args:
+        encode_fn (callable): `texts -> (embeddings, attention_mask)`, e.g. `T5Embedder.get_text_embeddings`. It receives
+            the prompts after `preprocess`.
+        model_id (str): Identity of the text encoder, part of the key.
+        max_length (int): Token length of the outputs, part of the key.
+        device: Device of the returned tensors.
+        dtype: Dtype of the returned embeddings.
+        preprocess (callable, optional): Text cleaning used for the key, e.g. `T5Embedder.text_preprocessing`.
+        max_bytes (int): Memory budget of the in-memory tier.
+        disk_dir (str, optional): Directory of the on-disk tier.
+    """
+
+    def __init__(self, encode_fn, model_id, max_length, device, dtype, preprocess=None, max_bytes=1 << 30, disk_dir=None):
+        self.encode_fn = encode_fn
+        self.model_id = model_id
+        self.max_length = max_length
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.preprocess = preprocess
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    @classmethod
+    def for_t5(cls, t5, **kwargs):
+        # prompts are cleaned once for the key and encoded as they are
+        return cls(partial(t5.get_text_embeddings, preprocessed=True), t5.dir_or_name or 't5', t5.model_max_length, t5.device,
+                   t5.torch_dtype, preprocess=t5.text_preprocessing, **kwargs)
+
+    @classmethod
+    def for_pipeline(cls, pipe, model_id, device, clean_caption=True, max_length=120, **kwargs):
+        """Cache in front of a diffusers `PixArtAlphaPipeline.encode_prompt`; feed the outputs back as `prompt_embeds`.
+        The pipeline cleans captions itself, so the key is the raw prompt plus the `clean_caption` flag."""
+        def encode_fn(texts):
+            prompt_embeds, prompt_attention_mask, _, _ = pipe.encode_prompt(
+                texts, do_classifier_free_guidance=False, device=device, clean_caption=clean_caption)
+            return prompt_embeds, prompt_attention_mask
+        return cls(encode_fn, f'{model_id}:clean_caption={clean_caption}', max_length, device, pipe.text_encoder.dtype, **kwargs)
+
+    def key(self, text):
+        return self._key(self.preprocess(text) if self.preprocess is not None else text)
+
+    def _key(self, text):
+        return hashlib.sha1(f'{self.model_id}\0{self.max_length}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.npy')
+
+    def _insert(self, key, emb):
+        self._entries[key] = emb
+        self._bytes += emb.numel() * emb.element_size()
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.numel() * evicted.element_size()
+
+    def _lookup(self, key):
+        emb = self._entries.get(key)
+        if emb is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return emb
+        if self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+            emb = torch.from_numpy(np.load(self._disk_path(key), mmap_mode='r').astype(np.float32)).to(self.dtype)
+            self._insert(key, emb)
+            self.disk_hits += 1
+            return emb
+        return None
+
+    def _store(self, key, emb):
+        self._insert(key, emb)
+        if self.disk_dir is not None:
+            # float32 holds bf16/fp16 outputs exactly; written to a temp file and renamed so readers never see partial files
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.tmp{os.getpid()}_{threading.get_ident()}'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, emb.float().numpy())
+            os.replace(tmp_path, path)
+
+    def __call__(self, texts):
+        return self.get_text_embeddings(texts)
+
+    def get_text_embeddings(self, texts):
+        assert len(texts), 'expected at least one prompt'
+        with self._lock:
+            texts = [self.preprocess(text) for text in texts] if self.preprocess is not None else texts
+            keys = [self._key(text) for text in texts]
+            found, missing = {}, {}
+            for key, text in zip(keys, texts):
+                if key in found or key in missing:
+                    continue
+                emb = self._lookup(key)
+                if emb is None:
+                    missing[key] = text
+                else:
+                    found[key] = emb
+            if missing:
+                self.misses += len(missing)
+                caption_embs, emb_masks = self.encode_fn(list(missing.values()))
+                lengths = emb_masks.sum(dim=-1).tolist()
+                caption_embs = caption_embs.to('cpu', self.dtype)
+                for i, key in enumerate(missing):
+                    found[key] = caption_embs[i, :int(lengths[i])].clone()
+                    self._store(key, found[key])
+
+        caption_embs = torch.zeros(len(texts), self.max_length, found[keys[0]].shape[-1], dtype=self.dtype)
+        emb_masks = torch.zeros(len(texts), self.max_length, dtype=torch.long)
+        for i, key in enumerate(keys):
+            emb = found[key]
+            caption_embs[i, :emb.shape[0]] = emb
+            emb_masks[i, :emb.shape[0]] = 1
+        return caption_embs.to(self.device), emb_masks.to(self.device)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses,
+                    hit_rate=(self.hits + self.disk_hits) / max(lookups, 1), entries=len(self._entries), bytes=self._bytes)
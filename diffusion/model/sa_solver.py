@@ -173,6 +173,7 @@ def model_wrapper(
         guidance_scale=1.,
         classifier_fn=None,
         classifier_kwargs={},
+        guidance_interval=None,
 ):
     """Thanks to DPM-Solver for their code base"""
     """Create a wrapper function for the noise prediction model.
@@ -244,8 +245,13 @@ def model_wrapper(
         guidance_scale: A `float`. The scale for the guided sampling.
         classifier_fn: A classifier function. Only used for the classifier guidance.
         classifier_kwargs: A `dict`. A dict for the other inputs of the classifier function.
+        guidance_interval: A tuple `(t_min, t_max)` of continuous times (t = T is pure noise). Only used for
+                    "classifier-free" guidance type: guidance is applied for t in [t_min, t_max] only, outside of it
+                    just the conditional branch is evaluated. None applies guidance at every step.
     Returns:
         A noise prediction model that accepts the noised data and the continuous time as the inputs.
+        Its `guidance_stats` dict counts the per-sample network evaluations run (`evals`) and the unconditional
+        ones skipped by `guidance_interval` (`skipped`).
     """
 
     def get_model_input_time(t_continuous):
@@ -301,15 +307,26 @@ def model_wrapper(
             return noise - guidance_scale * sigma_t * cond_grad
         elif guidance_type == "classifier-free":
             if guidance_scale == 1. or unconditional_condition is None:
+                guidance_stats['evals'] += x.shape[0]
                 return noise_pred_fn(x, t_continuous, cond=condition)
+            if guidance_interval is not None and not guidance_interval[0] <= t_continuous.reshape(-1)[0].item() <= guidance_interval[1]:
+                guidance_stats['evals'] += x.shape[0]
+                guidance_stats['skipped'] += x.shape[0]
+                return noise_pred_fn(x, t_continuous, cond=condition)
+            guidance_stats['evals'] += 2 * x.shape[0]
             x_in = torch.cat([x] * 2)
             t_in = torch.cat([t_continuous] * 2)
-            c_in = torch.cat([unconditional_condition, condition])
-            noise_uncond, noise = noise_pred_fn(x_in, t_in, cond=c_in).chunk(2)
+            noise_uncond, noise = noise_pred_fn(x_in, t_in, cond=cfg_condition).chunk(2)
             return noise_uncond + guidance_scale * (noise - noise_uncond)
 
     assert model_type in ["noise", "x_start", "v", "score"]
     assert guidance_type in ["uncond", "classifier", "classifier-free"]
+    # the same condition tensor at every step, so per-call conditioning caches of the model hit without a comparison
+    cfg_condition = None
+    if guidance_type == "classifier-free" and unconditional_condition is not None:
+        cfg_condition = torch.cat([unconditional_condition, condition])
+    guidance_stats = {'evals': 0, 'skipped': 0}
+    model_fn.guidance_stats = guidance_stats
     return model_fn
 
 
@@ -741,8 +758,8 @@ class SASolver:
         return x_t
 
     def sample_few_steps(self, x, tau, steps=5, t_start=None, t_end=None, skip_type='time', skip_order=1,
-                         predictor_order=3, corrector_order=4, pc_mode='PEC', return_intermediate=False
-                         ):
+                         predictor_order=3, corrector_order=4, pc_mode='PEC', return_intermediate=False,
+                         randn_like=torch.randn_like):
         """
         For the PC-mode, please refer to the wiki page
         https://en.wikipedia.org/wiki/Predictor%E2%80%93corrector_method#PEC_mode_and_PECE_mode
@@ -770,7 +787,7 @@ class SASolver:
             # Init the initial values.
             step = 0
             t = timesteps[step]
-            noise = torch.randn_like(x)
+            noise = randn_like(x)
             t_prev_list = [t]
             # do not evaluate if skip_first_step
             if skip_first_step:
@@ -794,7 +811,7 @@ class SASolver:
                 t = timesteps[step]
                 predictor_order_used = min(predictor_order, step)
                 corrector_order_used = min(corrector_order, step + 1)
-                noise = torch.randn_like(x)
+                noise = randn_like(x)
                 # predictor step
                 x_p = self.adams_bashforth_update_few_steps(order=predictor_order_used, x=x, tau=tau(t),
                                                             model_prev_list=model_prev_list, t_prev_list=t_prev_list,
@@ -834,7 +851,7 @@ class SASolver:
                     predictor_order_used = predictor_order
                     corrector_order_used = corrector_order
                 t = timesteps[step]
-                noise = torch.randn_like(x)
+                noise = randn_like(x)
 
                 # predictor step
                 if skip_final_step and step == steps and not denoise_to_zero:
@@ -889,8 +906,8 @@ class SASolver:
         return (x, intermediates) if return_intermediate else x
 
     def sample_more_steps(self, x, tau, steps=20, t_start=None, t_end=None, skip_type='time', skip_order=1,
-                          predictor_order=3, corrector_order=4, pc_mode='PEC', return_intermediate=False
-                          ):
+                          predictor_order=3, corrector_order=4, pc_mode='PEC', return_intermediate=False,
+                          randn_like=torch.randn_like):
         """
         For the PC-mode, please refer to the wiki page
         https://en.wikipedia.org/wiki/Predictor%E2%80%93corrector_method#PEC_mode_and_PECE_mode
@@ -918,7 +935,7 @@ class SASolver:
             # Init the initial values.
             step = 0
             t = timesteps[step]
-            noise = torch.randn_like(x)
+            noise = randn_like(x)
             t_prev_list = [t]
             # do not evaluate if skip_first_step
             if skip_first_step:
@@ -942,7 +959,7 @@ class SASolver:
                 t = timesteps[step]
                 predictor_order_used = min(predictor_order, step)
                 corrector_order_used = min(corrector_order, step + 1)
-                noise = torch.randn_like(x)
+                noise = randn_like(x)
                 # predictor step
                 x_p = self.adams_bashforth_update(order=predictor_order_used, x=x, tau=tau(t),
                                                   model_prev_list=model_prev_list, t_prev_list=t_prev_list, noise=noise,
@@ -981,7 +998,7 @@ class SASolver:
                     predictor_order_used = predictor_order
                     corrector_order_used = corrector_order
                 t = timesteps[step]
-                noise = torch.randn_like(x)
+                noise = randn_like(x)
 
                 # predictor step
                 if skip_final_step and step == steps and not denoise_to_zero:
@@ -1042,7 +1059,7 @@ class SASolver:
             return x
 
     def sample(self, mode, x, tau, steps, t_start=None, t_end=None, skip_type='time', skip_order=1, predictor_order=3,
-               corrector_order=4, pc_mode='PEC', return_intermediate=False
+               corrector_order=4, pc_mode='PEC', return_intermediate=False, randn_like=torch.randn_like
                ):
         """
         For the PC-mode, please refer to the wiki page 
@@ -1056,18 +1073,21 @@ class SASolver:
         For most of the experiments and tasks, we find these two operations do not have much help to sample quality.
         2) 'few_steps' use a rescaling trick as in Appendix D in SA-Solver paper https://arxiv.org/pdf/2309.05019.pdf
         We find it will slightly improve the sample quality especially in few steps.
+
+        `randn_like` draws the stochastic noise of every step, e.g. `StackedRandomGenerator.randn_like` so that a
+        sample does not depend on its batch.
         """
         assert mode in ['few_steps', 'more_steps'], "mode must be either 'few_steps' or 'more_steps'"
         if mode == 'few_steps':
             return self.sample_few_steps(x=x, tau=tau, steps=steps, t_start=t_start, t_end=t_end, skip_type=skip_type,
                                          skip_order=skip_order, predictor_order=predictor_order,
                                          corrector_order=corrector_order, pc_mode=pc_mode,
-                                         return_intermediate=return_intermediate)
+                                         return_intermediate=return_intermediate, randn_like=randn_like)
         else:
             return self.sample_more_steps(x=x, tau=tau, steps=steps, t_start=t_start, t_end=t_end, skip_type=skip_type,
                                           skip_order=skip_order, predictor_order=predictor_order,
                                           corrector_order=corrector_order, pc_mode=pc_mode,
-                                          return_intermediate=return_intermediate)
+                                          return_intermediate=return_intermediate, randn_like=randn_like)
 
 
 #############################################################
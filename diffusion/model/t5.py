@@ -2,6 +2,7 @@
 import os
 import re
 import html
+import multiprocessing
 import urllib.parse as ul
 
 import ftfy
@@ -10,14 +11,129 @@ from bs4 import BeautifulSoup
 from transformers import T5EncoderModel, AutoTokenizer
 from huggingface_hub import hf_hub_download
 
+# Caption cleaning, applied in this exact order. The patterns are compiled once at import instead of going through the
+# `re` cache on every call; together with the fast paths in `clean_caption` the output is unchanged.
+bad_punct_regex = re.compile(r'['+'#®•©™&@·º½¾¿¡§~'+'\)'+'\('+'\]'+'\['+'\}'+'\{'+'\|'+'\\'+'\/'+'\*' + r']{1,}')  # noqa
+url_regexes = (
+    re.compile(r'\b((?:https?:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))'),  # noqa
+    re.compile(r'\b((?:www:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))'),  # noqa
+)
+nickname_regex = re.compile(r'@[\w\d]+\b')
+# 31C0—31EF CJK Strokes, 31F0—31FF Katakana Phonetic Extensions, 3200—32FF Enclosed CJK Letters and Months,
+# 3300—33FF CJK Compatibility, 3400—4DBF CJK Unified Ideographs Extension A, 4DC0—4DFF Yijing Hexagram Symbols,
+# 4E00—9FFF CJK Unified Ideographs: contiguous, so deleting them one block after another is one deletion of 31C0—9FFF
+cjk_regex = re.compile(r'[\u31c0-\u9fff]+')
+# все виды тире / all types of dash --> "-"
+dash_regex = re.compile(
+    r'[\u002D\u058A\u05BE\u1400\u1806\u2010-\u2015\u2E17\u2E1A\u2E3A\u2E3B\u2E40\u301C\u3030\u30A0\uFE31\uFE32\uFE58\uFE63\uFF0D]+')  # noqa
+# кавычки к одному стандарту
+quotes_table = str.maketrans({**{c: '"' for c in '`´«»“”¨'}, **{c: "'" for c in '‘’'}})
+pre_clean_subs = tuple((re.compile(pattern), repl) for pattern, repl in (
+    (r'&quot;?', ''),  # &quot;
+    (r'&amp', ''),  # &amp
+    (r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', ' '),  # ip adresses
+    (r'\d:\d\d\s+$', ''),  # article ids
+    (r'\\n', ' '),  # \n
+    (r'#\d{1,3}\b', ''),  # "#123"
+    (r'#\d{5,}\b', ''),  # "#12345.."
+    (r'\b\d{6,}\b', ''),  # "123456.."
+    (r'[\S]+\.(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)', ''),  # filenames
+    (r'[\"\']{2,}', r'"'),  # """AUSVERKAUFT"""
+    (r'[\.]{2,}', r' '),  # """AUSVERKAUFT"""
+    (bad_punct_regex.pattern, r' '),  # ***AUSVERKAUFT***, #AUSVERKAUFT
+    (r'\s+\.\s+', r' '),  # " . "
+))
+post_clean_subs = tuple((re.compile(pattern), repl) for pattern, repl in (
+    (r'\b[a-zA-Z]{1,3}\d{3,15}\b', ''),  # jc6640
+    (r'\b[a-zA-Z]+\d+[a-zA-Z]+\b', ''),  # jc6640vc
+    (r'\b\d+[a-zA-Z]+\d+\b', ''),  # 6640vc231
+    (r'(worldwide\s+)?(free\s+)?shipping', ''),
+    (r'(free\s)?download(\sfree)?', ''),
+    (r'\bclick\b\s(?:for|on)\s\w+', ''),
+    (r'\b(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)(\simage[s]?)?', ''),
+    (r'\bpage\s+\d+\b', ''),
+    (r'\b\d*[a-zA-Z]+\d+[a-zA-Z]+\d+[a-zA-Z\d]*\b', r' '),  # j2d1a2a...
+    (r'\b\d+\.?\d*[xх×]\d+\.?\d*\b', ''),
+    (r'\b\s+\:\s+', r': '),
+    (r'(\D[,\./])\b', r'\1 '),
+    (r'\s+', ' '),
+    (r'^[\"\']([\w\W]+)[\"\']$', r'\1'),
+    (r'^[\'\_,\-\:;]', r''),
+    (r'[\'\_,\-\:\-\+]$', r''),
+    (r'^\.\S+$', ''),
+))
+# text that neither ftfy nor html.unescape change: printable ascii, tabs and newlines, no entities
+ftfy_noop_regex = re.compile(r'[\t\n\x20-\x25\x27-\x7e]*')
+
+
+def basic_clean(text):
+    if ftfy_noop_regex.fullmatch(text) is None:
+        text = ftfy.fix_text(text)
+        text = html.unescape(html.unescape(text))
+    return text.strip()
+
+
+def clean_caption(caption):
+    """One cleaning pass, as applied (twice) to the training captions."""
+    caption = str(caption)
+    caption = ul.unquote_plus(caption)
+    caption = caption.strip().lower()
+    caption = caption.replace('<person>', 'person')
+    # urls:
+    for regex in url_regexes:
+        caption = regex.sub('', caption)
+    # html: without tags or entities the parser returns the text unchanged
+    if '<' in caption or '&' in caption:
+        caption = BeautifulSoup(caption, features='html.parser').text
+
+    # @<nickname>
+    caption = nickname_regex.sub('', caption)
+    caption = cjk_regex.sub('', caption)
+    caption = dash_regex.sub('-', caption)
+    caption = caption.translate(quotes_table)
+    for regex, repl in pre_clean_subs:
+        caption = regex.sub(repl, caption)
+
+    # this-is-my-cute-cat / this_is_my_cute_cat
+    if caption.count('-') + caption.count('_') > 3:
+        caption = caption.replace('-', ' ').replace('_', ' ')
+
+    caption = basic_clean(caption)
+    for regex, repl in post_clean_subs:
+        caption = regex.sub(repl, caption)
+    return caption.strip()
+
+
+def preprocess_caption(caption):
+    # The exact text cleaning as was in the training stage. A pass can expose new matches (e.g. a url glued to a
+    # nickname), so the two passes are kept; the second one mostly takes the fast paths above.
+    return clean_caption(clean_caption(caption))
+
+
+def clean_captions(captions, num_workers=None, pool=None, chunksize=256):
+    """`preprocess_caption` over many captions, in input order, on a process pool (`num_workers=0`: in this process).
+    Pass a running `multiprocessing.Pool` as `pool` to reuse it across calls."""
+    if pool is not None:
+        return pool.map(preprocess_caption, captions, chunksize=chunksize)
+    if num_workers == 0 or len(captions) <= chunksize:
+        return [preprocess_caption(caption) for caption in captions]
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.map(preprocess_caption, captions, chunksize=chunksize)
+
+
+# random-weight T5 for `T5Embedder.from_config`: runs the text pipelines without the T5-XXL checkpoint, e.g. on CPU
+TINY_T5_CONFIG = dict(vocab_size=32128, d_model=64, d_kv=16, d_ff=128, num_layers=2, num_heads=4, feed_forward_proj='gated-gelu')
+
+
 class T5Embedder:
 
     available_models = ['t5-v1_1-xxl']
-    bad_punct_regex = re.compile(r'['+'#®•©™&@·º½¾¿¡§~'+'\)'+'\('+'\]'+'\['+'\}'+'\{'+'\|'+'\\'+'\/'+'\*' + r']{1,}')  # noqa
+    bad_punct_regex = bad_punct_regex
 
     def __init__(self, device, dir_or_name='t5-v1_1-xxl', *, local_cache=False, cache_dir=None, hf_token=None, use_text_preprocessing=True,
-                 t5_model_kwargs=None, torch_dtype=None, use_offload_folder=None, model_max_length=120):
+                 t5_model_kwargs=None, torch_dtype=None, use_offload_folder=None, model_max_length=120, pad_to_multiple_of=None):
         self.device = torch.device(device)
+        self.pad_to_multiple_of = pad_to_multiple_of
         self.torch_dtype = torch_dtype or torch.bfloat16
         if t5_model_kwargs is None:
             t5_model_kwargs = {'low_cpu_mem_usage': True, 'torch_dtype': self.torch_dtype}
@@ -87,8 +203,39 @@ class T5Embedder:
         self.model = T5EncoderModel.from_pretrained(path, **t5_model_kwargs).eval()
         self.model_max_length = model_max_length
 
-    def get_text_embeddings(self, texts):
-        texts = [self.text_preprocessing(text) for text in texts]
+    @classmethod
+    def from_config(cls, config, tokenizer_path, device='cpu', *, use_text_preprocessing=True, torch_dtype=None, model_max_length=120):
+        """Randomly initialized encoder built from a `T5Config`, e.g. a tiny one to run feature pipelines without the T5-XXL weights."""
+        self = cls.__new__(cls)
+        self.device = torch.device(device)
+        self.pad_to_multiple_of = None
+        self.torch_dtype = torch_dtype or torch.float32
+        self.use_text_preprocessing = use_text_preprocessing
+        self.hf_token = None
+        self.cache_dir = None
+        self.dir_or_name = None
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        self.model = T5EncoderModel(config).to(self.device, self.torch_dtype).eval()
+        self.model_max_length = model_max_length
+        return self
+
+    def get_text_embeddings(self, texts, pad_to_multiple_of=None, batch_size=None, preprocessed=False):
+        """
+        Args:
+            texts (list[str]): Prompts.
+            pad_to_multiple_of (int, optional): Encode only up to the longest prompt, rounded up to this multiple (8 or 16),
+                instead of running the encoder over `model_max_length` tokens. Defaults to the value given at construction;
+                None keeps the full `max_length` padding. The returned tensors are still `model_max_length` long, with
+                zero embeddings and a zero mask past every prompt's length.
+            batch_size (int, optional): With dynamic padding, sort the prompts by token length and encode them in groups of
+                this size, so a few long prompts do not set the padded length of all the others.
+            preprocessed (bool): The prompts already went through `text_preprocessing`; encode them as they are.
+        """
+        if not preprocessed:
+            texts = [self.text_preprocessing(text) for text in texts]
+        pad_to_multiple_of = pad_to_multiple_of or self.pad_to_multiple_of
+        if pad_to_multiple_of:
+            return self.get_text_embeddings_dynamic(texts, pad_to_multiple_of, batch_size)
 
         text_tokens_and_mask = self.tokenizer(
             texts,
@@ -110,124 +257,39 @@ class T5Embedder:
             )['last_hidden_state'].detach()
         return text_encoder_embs, text_tokens_and_mask['attention_mask'].to(self.device)
 
+    def get_text_embeddings_dynamic(self, texts, pad_to_multiple_of, batch_size=None):
+        # T5 uses relative position biases, so the embeddings of valid tokens do not depend on how much padding follows
+        input_ids = self.tokenizer(texts, max_length=self.model_max_length, truncation=True, add_special_tokens=True)['input_ids']
+        order = sorted(range(len(texts)), key=lambda i: len(input_ids[i])) if batch_size else list(range(len(texts)))
+        batch_size = batch_size or len(texts)
+        text_encoder_embs = None
+        attention_mask = torch.zeros(len(texts), self.model_max_length, dtype=torch.long)
+        for start in range(0, len(order), batch_size):
+            group = order[start:start + batch_size]
+            length = max(len(input_ids[i]) for i in group)
+            length = min(-(-length // pad_to_multiple_of) * pad_to_multiple_of, self.model_max_length)
+            tokens = self.tokenizer.pad({'input_ids': [input_ids[i] for i in group]}, padding='max_length', max_length=length,
+                                        return_attention_mask=True, return_tensors='pt')
+            tokens_mask = tokens['attention_mask'].to(self.device)
+            with torch.no_grad():
+                embs = self.model(input_ids=tokens['input_ids'].to(self.device), attention_mask=tokens_mask)['last_hidden_state'].detach()
+            if text_encoder_embs is None:
+                text_encoder_embs = embs.new_zeros(len(texts), self.model_max_length, embs.shape[-1])
+            group = torch.tensor(group, device=self.device)
+            text_encoder_embs[group, :length] = embs * tokens_mask[..., None].to(embs.dtype)
+            attention_mask[group.cpu(), :length] = tokens['attention_mask']
+        return text_encoder_embs, attention_mask.to(self.device)
+
     def text_preprocessing(self, text):
         if self.use_text_preprocessing:
             # The exact text cleaning as was in the training stage:
-            text = self.clean_caption(text)
-            text = self.clean_caption(text)
-            return text
+            return preprocess_caption(text)
         else:
             return text.lower().strip()
 
     @staticmethod
     def basic_clean(text):
-        text = ftfy.fix_text(text)
-        text = html.unescape(html.unescape(text))
-        return text.strip()
+        return basic_clean(text)
 
     def clean_caption(self, caption):
-        caption = str(caption)
-        caption = ul.unquote_plus(caption)
-        caption = caption.strip().lower()
-        caption = re.sub('<person>', 'person', caption)
-        # urls:
-        caption = re.sub(
-            r'\b((?:https?:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))',  # noqa
-            '', caption)  # regex for urls
-        caption = re.sub(
-            r'\b((?:www:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))',  # noqa
-            '', caption)  # regex for urls
-        # html:
-        caption = BeautifulSoup(caption, features='html.parser').text
-
-        # @<nickname>
-        caption = re.sub(r'@[\w\d]+\b', '', caption)
-
-        # 31C0—31EF CJK Strokes
-        # 31F0—31FF Katakana Phonetic Extensions
-        # 3200—32FF Enclosed CJK Letters and Months
-        # 3300—33FF CJK Compatibility
-        # 3400—4DBF CJK Unified Ideographs Extension A
-        # 4DC0—4DFF Yijing Hexagram Symbols
-        # 4E00—9FFF CJK Unified Ideographs
-        caption = re.sub(r'[\u31c0-\u31ef]+', '', caption)
-        caption = re.sub(r'[\u31f0-\u31ff]+', '', caption)
-        caption = re.sub(r'[\u3200-\u32ff]+', '', caption)
-        caption = re.sub(r'[\u3300-\u33ff]+', '', caption)
-        caption = re.sub(r'[\u3400-\u4dbf]+', '', caption)
-        caption = re.sub(r'[\u4dc0-\u4dff]+', '', caption)
-        caption = re.sub(r'[\u4e00-\u9fff]+', '', caption)
-        #######################################################
-
-        # все виды тире / all types of dash --> "-"
-        caption = re.sub(
-            r'[\u002D\u058A\u05BE\u1400\u1806\u2010-\u2015\u2E17\u2E1A\u2E3A\u2E3B\u2E40\u301C\u3030\u30A0\uFE31\uFE32\uFE58\uFE63\uFF0D]+',  # noqa
-            '-', caption)
-
-        # кавычки к одному стандарту
-        caption = re.sub(r'[`´«»“”¨]', '"', caption)
-        caption = re.sub(r'[‘’]', "'", caption)
-
-        # &quot;
-        caption = re.sub(r'&quot;?', '', caption)
-        # &amp
-        caption = re.sub(r'&amp', '', caption)
-
-        # ip adresses:
-        caption = re.sub(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', ' ', caption)
-
-        # article ids:
-        caption = re.sub(r'\d:\d\d\s+$', '', caption)
-
-        # \n
-        caption = re.sub(r'\\n', ' ', caption)
-
-        # "#123"
-        caption = re.sub(r'#\d{1,3}\b', '', caption)
-        # "#12345.."
-        caption = re.sub(r'#\d{5,}\b', '', caption)
-        # "123456.."
-        caption = re.sub(r'\b\d{6,}\b', '', caption)
-        # filenames:
-        caption = re.sub(r'[\S]+\.(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)', '', caption)
-
-        #
-        caption = re.sub(r'[\"\']{2,}', r'"', caption)  # """AUSVERKAUFT"""
-        caption = re.sub(r'[\.]{2,}', r' ', caption)  # """AUSVERKAUFT"""
-
-        caption = re.sub(self.bad_punct_regex, r' ', caption)  # ***AUSVERKAUFT***, #AUSVERKAUFT
-        caption = re.sub(r'\s+\.\s+', r' ', caption)  # " . "
-
-        # this-is-my-cute-cat / this_is_my_cute_cat
-        regex2 = re.compile(r'(?:\-|\_)')
-        if len(re.findall(regex2, caption)) > 3:
-            caption = re.sub(regex2, ' ', caption)
-
-        caption = self.basic_clean(caption)
-
-        caption = re.sub(r'\b[a-zA-Z]{1,3}\d{3,15}\b', '', caption)  # jc6640
-        caption = re.sub(r'\b[a-zA-Z]+\d+[a-zA-Z]+\b', '', caption)  # jc6640vc
-        caption = re.sub(r'\b\d+[a-zA-Z]+\d+\b', '', caption)  # 6640vc231
-
-        caption = re.sub(r'(worldwide\s+)?(free\s+)?shipping', '', caption)
-        caption = re.sub(r'(free\s)?download(\sfree)?', '', caption)
-        caption = re.sub(r'\bclick\b\s(?:for|on)\s\w+', '', caption)
-        caption = re.sub(r'\b(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)(\simage[s]?)?', '', caption)
-        caption = re.sub(r'\bpage\s+\d+\b', '', caption)
-
-        caption = re.sub(r'\b\d*[a-zA-Z]+\d+[a-zA-Z]+\d+[a-zA-Z\d]*\b', r' ', caption)  # j2d1a2a...
-
-        caption = re.sub(r'\b\d+\.?\d*[xх×]\d+\.?\d*\b', '', caption)
-
-        caption = re.sub(r'\b\s+\:\s+', r': ', caption)
-        caption = re.sub(r'(\D[,\./])\b', r'\1 ', caption)
-        caption = re.sub(r'\s+', ' ', caption)
-
-        caption.strip()
-
-        caption = re.sub(r'^[\"\']([\w\W]+)[\"\']$', r'\1', caption)
-        caption = re.sub(r'^[\'\_,\-\:;]', r'', caption)
-        caption = re.sub(r'[\'\_,\-\:\-\+]$', r'', caption)
-        caption = re.sub(r'^\.\S+$', '', caption)
-
-        return caption.strip()
+        return clean_caption(caption)
@@ -0,0 +1,93 @@
+# --------------------------------------------------------
+# Token merging (ToMe) for the PixArt blocks at inference.
+# References:
+# ToMe: https://github.com/facebookresearch/ToMe
+# ToMe for SD: https://github.com/dbolya/tomesd
+# --------------------------------------------------------
+import torch
+
+
+def do_nothing(x):
+    return x
+
+
+def in_range(value, bounds):
+    """`bounds` is a half-open (start, end) range; None matches everything."""
+    return bounds is None or bounds[0] <= value < bounds[1]
+
+
+def bipartite_soft_matching_random2d(metric, h, w, r, sx=2, sy=2, seed=0):
+    """
+    Partitions the tokens of an h x w grid into destinations (one random token of every sy x sx cell) and sources,
+    and merges the `r` sources most similar to a destination into it.
+    metric: (B, N, C) tokens used for the similarity; seed: seeds the choice of the destination tokens
+    return: `merge` (B, N, C) -> (B, N - r, C) and `unmerge`, which copies every merged token back to its sources
+    """
+    B, N, _ = metric.shape
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+        # drawn on the CPU from a fixed seed, so the partition does not depend on the batch or the global RNG
+        generator = torch.Generator().manual_seed(seed)
+        rand_idx = torch.randint(sy * sx, size=(hsy, wsx, 1), generator=generator).to(metric.device)
+        idx_buffer_view = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer_view.scatter_(dim=2, index=rand_idx, src=-torch.ones_like(rand_idx))
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+        if hsy * sy < h or wsx * sx < w:
+            # the leftover rows and columns are all sources
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[:hsy * sy, :wsx * sx] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+        # destinations (-1) sort first
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]  # src
+        b_idx = rand_idx[:, :num_dst, :]  # dst
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # unmerged sources
+        src_idx = edge_idx[..., :r, :]  # merged sources
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x, mode='mean'):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = unm.shape[-1]
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx).expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx).expand(B, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+def compute_merge(x, hw=None, ratio=0., seed=0):
+    """`merge`/`unmerge` of the image tokens `x` (B, N, C) of an (h, w) grid, merging `ratio` of them."""
+    if not ratio:
+        return do_nothing, do_nothing
+    return bipartite_soft_matching_random2d(x, *hw, int(x.shape[1] * ratio), seed=seed)
@@ -1,5 +1,7 @@
 import os
 import sys
+import inspect
+from functools import partial
 import torch.nn as nn
 from torch.utils.checkpoint import checkpoint, checkpoint_sequential
 import torch.nn.functional as F
@@ -44,6 +46,38 @@ def auto_grad_checkpoint(module, *args, **kwargs):
     return module(*args, **kwargs)
 
 
+def _same_input(a, b):
+    if a is b:
+        return True
+    if isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor):
+        return a.shape == b.shape and a.dtype == b.dtype and a.device == b.device and torch.equal(a, b)
+    return not isinstance(a, torch.Tensor) and not isinstance(b, torch.Tensor) and a == b
+
+
+def cached_condition(cond_cache, name, inputs, fn):
+    """
+    Returns fn(). With a `cond_cache` dict (one per sampling call), the output of an earlier call under the same `name`
+    with the same (or equal) `inputs` is returned instead, so timestep-invariant conditioning is computed once per
+    sampling call rather than at every solver step.
+    """
+    if cond_cache is None:
+        return fn()
+    entries = cond_cache.setdefault(name, [])
+    for cached_inputs, out in entries:
+        if len(cached_inputs) == len(inputs) and all(_same_input(a, b) for a, b in zip(cached_inputs, inputs)):
+            return out
+    out = fn()
+    entries.append((inputs, out))
+    return out
+
+
+def with_cond_cache(model_fn):
+    """Gives `model_fn` a fresh conditioning cache if it takes one, e.g. `PixArtMS.forward_with_dpmsolver`."""
+    if 'cond_cache' in inspect.signature(model_fn).parameters:
+        return partial(model_fn, cond_cache={})
+    return model_fn
+
+
 def checkpoint_sequential(functions, step, input, *args, **kwargs):
 
     # Hack for keyword-only parameter in a python 2.7-compliant way
@@ -463,6 +497,18 @@ def prepare_prompt_ar(prompt, ratios, device='cpu', show=True):
     return prompt_clean, prompt_show, torch.tensor(default_hw, device=device)[None], torch.tensor([float(closest_ratio)], device=device)[None], torch.tensor(custom_hw, device=device)[None]
 
 
+def group_prompts_by_ratio(default_hws, batch_size):
+    """
+    Batches of at most `batch_size` prompt indices that fall in the same aspect-ratio bucket, given the bucket size
+    `default_hw` that `prepare_prompt_ar` returned for every prompt, so that every batch shares one latent size.
+    Buckets come in order of first appearance and keep the input order of their prompts.
+    """
+    buckets = {}
+    for i, default_hw in enumerate(default_hws):
+        buckets.setdefault(tuple(default_hw[0].tolist()), []).append(i)
+    return [indices[j:j + batch_size] for indices in buckets.values() for j in range(0, len(indices), batch_size)]
+
+
 def resize_and_crop_tensor(samples: torch.Tensor, new_width: int, new_height: int):
     orig_hw = torch.tensor([samples.shape[2], samples.shape[3]], dtype=torch.int)
     custom_hw = torch.tensor([int(new_height), int(new_width)], dtype=torch.int)
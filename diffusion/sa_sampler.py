@@ -4,6 +4,7 @@ import torch
 import numpy as np
 
 from diffusion.model.sa_solver import NoiseScheduleVP, model_wrapper, SASolver
+from diffusion.model.utils import with_cond_cache, StackedRandomGenerator
 from .model import gaussian_diffusion as gd
 
 
@@ -27,7 +28,8 @@ class SASolverSampler(object):
         setattr(self, name, attr)
 
     @torch.no_grad()
-    def sample(self, S, batch_size, shape, conditioning=None, callback=None, normals_sequence=None, img_callback=None, quantize_x0=False, eta=0., mask=None, x0=None, temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None, verbose=True, x_T=None, log_every_t=100, unconditional_guidance_scale=1., unconditional_conditioning=None, model_kwargs=None, **kwargs):
+    def sample(self, S, batch_size, shape, conditioning=None, callback=None, normals_sequence=None, img_callback=None, quantize_x0=False, eta=0., mask=None, x0=None, temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None, verbose=True, x_T=None, log_every_t=100, unconditional_guidance_scale=1., unconditional_conditioning=None, model_kwargs=None, guidance_interval=None, seeds=None, **kwargs):
+        # seeds: one per sample; the initial and the corrector noise of each sample then come from its own generator
         if model_kwargs is None:
             model_kwargs = {}
         if conditioning is not None:
@@ -43,11 +45,16 @@ class SASolverSampler(object):
         size = (batch_size, C, H, W)
 
         device = self.device
-        img = torch.randn(size, device=device) if x_T is None else x_T
+        rnd = StackedRandomGenerator(device, seeds) if seeds is not None else None
+        randn_like = rnd.randn_like if rnd is not None else torch.randn_like
+        if x_T is not None:
+            img = x_T
+        else:
+            img = rnd.randn(size, device=device) if rnd is not None else torch.randn(size, device=device)
         ns = NoiseScheduleVP('discrete', alphas_cumprod=self.alphas_cumprod)
 
         model_fn = model_wrapper(
-            self.model,
+            with_cond_cache(self.model),  # conditioning computed once per call
             ns,
             model_type="noise",
             guidance_type="classifier-free",
@@ -55,12 +62,14 @@ class SASolverSampler(object):
             unconditional_condition=unconditional_conditioning,
             guidance_scale=unconditional_guidance_scale,
             model_kwargs=model_kwargs,
+            guidance_interval=guidance_interval,
         )
+        self.guidance_stats = model_fn.guidance_stats
 
         sasolver = SASolver(model_fn, ns, algorithm_type="data_prediction")
 
         tau_t = lambda t: eta if 0.2 <= t <= 0.8 else 0
 
-        x = sasolver.sample(mode='few_steps', x=img, tau=tau_t, steps=S, skip_type='time', skip_order=1, predictor_order=2, corrector_order=2, pc_mode='PEC', return_intermediate=False)
+        x = sasolver.sample(mode='few_steps', x=img, tau=tau_t, steps=S, skip_type='time', skip_order=1, predictor_order=2, corrector_order=2, pc_mode='PEC', return_intermediate=False, randn_like=randn_like)
 
         return x.to(device), None
\ No newline at end of file
@@ -1,9 +1,66 @@
+import glob
+import json
 import os
 import re
+import shutil
+import threading
+import time
+import uuid
+
 import torch
+import torch.distributed as dist
+import torch.nn as nn
 
+from diffusion.utils.dist_utils import get_rank, get_world_size
 from diffusion.utils.logger import get_root_logger
 
+POS_EMBED_KEYS = ['pos_embed', 'base_model.pos_embed', 'model.pos_embed']
+CHECKPOINT_NAME = re.compile(r'epoch_(\d+)(?:_step_(\d+))?(?:\.pth)?$')
+MANIFEST = 'manifest.json'
+META = 'meta.pth'
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_json(path, obj):
+    """Writes `obj` next to `path` and renames it over `path`, so readers never see a partial file."""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def list_checkpoints(work_dir):
+    """Committed checkpoints in `work_dir`, `.pth` files and sharded directories, sorted oldest first by (epoch, step)."""
+    checkpoints = []
+    for path in glob.glob(os.path.join(work_dir, 'epoch_*')):
+        match = CHECKPOINT_NAME.match(os.path.basename(path))
+        if match is None or (os.path.isdir(path) and not os.path.exists(os.path.join(path, MANIFEST))):
+            continue
+        checkpoints.append((int(match.group(1)), int(match.group(2) or 0), path))
+    return [path for _, _, path in sorted(checkpoints)]
+
+
+def apply_retention(work_dir, keep_last):
+    """Removes all but the `keep_last` newest checkpoints of `work_dir` (True keeps one, None/False/0 keeps all)."""
+    if not keep_last:
+        return []
+    checkpoints = list_checkpoints(work_dir)
+    removed = checkpoints[:-int(keep_last)]
+    for path in removed:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    return removed
+
 
 def save_checkpoint(work_dir,
                     epoch,
@@ -13,6 +70,7 @@ def save_checkpoint(work_dir,
                     lr_scheduler=None,
                     keep_last=False,
                     step=None,
+                    sampler_state=None,
                     ):
     os.makedirs(work_dir, exist_ok=True)
     state_dict = dict(state_dict=model.state_dict())
@@ -22,6 +80,8 @@ def save_checkpoint(work_dir,
         state_dict['optimizer'] = optimizer.state_dict()
     if lr_scheduler is not None:
         state_dict['scheduler'] = lr_scheduler.state_dict()
+    if sampler_state is not None:
+        state_dict['sampler'] = sampler_state
     if epoch is not None:
         state_dict['epoch'] = epoch
         file_path = os.path.join(work_dir, f"epoch_{epoch}.pth")
@@ -29,12 +89,272 @@ def save_checkpoint(work_dir,
             file_path = file_path.split('.pth')[0] + f"_step_{step}.pth"
     logger = get_root_logger()
     torch.save(state_dict, file_path)
-    logger.info(f'Saved checkpoint of epoch {epoch} to {file_path.format(epoch)}.')
-    if keep_last:
-        for i in range(epoch):
-            previous_ckgt = file_path.format(i)
-            if os.path.exists(previous_ckgt):
-                os.remove(previous_ckgt)
+    logger.info(f'Saved checkpoint of epoch {epoch} to {file_path}.')
+    apply_retention(work_dir, keep_last)
+
+
+def _flatten(obj, prefix, tensors):
+    """Moves the tensors of the nested dicts/lists `obj` to `tensors` under their dotted path; returns the rest."""
+    if isinstance(obj, torch.Tensor):
+        assert prefix not in tensors, f'duplicate checkpoint key {prefix}'
+        tensors[prefix] = obj
+        return {'__tensor__': prefix}
+    if isinstance(obj, dict):
+        return {k: _flatten(v, f'{prefix}.{k}', tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(v, f'{prefix}.{i}', tensors) for i, v in enumerate(obj))
+    return obj
+
+
+def _unflatten(obj, tensors):
+    if isinstance(obj, dict):
+        if set(obj) == {'__tensor__'}:
+            return tensors[obj['__tensor__']]
+        return {k: _unflatten(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_unflatten(v, tensors) for v in obj)
+    return obj
+
+
+def _balanced_groups(tensors, num_groups):
+    """Splits the keys of `tensors` into `num_groups` groups of about the same number of bytes, the same on every rank."""
+    groups, sizes = [[] for _ in range(num_groups)], [0] * num_groups
+    for key in sorted(tensors, key=lambda k: (-tensors[k].numel() * tensors[k].element_size(), k)):
+        i = sizes.index(min(sizes))
+        groups[i].append(key)
+        sizes[i] += tensors[key].numel() * tensors[key].element_size()
+    return groups
+
+
+class AsyncCheckpointWriter:
+    """
+    Saves the same state as `save_checkpoint` without stalling training on the write.
+
+    `save` has to be called on every rank. Each rank snapshots its share of the tensors to pinned CPU buffers.
+    The shares are balanced by bytes, because under data parallel every rank holds the full state. The copies are
+    only enqueued on the current CUDA stream. A background thread then writes the share as one safetensors shard into
+    a temporary directory. Rank 0 also writes the non-tensor state (`meta.pth`). Once all shards are on disk, rank 0
+    writes `manifest.json` and renames the directory to `epoch_{epoch}_step_{step}`, so a crash never leaves a
+    partial checkpoint behind. It then keeps the `keep_last` newest checkpoints. `load_checkpoint` reads both these
+    directories and `.pth` files.
+
+    The shards are committed through the file system, so `work_dir` must be shared by all ranks. Only one save is in
+    flight at a time: `save` waits for the previous one, and `wait` must be called before exiting.
+    """
+
+    def __init__(self, keep_last=None, timeout=1800):
+        self.keep_last = keep_last
+        self.timeout = timeout
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+
+    def _snapshot(self, tensors):
+        snapshot = {}
+        pin_memory = torch.cuda.is_available()
+        for key, tensor in tensors.items():
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = self.buffers[key] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=pin_memory)
+            snapshot[key] = buffer.copy_(tensor.detach(), non_blocking=True)
+        for key in set(self.buffers) - set(tensors):
+            del self.buffers[key]
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        return snapshot, event
+
+    def _save_id(self):
+        save_id = [uuid.uuid4().hex[:8]]
+        if self.world_size > 1:
+            dist.broadcast_object_list(save_id, src=0)
+        return save_id[0]
+
+    @torch.no_grad()
+    def save(self, work_dir, epoch, model, model_ema=None, optimizer=None, lr_scheduler=None, step=None,
+             sampler_state=None):
+        self.wait()
+        os.makedirs(work_dir, exist_ok=True)
+        name = f'epoch_{epoch}' if step is None else f'epoch_{epoch}_step_{step}'
+        tmp_dir = os.path.join(work_dir, f'.{name}.{self._save_id()}.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        state = dict(state_dict=model.state_dict(), epoch=epoch)
+        if model_ema is not None:
+            state['state_dict_ema'] = model_ema.state_dict()
+        if optimizer is not None:
+            state['optimizer'] = optimizer.state_dict()
+        if lr_scheduler is not None:
+            state['scheduler'] = lr_scheduler.state_dict()
+        if sampler_state is not None:
+            state['sampler'] = sampler_state
+        tensors = {}
+        meta = _flatten(state, 'checkpoint', tensors)
+        shard = _balanced_groups(tensors, self.world_size)[self.rank]
+        snapshot, event = self._snapshot({key: tensors[key] for key in shard})
+        self.thread = threading.Thread(target=self._write, args=(work_dir, name, tmp_dir, snapshot, event, meta, epoch, step))
+        self.thread.start()
+
+    def _write(self, work_dir, name, tmp_dir, snapshot, event, meta, epoch, step):
+        try:
+            from safetensors.torch import save_file
+
+            t = time.time()
+            if event is not None:
+                event.synchronize()
+            shard_name = f'shard_{self.rank:05d}-of-{self.world_size:05d}.safetensors'
+            save_file(snapshot, os.path.join(tmp_dir, shard_name))
+            with open(os.path.join(tmp_dir, shard_name), 'rb') as f:
+                os.fsync(f.fileno())
+            if self.rank == 0:
+                torch.save(meta, os.path.join(tmp_dir, META))
+                with open(os.path.join(tmp_dir, META), 'rb') as f:
+                    os.fsync(f.fileno())
+            # the per-shard index doubles as the marker that the shard is complete
+            _write_json(os.path.join(tmp_dir, shard_name + '.json'), sorted(snapshot))
+            if self.rank == 0:
+                self._commit(work_dir, name, tmp_dir, epoch, step)
+                get_root_logger().info(f'Saved checkpoint of epoch {epoch} to {os.path.join(work_dir, name)} '
+                                       f'in the background ({time.time() - t:.1f}s).')
+        except BaseException as e:
+            self.error = e
+
+    def _commit(self, work_dir, name, tmp_dir, epoch, step):
+        shard_names = [f'shard_{rank:05d}-of-{self.world_size:05d}.safetensors' for rank in range(self.world_size)]
+        deadline = time.time() + self.timeout
+        while not all(os.path.exists(os.path.join(tmp_dir, shard_name + '.json')) for shard_name in shard_names):
+            if time.time() > deadline:
+                raise TimeoutError(f'shards of {name} not written within {self.timeout}s')
+            time.sleep(1)
+        shards = {}
+        for shard_name in shard_names:
+            with open(os.path.join(tmp_dir, shard_name + '.json')) as f:
+                shards[shard_name] = json.load(f)
+        _write_json(os.path.join(tmp_dir, MANIFEST), dict(epoch=epoch, step=step, meta=META, shards=shards))
+        _fsync_dir(tmp_dir)
+        final_dir = os.path.join(work_dir, name)
+        if os.path.exists(final_dir):
+            shutil.rmtree(final_dir)
+        os.rename(tmp_dir, final_dir)
+        _fsync_dir(work_dir)
+        # temporary directories of saves that were interrupted
+        for stale in glob.glob(os.path.join(work_dir, '.epoch_*.tmp')):
+            shutil.rmtree(stale, ignore_errors=True)
+        apply_retention(work_dir, self.keep_last)
+
+    def wait(self):
+        """Blocks until the pending save is written (and committed, on rank 0); re-raises its error."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def torch_load_mmap(path):
+    """
+    `torch.load` to the CPU, memory-mapped where torch (>= 2.1) and the file (zip format) allow it: tensors are only
+    read from disk when they are used, so the sub-dicts a caller never touches cost no RAM.
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):   # older torch, or a legacy (non-zip) checkpoint
+        return torch.load(path, map_location="cpu")
+
+
+def _has_tensor(obj):
+    if isinstance(obj, dict):
+        return set(obj) == {'__tensor__'} or any(_has_tensor(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_tensor(v) for v in obj)
+    return False
+
+
+def read_checkpoint(path, keys=None):
+    """
+    The state saved by `save_checkpoint` (a `.pth` file) or `AsyncCheckpointWriter` (a directory), or a bare
+    `.safetensors` state dict (returned as `state_dict`).
+
+    Args:
+        keys (list, optional): The top-level entries whose tensors are needed, e.g. ['state_dict']. Tensors of the
+            others are not read: `.pth` files are memory-mapped, and only the matching tensors of the shards are loaded.
+    """
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+
+        return dict(state_dict=load_file(path))
+    if not os.path.isdir(path):
+        return torch_load_mmap(path)
+    from safetensors import safe_open
+
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    tensors = {}
+    for shard_name in manifest['shards']:
+        with safe_open(os.path.join(path, shard_name), framework="pt", device="cpu") as f:
+            for name in f.keys():
+                if keys is None or name.split('.')[1] in keys:
+                    tensors[name] = f.get_tensor(name)
+    meta = torch.load(os.path.join(path, manifest['meta']), map_location="cpu")
+    if keys is not None:
+        meta = {k: v for k, v in meta.items() if k in keys or not _has_tensor(v)}
+    return _unflatten(meta, tensors)
+
+
+# weights that are expected to be absent from a checkpoint: the sin-cos pos_embed, which the loaders drop, and the
+# zero-initialized input/output projections of fresh ControlNet blocks
+MATERIALIZED_KEYS = re.compile(r'(^|\.)pos_embed$|^controlnet\.\d+\.(before|after)_proj\.')
+
+
+def _materialize_meta(model):
+    """
+    Allocates (zeroed) the parameters and buffers of `model` still on the meta device and returns their names. Raises
+    if any of them is a weight the checkpoint should have provided, instead of running with zeros.
+    """
+    meta = []
+    for module_name, module in model.named_modules():
+        for tensors, wrap in ((module._parameters, True), (module._buffers, False)):
+            for name, tensor in tensors.items():
+                if tensor is not None and tensor.is_meta:
+                    meta.append((f'{module_name}.{name}' if module_name else name, tensors, name, wrap))
+    unexpected_missing = [full_name for full_name, *_ in meta if not MATERIALIZED_KEYS.search(full_name)]
+    if unexpected_missing:
+        raise KeyError(f'{len(unexpected_missing)} weights missing from the checkpoint, '
+                       f'e.g. {unexpected_missing[:5]}; does it match the model (image size, architecture)?')
+    for _, tensors, name, wrap in meta:
+        tensor = tensors[name]
+        value = torch.zeros(tensor.shape, dtype=tensor.dtype)
+        tensors[name] = nn.Parameter(value, requires_grad=tensor.requires_grad) if wrap else value
+    return [full_name for full_name, *_ in meta]
+
+
+def load_model_weights(checkpoint, model, load_ema=False):
+    """
+    Loads only the (EMA) weights of `checkpoint` into `model`, for inference and fine-tuning.
+
+    `model` may be built without allocating its weights (`accelerate.init_empty_weights`); its parameters are then
+    replaced by the memory-mapped checkpoint tensors instead of being copied, so they are read from disk once, when
+    the model is moved to its device and dtype. Weights left unallocated raise a KeyError, except `pos_embed` and the
+    zero-initialized ControlNet projections.
+    """
+    key = 'state_dict_ema' if load_ema else 'state_dict'
+    ckpt = read_checkpoint(checkpoint, keys=[key])
+    if key in ckpt:
+        state_dict = ckpt[key]
+    elif key == 'state_dict' and all(isinstance(v, torch.Tensor) for v in ckpt.values()):
+        state_dict = ckpt  # to be compatible with a bare state dict
+    else:
+        raise KeyError(f'{checkpoint} has no {key}')
+    for pos_embed_key in POS_EMBED_KEYS:
+        state_dict.pop(pos_embed_key, None)
+    if not any(p.is_meta for p in model.parameters()):
+        return model.load_state_dict(state_dict, strict=False)
+    missing, unexpect = model.load_state_dict(state_dict, strict=False, assign=True)   # torch >= 2.1
+    _materialize_meta(model)
+    return missing, unexpect
 
 
 def load_checkpoint(checkpoint,
@@ -44,14 +364,19 @@ def load_checkpoint(checkpoint,
                     lr_scheduler=None,
                     load_ema=False,
                     resume_optimizer=True,
-                    resume_lr_scheduler=True
+                    resume_lr_scheduler=True,
+                    sampler=None,
                     ):
     assert isinstance(checkpoint, str)
     ckpt_file = checkpoint
-    checkpoint = torch.load(ckpt_file, map_location="cpu")
+    keys = ['state_dict']
+    if load_ema or model_ema is not None:
+        keys.append('state_dict_ema')
+    if optimizer is not None and resume_optimizer:
+        keys.append('optimizer')
+    checkpoint = read_checkpoint(ckpt_file, keys=keys)
 
-    state_dict_keys = ['pos_embed', 'base_model.pos_embed', 'model.pos_embed']
-    for key in state_dict_keys:
+    for key in POS_EMBED_KEYS:
         if key in checkpoint['state_dict']:
             del checkpoint['state_dict'][key]
             if 'state_dict_ema' in checkpoint and key in checkpoint['state_dict_ema']:
@@ -71,6 +396,10 @@ def load_checkpoint(checkpoint,
     if lr_scheduler is not None and resume_lr_scheduler:
         lr_scheduler.load_state_dict(checkpoint['scheduler'])
     logger = get_root_logger()
+    if sampler is not None and 'sampler' in checkpoint:
+        sampler.load_state_dict(checkpoint['sampler'])
+        logger.info(f"Resume sampler at epoch {checkpoint['sampler']['epoch']}, "
+                    f"skipping {checkpoint['sampler']['consumed_steps']} consumed steps.")
     if optimizer is not None:
         epoch = checkpoint.get('epoch', re.match(r'.*epoch_(\d*).*.pth', ckpt_file).group()[0])
         logger.info(f'Resume checkpoint of epoch {epoch} from {ckpt_file}. Load ema: {load_ema}, '
@@ -1,12 +1,31 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import os
 from typing import Sequence
-from torch.utils.data import BatchSampler, Sampler, Dataset
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, Sampler, Dataset, RandomSampler, SequentialSampler
 from random import shuffle, choice
 from copy import deepcopy
+from diffusion.data.datasets.utils import get_closest_ratio_ids, sorted_ratio_keys
 from diffusion.utils.logger import get_root_logger
 
 
+def get_bucket_ids(dataset, aspect_ratios):
+    """Per-sample aspect-ratio bucket ids (indices into `sorted_ratio_keys(aspect_ratios)`)."""
+    if hasattr(dataset, 'get_bucket_ids'):
+        return np.asarray(dataset.get_bucket_ids(aspect_ratios))
+    # generic datasets: a single pass over get_data_info
+    infos = [dataset.get_data_info(idx) for idx in range(len(dataset))]
+    return get_closest_ratio_ids([info['height'] for info in infos], [info['width'] for info in infos], aspect_ratios)
+
+
+def sampler_indices(sampler):
+    """Materialize one epoch of `sampler` as an int64 array, without a python loop for plain random sampling."""
+    if isinstance(sampler, RandomSampler) and not sampler.replacement and sampler.num_samples == len(sampler.data_source):
+        return torch.randperm(len(sampler.data_source), generator=sampler.generator).numpy()
+    return np.fromiter(iter(sampler), dtype=np.int64, count=len(sampler))
+
+
 class AspectRatioBatchSampler(BatchSampler):
     """A sampler wrapper for grouping images with similar aspect ratio into a same batch.
 
@@ -42,38 +61,156 @@ class AspectRatioBatchSampler(BatchSampler):
         self.ratio_nums_gt = kwargs.get('ratio_nums', None)
         self.config = config
         assert self.ratio_nums_gt
-        # buckets for each aspect ratio
-        self._aspect_ratio_buckets = {ratio: [] for ratio in aspect_ratios}
         self.current_available_bucket_keys =  [str(k) for k, v in self.ratio_nums_gt.items() if v >= valid_num]
+        # bucket ids index into the ascending ratio keys, computed once for the whole dataset
+        self.ratio_keys = sorted_ratio_keys(aspect_ratios)
+        self.bucket_ids = get_bucket_ids(dataset, aspect_ratios)
+        self.valid_buckets = np.array([k in self.current_available_bucket_keys for k in self.ratio_keys])
+        # with drop_last, incomplete buckets are carried over to the next epoch instead of being dropped
+        self._carry_over = np.zeros(0, dtype=np.int64)
         logger = get_root_logger() if config is None else get_root_logger(os.path.join(config.work_dir, 'train_log.log'))
         logger.warning(f"Using valid_num={valid_num} in config file. Available {len(self.current_available_bucket_keys)} aspect_ratios: {self.current_available_bucket_keys}")
 
+    def assemble_batches(self, indices, batch_size=None):
+        """Split one epoch of sample indices into same-bucket batches.
+
+        Equivalent to streaming `indices` into per-bucket lists and emitting a bucket whenever it holds
+        `batch_size` samples: full batches come out ordered by the stream position of their last sample,
+        followed (unless `drop_last`) by the incomplete rest of every bucket in ratio order.
+
+        Returns:
+            (batches, rest): an (num_batches, batch_size) index array and a list of incomplete buckets.
+        """
+        batch_size = batch_size or self.batch_size
+        indices = np.concatenate([self._carry_over, np.asarray(indices, dtype=np.int64)])
+        bucket_ids = self.bucket_ids[indices]
+        keep = self.valid_buckets[bucket_ids]
+        indices, bucket_ids = indices[keep], bucket_ids[keep]
+        order = np.argsort(bucket_ids, kind='stable')       # positions stay ascending inside every bucket
+        sorted_buckets = bucket_ids[order]
+        bucket_starts = np.searchsorted(sorted_buckets, np.arange(len(self.ratio_keys) + 1))
+
+        batches, batch_ends, rest = [], [], []
+        for b in range(len(self.ratio_keys)):
+            start, end = bucket_starts[b], bucket_starts[b + 1]
+            num_full = (end - start) // batch_size
+            full_end = start + num_full * batch_size
+            if num_full:
+                batches.append(indices[order[start:full_end]].reshape(num_full, batch_size))
+                batch_ends.append(order[start + batch_size - 1:full_end:batch_size])
+            if full_end < end:
+                rest.append(indices[order[full_end:end]])
+        if not batches:
+            return np.zeros((0, batch_size), dtype=np.int64), rest
+        batches, batch_ends = np.concatenate(batches), np.concatenate(batch_ends)
+        return batches[np.argsort(batch_ends, kind='stable')], rest
+
     def __iter__(self) -> Sequence[int]:
-        for idx in self.sampler:
-            data_info = self.dataset.get_data_info(idx)
-            height, width =  data_info['height'], data_info['width']
-            ratio = height / width
-            # find the closest aspect ratio
-            closest_ratio = min(self.aspect_ratios.keys(), key=lambda r: abs(float(r) - ratio))
-            if closest_ratio not in self.current_available_bucket_keys:
-                continue
-            bucket = self._aspect_ratio_buckets[closest_ratio]
-            bucket.append(idx)
-            # yield a batch of indices in the same aspect ratio group
-            if len(bucket) == self.batch_size:
-                yield bucket[:]
-                del bucket[:]
+        batches, rest = self.assemble_batches(sampler_indices(self.sampler))
+        self._carry_over = np.concatenate(rest) if self.drop_last and rest else np.zeros(0, dtype=np.int64)
+        for batch in batches:
+            yield batch.tolist()
+
+        # yield the rest data
+        if not self.drop_last:
+            for bucket in rest:
+                yield bucket.tolist()
+
+
+class DistributedAspectRatioBatchSampler(AspectRatioBatchSampler):
+    """Aspect-ratio batch sampler that is deterministic across ranks and resumable inside an epoch.
 
-        # yield the rest data and reset the buckets
-        for bucket in self._aspect_ratio_buckets.values():
-            while len(bucket) > 0:
-                if len(bucket) <= self.batch_size:
-                    if not self.drop_last:
-                        yield bucket[:]
-                    bucket = []
-                else:
-                    yield bucket[:self.batch_size]
-                    bucket = bucket[self.batch_size:]
+    Every epoch is planned from ``(seed, epoch)`` alone: a seeded permutation of the dataset is bucketed into
+    global batches of ``batch_size * num_replicas`` same-ratio samples and each global batch is split across
+    the ranks. All ranks therefore get the same bucket, i.e. the same latent shape, at every step, on disjoint
+    samples. Incomplete global batches are dropped; the next epoch reshuffles, so no sample is dropped for good.
+
+    With ``rank=None`` the per-rank batches of a step are yielded back to back, which is the layout
+    ``accelerator.prepare`` expects when it shards a batch sampler round-robin over processes. With an
+    explicit ``rank`` only that rank's batches are yielded.
+
+    Args:
+        dataset (Dataset): Dataset providing data information.
+        batch_size (int): Size of mini-batch on every rank.
+        aspect_ratios (dict): The predefined aspect ratios.
+        num_replicas (int): Number of ranks sharing the global batches.
+        rank (int, optional): Rank to yield batches for, ``None`` to yield the batches of all ranks.
+        seed (int): Seed shared by all ranks.
+    """
+
+    def __init__(self,
+                 dataset: Dataset,
+                 batch_size: int,
+                 aspect_ratios: dict,
+                 config=None,
+                 valid_num=0,
+                 num_replicas: int = 1,
+                 rank=None,
+                 seed: int = 0,
+                 **kwargs) -> None:
+        kwargs.pop('drop_last', None)
+        super().__init__(SequentialSampler(dataset), dataset, batch_size, aspect_ratios, drop_last=True,
+                         config=config, valid_num=valid_num, **kwargs)
+        if rank is not None and not 0 <= rank < num_replicas:
+            raise ValueError(f'rank should be in [0, {num_replicas}), but got rank={rank}')
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self._consumed_steps = 0
+        self._resume_steps = {}     # epoch -> number of steps already consumed in that epoch
+        bucket_ids = self.bucket_ids[:len(dataset)]
+        bucket_nums = np.bincount(bucket_ids[self.valid_buckets[bucket_ids]], minlength=len(self.ratio_keys))
+        self.num_steps = int((bucket_nums // (batch_size * num_replicas)).sum())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def resume_step(self):
+        """Number of steps of the current epoch that will be skipped by the next ``__iter__``."""
+        return self._resume_steps.get(self.epoch, 0)
+
+    def state_dict(self, consumed_steps=None):
+        """
+        Args:
+            consumed_steps (int, optional): Steps of the current epoch the training loop has finished. The
+                dataloader prefetches batches, so this is more accurate than what the sampler has yielded.
+        """
+        if consumed_steps is None:
+            consumed_steps = self._consumed_steps
+        epoch = self.epoch
+        if consumed_steps >= self.num_steps:
+            epoch, consumed_steps = epoch + 1, 0
+        return dict(seed=self.seed, epoch=epoch, consumed_steps=consumed_steps, num_replicas=self.num_replicas)
+
+    def load_state_dict(self, state_dict):
+        if state_dict['num_replicas'] != self.num_replicas:
+            # the epoch plan depends on the global batch size, skipping steps of a different plan is meaningless
+            logger = get_root_logger()
+            logger.warning(f"Sampler state saved with {state_dict['num_replicas']} replicas, running with "
+                           f"{self.num_replicas}. Restart epoch {state_dict['epoch']} from the beginning.")
+            state_dict = dict(state_dict, consumed_steps=0)
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self._resume_steps = {self.epoch: state_dict['consumed_steps']}
+
+    def __len__(self):
+        return self.num_steps if self.rank is not None else self.num_steps * self.num_replicas
+
+    def __iter__(self) -> Sequence[int]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.dataset), generator=generator).numpy()
+        global_batches, _ = self.assemble_batches(indices, self.batch_size * self.num_replicas)
+        skip = self._resume_steps.pop(self.epoch, 0)
+        for self._consumed_steps in range(skip, len(global_batches)):
+            batches = global_batches[self._consumed_steps].reshape(self.num_replicas, self.batch_size)
+            if self.rank is None:
+                yield from (batch.tolist() for batch in batches)
+            else:
+                yield batches[self.rank].tolist()
+        self._consumed_steps = len(global_batches)
 
 
 class BalancedAspectRatioBatchSampler(AspectRatioBatchSampler):
@@ -97,11 +234,10 @@ class BalancedAspectRatioBatchSampler(AspectRatioBatchSampler):
 
     def __iter__(self) -> Sequence[int]:
         i = 0
-        for idx in self.sampler:
-            data_info = self.dataset.get_data_info(idx)
-            height, width = data_info['height'], data_info['width']
-            ratio = height / width
-            closest_ratio = float(min(self.aspect_ratios.keys(), key=lambda r: abs(float(r) - ratio)))
+        # the round-robin over buckets below is inherently sequential; only the per-sample ratio lookup is precomputed
+        indices = sampler_indices(self.sampler)
+        bucket_ratios = np.array([float(k) for k in self.ratio_keys])[self.bucket_ids[indices]]
+        for idx, closest_ratio in zip(indices.tolist(), bucket_ratios.tolist()):
             if closest_ratio not in self.all_available_keys:
                 continue
             if self._aspect_ratio_count[closest_ratio] < self.ratio_nums_gt[closest_ratio]:
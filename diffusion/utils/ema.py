@@ -0,0 +1,74 @@
+import torch
+import torch.nn as nn
+
+
+def _paired_parameters(model_dest: nn.Module, model_src: nn.Module):
+    param_dict_src = dict(model_src.named_parameters())
+    params_dest, params_src = [], []
+    for p_name, p_dest in model_dest.named_parameters():
+        p_src = param_dict_src[p_name]
+        assert p_src is not p_dest
+        params_dest.append(p_dest)
+        params_src.append(p_src)
+    return params_dest, params_src
+
+
+@torch.no_grad()
+def _lerp(params_dest, params_src, rate):
+    if rate == 0:
+        for p_dest, p_src in zip(params_dest, params_src):
+            p_dest.copy_(p_src)
+    elif hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(params_dest, params_src, 1 - rate)
+    else:
+        torch._foreach_mul_(params_dest, rate)
+        torch._foreach_add_(params_dest, params_src, alpha=1 - rate)
+
+
+def ema_update(model_dest: nn.Module, model_src: nn.Module, rate):
+    """One EMA step, `dest = rate * dest + (1 - rate) * src`; rate 0 copies. Use `EMA` for the per-step update."""
+    _lerp(*_paired_parameters(model_dest, model_src), rate)
+
+
+class EMA:
+    """
+    Exponential moving average of the parameters of `model_src`, kept in `model_dest` (a copy of it).
+
+    The parameter pairs are matched by name once; every update is one multi-tensor `torch._foreach_lerp_` over all
+    of them instead of a Python loop of per-parameter kernels. Build it after `accelerator.prepare`, which may move
+    or replace the parameters.
+
+    Args:
+        rate (float): Decay per optimizer step.
+        update_every (int): Update on every N-th call of `step`, with the decay `rate ** N` of the N skipped steps.
+        offload (bool): Keep the EMA weights on the CPU; `model_src` is copied to pinned buffers on every update.
+            `model_dest` must then not be prepared by accelerate.
+    """
+
+    def __init__(self, model_dest: nn.Module, model_src: nn.Module, rate, update_every=1, offload=False):
+        self.params_dest, self.params_src = _paired_parameters(model_dest, model_src)
+        self.rate = rate
+        self.update_every = update_every
+        self.offload = offload
+        self.num_steps = 0
+        if offload:
+            model_dest.cpu()
+            pin_memory = torch.cuda.is_available()
+            self.buffers = [torch.empty(p.shape, dtype=p.dtype, pin_memory=pin_memory) for p in self.params_dest]
+
+    @torch.no_grad()
+    def step(self):
+        self.num_steps += 1
+        if self.num_steps % self.update_every == 0:
+            self.update(self.rate ** self.update_every)
+
+    @torch.no_grad()
+    def update(self, rate):
+        params_src = self.params_src
+        if self.offload:
+            for buffer, p_src in zip(self.buffers, params_src):
+                buffer.copy_(p_src, non_blocking=True)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            params_src = self.buffers
+        _lerp(self.params_dest, params_src, rate)
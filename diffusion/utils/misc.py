@@ -1,9 +1,13 @@
 import collections
 import datetime
+import glob
+import json
 import os
 import random
 import subprocess
+import threading
 import time
+from contextlib import contextmanager
 from multiprocessing import JoinableQueue, Process
 
 import numpy as np
@@ -102,6 +106,152 @@ class SimpleTimer:
             self.logger.info(log_info)
 
 
+class StageTimer:
+    """Busy time and item counts per stage of a pipeline whose stages run in different threads."""
+    def __init__(self):
+        self.start_time = self._last_lap = time.time()
+        self.busy = collections.defaultdict(float)
+        self.items = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, stage, num_items=1):
+        t = time.time()
+        yield
+        with self._lock:
+            self.busy[stage] += time.time() - t
+            self.items[stage] += num_items
+
+    def lap(self, stage=None, num_items=1):
+        """Sequential stages of one thread: adds the time since the previous lap to `stage`; None restarts the clock."""
+        t = time.time()
+        if stage is not None:
+            with self._lock:
+                self.busy[stage] += t - self._last_lap
+                self.items[stage] += num_items
+        self._last_lap = t
+
+    def pop_means(self):
+        """Mean time per item of every stage since the previous call, e.g. a per-step time breakdown."""
+        with self._lock:
+            means = {stage: busy / max(self.items[stage], 1) for stage, busy in self.busy.items()}
+            self.busy.clear()
+            self.items.clear()
+        return means
+
+    def report(self):
+        wall = time.time() - self.start_time
+        lines = [f"{stage:>10}: {self.items[stage]} items, {busy:.2f}s busy, {self.items[stage] / max(busy, 1e-9):.2f} items/s"
+                 for stage, busy in self.busy.items()]
+        total = sum(self.busy.values())
+        lines.append(f"{'wall':>10}: {wall:.2f}s, {total:.2f}s of stage work (overlap x{total / max(wall, 1e-9):.2f})")
+        return '\n'.join(lines)
+
+
+class MetricsAccumulator:
+    """
+    Running sums of scalar training metrics (e.g. loss, grad norm), kept on the device so that the training step never
+    waits for them. `reduce` averages them over the steps and the processes with one gather and one host copy, so
+    call it every `log_interval` steps on every process.
+    """
+    def __init__(self, accelerator):
+        self.accelerator = accelerator
+        self.sums, self.counts = {}, {}
+
+    def update(self, **metrics):
+        for name, value in metrics.items():
+            if value is None:
+                continue
+            value = torch.as_tensor(value, device=self.accelerator.device).detach().float()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reduce(self):
+        if not self.sums:
+            return {}
+        names = sorted(self.sums)
+        means = torch.stack([self.sums[name] / self.counts[name] for name in names])
+        means = self.accelerator.gather(means[None]).mean(dim=0).tolist()
+        self.sums, self.counts = {}, {}
+        return dict(zip(names, means))
+
+
+class GenerationManifest:
+    """
+    Record of the finished items of a sharded generation job in `job_dir`, one JSON line per item.
+
+    Every shard appends to its own `manifest_{shard}-of-{num_shards}.jsonl`; entries are written a batch at a time,
+    flushed and fsync'ed, so a crash loses at most the batch being written. A torn last line is cut off on open.
+    All manifests in `job_dir` are read back, so a job can be restarted with a different number of shards.
+
+    `params` (JSON-serializable dict: seed, prompt file hash, sampler settings, ...) is stored as the job header
+    `job.json` by the first run; a restart with different params raises instead of mixing outputs of both settings.
+    """
+    HEADER = 'job.json'
+
+    def __init__(self, job_dir, shard_id=0, num_shards=1, params=None):
+        self.job_dir = job_dir
+        os.makedirs(job_dir, exist_ok=True)
+        if params is not None:
+            self._check_header(params)
+        self.path = os.path.join(job_dir, f'manifest_{shard_id:05d}-of-{num_shards:05d}.jsonl')
+        self._repair(self.path)
+        self.done = {}
+        for path in sorted(glob.glob(os.path.join(job_dir, 'manifest_*.jsonl'))):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:      # torn line of a shard that is still running
+                        continue
+                    self.done[entry['id']] = entry
+
+    def _check_header(self, params):
+        params = json.loads(json.dumps(params))     # as it reads back, e.g. tuples as lists
+        path = os.path.join(self.job_dir, self.HEADER)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                stored = json.load(f)
+            changed = sorted(k for k in set(stored) | set(params) if stored.get(k) != params.get(k))
+            if changed:
+                raise ValueError(f'{self.job_dir} was started with other settings, refusing to resume: '
+                                 + ', '.join(f'{k}: {stored.get(k)!r} -> {params.get(k)!r}' for k in changed))
+            return
+        # every shard may get here first; they write the same content and the rename is atomic
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(params, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _repair(path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def is_done(self, item_id, seed=None):
+        """Whether `item_id` has an output on disk, generated with `seed` if given."""
+        entry = self.done.get(item_id)
+        return (entry is not None and (seed is None or entry['seed'] == seed)
+                and os.path.exists(os.path.join(self.job_dir, entry['path'])))
+
+    def add(self, entries):
+        """Appends `entries`, dicts with `id`, `seed` and `path` (relative to `job_dir`), in a single write."""
+        if not entries:
+            return
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        for entry in entries:
+            self.done[entry['id']] = entry
+
+
 class DebugUnderflowOverflow:
     """
     This debug class helps detect and understand where the model starts getting very large or very small, and more
@@ -6,19 +6,30 @@ sys.path.insert(0, str(current_file_path.parent.parent))
 import warnings
 warnings.filterwarnings("ignore")  # ignore warning
 import re
+import hashlib
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from queue import Queue
 from tqdm import tqdm
 import torch
 from torchvision.utils import save_image
 from diffusers.models import AutoencoderKL
+from transformers import T5Config
 
-from diffusion.model.utils import prepare_prompt_ar
+from diffusion.model.utils import prepare_prompt_ar, group_prompts_by_ratio, StackedRandomGenerator
 from diffusion import IDDPM, DPMS, SASolverSampler
-from tools.download import find_model
-from diffusion.model.nets import PixArtMS_XL_2, PixArt_XL_2
-from diffusion.model.t5 import T5Embedder
-from diffusion.data.datasets import get_chunks, ASPECT_RATIO_512_TEST, ASPECT_RATIO_1024_TEST
+from tools.download import find_model_path
+from diffusion.model.builder import build_model
+from diffusion.model.nets import PixArtMS, PixArt
+from diffusion.model.nets.PixArt_blocks import ATTENTION_BACKENDS, set_attention_backend
+from diffusion.model.t5 import T5Embedder, TINY_T5_CONFIG
+from diffusion.model.prompt_cache import PromptEmbeddingCache
+from diffusion.data.datasets import ASPECT_RATIO_512_TEST, ASPECT_RATIO_1024_TEST
+from diffusion.utils.checkpoint import load_model_weights
+from diffusion.utils.misc import StageTimer, GenerationManifest
 
 
 def get_args():
@@ -29,12 +40,30 @@ def get_args():
     parser.add_argument('--txt_file', default='asset/samples.txt', type=str)
     parser.add_argument('--model_path', default='output/pretrained_models/PixArt-XL-2-1024x1024.pth', type=str)
     parser.add_argument('--bs', default=1, type=int)
+    parser.add_argument('--group_window', default=8, type=int, help='batches of prompts regrouped by aspect-ratio bucket at a time')
     parser.add_argument('--cfg_scale', default=4.5, type=float)
     parser.add_argument('--sampling_algo', default='dpm-solver', type=str, choices=['iddpm', 'dpm-solver', 'sa-solver'])
     parser.add_argument('--seed', default=0, type=int)
     parser.add_argument('--dataset', default='custom', type=str)
     parser.add_argument('--step', default=-1, type=int)
     parser.add_argument('--save_name', default='test_sample', type=str)
+    parser.add_argument('--prompt_cache_mb', default=1024, type=int, help='memory budget of the prompt embedding cache')
+    parser.add_argument('--prompt_cache_dir', default=None, type=str, help='optional on-disk tier of the prompt embedding cache')
+    parser.add_argument('--guidance_interval', default=None, type=float, nargs=2, metavar=('T_MIN', 'T_MAX'),
+                        help='dpm-solver/sa-solver: apply CFG only for continuous times in [T_MIN, T_MAX] (1 is pure noise)')
+    parser.add_argument('--image_format', default='jpg', type=str, choices=['jpg', 'png'])
+    parser.add_argument('--stream', action='store_true', help='pipelined mode: read/encode, denoise/decode and save run concurrently')
+    parser.add_argument('--prefetch_batches', default=4, type=int, help='--stream: encoded batches queued ahead of the sampler')
+    parser.add_argument('--num_writers', default=4, type=int, help='--stream: threads encoding and writing images')
+    parser.add_argument('--job_dir', default=None, type=str,
+                        help='resumable batch job: images are named by prompt line number and recorded in a manifest here')
+    parser.add_argument('--num_shards', default=int(os.environ.get('WORLD_SIZE', 1)), type=int, help='--job_dir: number of workers')
+    parser.add_argument('--shard_id', default=int(os.environ.get('RANK', 0)), type=int, help='--job_dir: this worker, takes lines shard_id::num_shards')
+    parser.add_argument('--attention', default=None, type=str, choices=ATTENTION_BACKENDS,
+                        help='attention backend (default: $PIXART_ATTENTION_BACKEND or auto, i.e. xformers on GPU if installed, else torch sdpa)')
+    parser.add_argument('--token_merging', default=0., type=float, metavar='RATIO',
+                        help='merge this fraction of the image tokens before self-attention and MLP in every block (ToMe)')
+    parser.add_argument('--tiny', action='store_true', help='random-weight tiny PixArt, T5 and VAE, e.g. to test the pipeline on CPU')
 
     return parser.parse_args()
 
@@ -46,88 +75,230 @@ def set_env(seed=0):
         torch.randn(1, 4, args.image_size, args.image_size)
 
 
+def plan_batches(chunk, bs):
+    """
+    Cleaned prompts of `chunk` and its batches `(indices, hw, ar)`, with the image size `hw` (1, 2) and aspect ratio `ar`
+    (1, 1) of each batch. Every prompt is parsed once; at 1024px batches are grouped by aspect-ratio bucket and take its
+    size, per-prompt `--ar`/`--hw` need the multi-scale model.
+    """
+    parsed = [prepare_prompt_ar(prompt, base_ratios, show=False) for prompt in chunk]
+    prompts = [prompt_clean.strip() for prompt_clean, *_ in parsed]
+    if args.image_size == 1024:
+        batches = []
+        for indices in group_prompts_by_ratio([default_hw for _, _, default_hw, _, _ in parsed], bs):
+            _, _, hw, ar, _ = parsed[indices[0]]    # ar for aspect ratio, shared by the bucket
+            batches.append((indices, hw.to(device), ar.to(device)))
+        return prompts, batches
+    hw = torch.tensor([[args.image_size, args.image_size]], dtype=torch.float, device=device)
+    ar = torch.tensor([[1.]], device=device)
+    return prompts, [(list(range(i, min(i + bs, len(chunk)))), hw, ar) for i in range(0, len(chunk), bs)]
+
+
+@torch.inference_mode()
+def encode_prompts(prompts):
+    caption_embs, emb_masks = prompt_cache(prompts)
+    return caption_embs.float()[:, None], emb_masks
+
+
+@torch.inference_mode()
+def sample_batch(caption_embs, emb_masks, hw, ar, seeds, sample_steps, cfg_scale):
+    """
+    Denoise one batch of encoded prompts that share the image size `hw` (1, 2) and aspect ratio `ar` (1, 1).
+    All noise of a sample comes from its own seed, so its output does not depend on the batch it runs in.
+    """
+    n = len(caption_embs)
+    hw, ar = hw.repeat(n, 1), ar.repeat(n, 1)
+    latent_size_h, latent_size_w = int(hw[0, 0] // 8), int(hw[0, 1] // 8)
+    null_y = model.y_embedder.y_embedding[None].repeat(n, 1, 1)[:, None]
+
+    with torch.no_grad():
+        if args.sampling_algo == 'iddpm':
+            # Create sampling noise:
+            # both CFG halves of a sample draw the same noise from its seed
+            rnd = StackedRandomGenerator(device, list(seeds) * 2)
+            z = rnd.randn((2 * n, 4, latent_size_h, latent_size_w), device=device)
+            model_kwargs = dict(y=torch.cat([caption_embs, null_y]),
+                                cfg_scale=cfg_scale, data_info={'img_hw': hw, 'aspect_ratio': ar}, mask=emb_masks)
+            diffusion = IDDPM(str(sample_steps))
+            # Sample images:
+            samples = diffusion.p_sample_loop(
+                model.forward_with_cfg, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True,
+                device=device, randn_like=rnd.randn_like
+            )
+            samples, _ = samples.chunk(2, dim=0)  # Remove null class samples
+        elif args.sampling_algo == 'dpm-solver':
+            # Create sampling noise:
+            z = StackedRandomGenerator(device, seeds).randn((n, 4, latent_size_h, latent_size_w), device=device)
+            model_kwargs = dict(data_info={'img_hw': hw, 'aspect_ratio': ar}, mask=emb_masks)
+            dpm_solver = DPMS(model.forward_with_dpmsolver,
+                              condition=caption_embs,
+                              uncondition=null_y,
+                              cfg_scale=cfg_scale,
+                              model_kwargs=model_kwargs,
+                              guidance_interval=args.guidance_interval)
+            samples = dpm_solver.sample(
+                z,
+                steps=sample_steps,
+                order=2,
+                skip_type="time_uniform",
+                method="multistep",
+            )
+            for k, v in dpm_solver.guidance_stats.items():
+                guidance_stats[k] += v
+        elif args.sampling_algo == 'sa-solver':
+            # Create sampling noise:
+            model_kwargs = dict(data_info={'img_hw': hw, 'aspect_ratio': ar}, mask=emb_masks)
+            sa_solver = SASolverSampler(model.forward_with_dpmsolver, device=device)
+            samples = sa_solver.sample(
+                S=25,
+                batch_size=n,
+                shape=(4, latent_size_h, latent_size_w),
+                eta=1,
+                conditioning=caption_embs,
+                unconditional_conditioning=null_y,
+                unconditional_guidance_scale=cfg_scale,
+                model_kwargs=model_kwargs,
+                guidance_interval=args.guidance_interval,
+                seeds=seeds,
+            )[0]
+            for k, v in sa_solver.guidance_stats.items():
+                guidance_stats[k] += v
+    return samples
+
+
+@torch.inference_mode()
+def decode_samples(samples):
+    return vae.decode(samples / 0.18215).sample
+
+
+def save_sample(sample, name):
+    save_path = os.path.join(save_root, f"{name}.{args.image_format}")
+    save_image(sample, save_path, nrow=1, normalize=True, value_range=(-1, 1))
+    return save_path
+
+
+@torch.inference_mode()
+def visualize(items, bs, sample_steps, cfg_scale, names=None, on_saved=None, seeds=None):
+    # Prompts of a window of `group_window` batches are regrouped by aspect-ratio bucket, so mixed-ratio prompt files
+    # still run full batches; the samples are scattered back and saved in input order.
+    # Images are named by `names` (default: the first 100 characters of the prompt); `on_saved(indices, paths)` is
+    # called with the item indices and paths of every saved window. Item i is sampled with `seeds[i]` (default: seed + i).
+    seeds = seeds if seeds is not None else [seed + i for i in range(len(items))]
+    window = bs * args.group_window
+    with tqdm(total=len(items), unit='prompt') as pbar:
+        for start in range(0, len(items), window):
+            chunk = items[start:start + window]
+            prompts, batches = plan_batches(chunk, bs)
+            samples = [None] * len(chunk)
+            for indices, hw, ar in batches:
+                caption_embs, emb_masks = encode_prompts([prompts[i] for i in indices])
+                latents = sample_batch(caption_embs, emb_masks, hw, ar, [seeds[start + i] for i in indices], sample_steps, cfg_scale)
+                for i, sample in zip(indices, decode_samples(latents)):
+                    samples[i] = sample
+                pbar.update(len(indices))
+            torch.cuda.empty_cache()
+            # Save images:
+            os.umask(0o000)  # file permission: 666; dir permission: 777
+            chunk_names = names[start:start + window] if names is not None else [prompt[:100] for prompt in prompts]
+            paths = []
+            for name, sample in zip(chunk_names, samples):
+                paths.append(save_sample(sample, name))
+                print("Saving path: ", paths[-1])
+            if on_saved is not None:
+                on_saved(range(start, start + len(chunk)), paths)
+
+
+def run_job(bs, sample_steps, cfg_scale):
+    """
+    Resumable batch generation over a large prompt file. Prompt `i` (its line number) belongs to shard
+    `i % num_shards` and is saved as `{i:08d}.{image_format}` in `--job_dir`; finished prompts are recorded in the
+    shard's manifest and skipped on restart. The job refuses to resume with a different prompt file or settings.
+    """
+    with open(args.txt_file, 'rb') as f:
+        txt_sha1 = hashlib.sha1(f.read()).hexdigest()
+    params = dict(txt_file_sha1=txt_sha1, seed=seed, model_path=args.model_path, tiny=args.tiny, image_size=args.image_size,
+                  sampling_algo=args.sampling_algo, sample_steps=sample_steps, cfg_scale=cfg_scale,
+                  guidance_interval=args.guidance_interval, token_merging=args.token_merging, image_format=args.image_format)
+    manifest = GenerationManifest(args.job_dir, args.shard_id, args.num_shards, params=params)
+    ids, items = [], []
+    with open(args.txt_file, 'r') as f:
+        for i, line in enumerate(f):
+            if i % args.num_shards == args.shard_id and not manifest.is_done(i, seed=seed + i):
+                ids.append(i)
+                items.append(line.strip())
+    print(f'Shard {args.shard_id}/{args.num_shards}: {len(items)} prompts left, {len(manifest.done)} done in {args.job_dir}')
+
+    def on_saved(indices, paths):
+        manifest.add([dict(id=ids[i], seed=seeds[i], path=os.path.basename(path)) for i, path in zip(indices, paths)])
+
+    seeds = [seed + i for i in ids]     # by line number, so outputs do not depend on the sharding or batching
+    visualize(items, bs, sample_steps, cfg_scale, names=[f'{i:08d}' for i in ids], on_saved=on_saved, seeds=seeds)
+
+
+def read_prompts(txt_file):
+    with open(txt_file, 'r') as f:
+        for line in f:
+            yield line.strip()
+
+
+def encode_worker(prompts_iter, bs, q):
+    """Producer stage: reads the prompt file and text-encodes the upcoming batches while the sampler is busy."""
+    try:
+        with torch.inference_mode():
+            offset = 0
+            while True:
+                chunk = list(islice(prompts_iter, bs * args.group_window))
+                if not chunk:
+                    break
+                prompts, batches = plan_batches(chunk, bs)
+                for indices, hw, ar in batches:
+                    batch_prompts = [prompts[i] for i in indices]
+                    with stage_timer('encode', len(indices)):
+                        caption_embs, emb_masks = encode_prompts(batch_prompts)
+                    q.put((batch_prompts, hw, ar, caption_embs, emb_masks, [seed + offset + i for i in indices]))
+                offset += len(chunk)
+        q.put(None)
+    except BaseException as e:
+        q.put(e)
+
+
+def timed_save(sample, prompt):
+    with stage_timer('save'):
+        return save_sample(sample, prompt[:100])
+
+
 @torch.inference_mode()
-def visualize(items, bs, sample_steps, cfg_scale):
-
-    for chunk in tqdm(list(get_chunks(items, bs)), unit='batch'):
-
-        prompts = []
-        if bs == 1:
-            prompt_clean, _, hw, ar, custom_hw = prepare_prompt_ar(chunk[0], base_ratios, device=device, show=False)  # ar for aspect ratio
-            if args.image_size == 1024:
-                latent_size_h, latent_size_w = int(hw[0, 0] // 8), int(hw[0, 1] // 8)
-            else:
-                hw = torch.tensor([[args.image_size, args.image_size]], dtype=torch.float, device=device).repeat(bs, 1)
-                ar = torch.tensor([[1.]], device=device).repeat(bs, 1)
-                latent_size_h, latent_size_w = latent_size, latent_size
-            prompts.append(prompt_clean.strip())
-        else:
-            hw = torch.tensor([[args.image_size, args.image_size]], dtype=torch.float, device=device).repeat(bs, 1)
-            ar = torch.tensor([[1.]], device=device).repeat(bs, 1)
-            for prompt in chunk:
-                prompts.append(prepare_prompt_ar(prompt, base_ratios, device=device, show=False)[0].strip())
-            latent_size_h, latent_size_w = latent_size, latent_size
-
-        null_y = model.y_embedder.y_embedding[None].repeat(len(prompts), 1, 1)[:, None]
-
-        with torch.no_grad():
-            caption_embs, emb_masks = t5.get_text_embeddings(prompts)
-            caption_embs = caption_embs.float()[:, None]
-            print('finish embedding')
-
-            if args.sampling_algo == 'iddpm':
-                # Create sampling noise:
-                n = len(prompts)
-                z = torch.randn(n, 4, latent_size_h, latent_size_w, device=device).repeat(2, 1, 1, 1)
-                model_kwargs = dict(y=torch.cat([caption_embs, null_y]),
-                                    cfg_scale=cfg_scale, data_info={'img_hw': hw, 'aspect_ratio': ar}, mask=emb_masks)
-                diffusion = IDDPM(str(sample_steps))
-                # Sample images:
-                samples = diffusion.p_sample_loop(
-                    model.forward_with_cfg, z.shape, z, clip_denoised=False, model_kwargs=model_kwargs, progress=True,
-                    device=device
-                )
-                samples, _ = samples.chunk(2, dim=0)  # Remove null class samples
-            elif args.sampling_algo == 'dpm-solver':
-                # Create sampling noise:
-                n = len(prompts)
-                z = torch.randn(n, 4, latent_size_h, latent_size_w, device=device)
-                model_kwargs = dict(data_info={'img_hw': hw, 'aspect_ratio': ar}, mask=emb_masks)
-                dpm_solver = DPMS(model.forward_with_dpmsolver,
-                                  condition=caption_embs,
-                                  uncondition=null_y,
-                                  cfg_scale=cfg_scale,
-                                  model_kwargs=model_kwargs)
-                samples = dpm_solver.sample(
-                    z,
-                    steps=sample_steps,
-                    order=2,
-                    skip_type="time_uniform",
-                    method="multistep",
-                )
-            elif args.sampling_algo == 'sa-solver':
-                # Create sampling noise:
-                n = len(prompts)
-                model_kwargs = dict(data_info={'img_hw': hw, 'aspect_ratio': ar}, mask=emb_masks)
-                sa_solver = SASolverSampler(model.forward_with_dpmsolver, device=device)
-                samples = sa_solver.sample(
-                    S=25,
-                    batch_size=n,
-                    shape=(4, latent_size_h, latent_size_w),
-                    eta=1,
-                    conditioning=caption_embs,
-                    unconditional_conditioning=null_y,
-                    unconditional_guidance_scale=cfg_scale,
-                    model_kwargs=model_kwargs,
-                )[0]
-        samples = vae.decode(samples / 0.18215).sample
-        torch.cuda.empty_cache()
-        # Save images:
-        os.umask(0o000)  # file permission: 666; dir permission: 777
-        for i, sample in enumerate(samples):
-            save_path = os.path.join(save_root, f"{prompts[i][:100]}.jpg")
-            print("Saving path: ", save_path)
-            save_image(sample, save_path, nrow=1, normalize=True, value_range=(-1, 1))
+def stream_visualize(bs, sample_steps, cfg_scale):
+    """
+    Pipelined `visualize` over a prompt file of any length: a producer thread reads and text-encodes upcoming
+    batches, this thread denoises and decodes, and a thread pool encodes and writes the images. Reports the
+    throughput of every stage and how much they overlapped.
+    """
+    q = Queue(maxsize=args.prefetch_batches)
+    threading.Thread(target=encode_worker, args=(read_prompts(args.txt_file), bs, q), daemon=True).start()
+    os.umask(0o000)  # file permission: 666; dir permission: 777
+    pending = []
+    with ThreadPoolExecutor(args.num_writers) as pool, tqdm(unit='prompt') as pbar:
+        while True:
+            batch = q.get()
+            if batch is None:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            prompts, hw, ar, caption_embs, emb_masks, seeds = batch
+            with stage_timer('denoise', len(prompts)):
+                latents = sample_batch(caption_embs, emb_masks, hw, ar, seeds, sample_steps, cfg_scale)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+            with stage_timer('decode', len(prompts)):
+                samples = decode_samples(latents).cpu()
+            pending.extend(pool.submit(timed_save, sample, prompt) for sample, prompt in zip(samples, prompts))
+            while len(pending) > 4 * args.num_writers:      # bound the decoded images held in memory
+                pending.pop(0).result()
+            pbar.update(len(prompts))
+        for future in pending:
+            future.result()
+    print(stage_timer.report())
 
 
 if __name__ == '__main__':
@@ -136,6 +307,10 @@ if __name__ == '__main__':
     seed = args.seed
     set_env(seed)
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.attention is not None:
+        set_attention_backend(args.attention)
+    if torch.cuda.is_available() and 'LOCAL_RANK' in os.environ:     # one shard per GPU under torchrun
+        torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
     assert args.sampling_algo in ['iddpm', 'dpm-solver', 'sa-solver']
 
     # only support fixed latent size currently
@@ -143,34 +318,41 @@ if __name__ == '__main__':
     lewei_scale = {512: 1, 1024: 2}     # trick for positional embedding interpolation
     sample_steps_dict = {'iddpm': 100, 'dpm-solver': 20, 'sa-solver': 25}
     sample_steps = args.step if args.step != -1 else sample_steps_dict[args.sampling_algo]
-    weight_dtype = torch.float16
+    weight_dtype = torch.float32 if args.tiny else torch.float16
     print(f"Inference with {weight_dtype}")
 
     # model setting
-    if args.image_size == 512:
-        model = PixArt_XL_2(input_size=latent_size, lewei_scale=lewei_scale[args.image_size]).to(device)
+    if args.tiny:
+        # random weights, sized to exercise the whole pipeline quickly on CPU
+        model_cls = PixArt if args.image_size == 512 else PixArtMS
+        model = model_cls(input_size=latent_size, lewei_scale=lewei_scale[args.image_size], depth=2, hidden_size=96, patch_size=2,
+                          num_heads=4, caption_channels=TINY_T5_CONFIG['d_model']).to(device)
     else:
-        model = PixArtMS_XL_2(input_size=latent_size, lewei_scale=lewei_scale[args.image_size]).to(device)
-
-    print(f"Generating sample from ckpt: {args.model_path}")
-    state_dict = find_model(args.model_path)
-    del state_dict['state_dict']['pos_embed']
-    missing, unexpected = model.load_state_dict(state_dict['state_dict'], strict=False)
-    print('Missing keys: ', missing)
-    print('Unexpected keys', unexpected)
+        # the weights are neither allocated nor initialized here: they are mapped from the checkpoint and read once,
+        # by the `.to` below
+        model = build_model('PixArt_XL_2' if args.image_size == 512 else 'PixArtMS_XL_2', init_weights=False, device='meta',
+                            input_size=latent_size, lewei_scale=lewei_scale[args.image_size])
+        print(f"Generating sample from ckpt: {args.model_path}")
+        missing, unexpected = load_model_weights(find_model_path(args.model_path), model)
+        print('Missing keys: ', missing)
+        print('Unexpected keys', unexpected)
     model.eval()
-    model.to(weight_dtype)
+    model.to(device, weight_dtype)
+    if args.token_merging:
+        model.set_token_merging([dict(ratio=args.token_merging)])
     base_ratios = eval(f'ASPECT_RATIO_{args.image_size}_TEST')
 
-    vae = AutoencoderKL.from_pretrained(args.tokenizer_path).to(device)
-    t5 = T5Embedder(device="cuda", local_cache=True, cache_dir=args.t5_path, torch_dtype=torch.float)
+    if args.tiny:
+        vae = AutoencoderKL(down_block_types=('DownEncoderBlock2D',) * 4, up_block_types=('UpDecoderBlock2D',) * 4,
+                            block_out_channels=(32,) * 4, layers_per_block=1, latent_channels=4).to(device)
+        t5 = T5Embedder.from_config(T5Config(**TINY_T5_CONFIG), os.path.join(args.t5_path, 't5-v1_1-xxl'), device=device)
+    else:
+        vae = AutoencoderKL.from_pretrained(args.tokenizer_path).to(device)
+        t5 = T5Embedder(device="cuda", local_cache=True, cache_dir=args.t5_path, torch_dtype=torch.float)
+    prompt_cache = PromptEmbeddingCache.for_t5(t5, max_bytes=args.prompt_cache_mb << 20, disk_dir=args.prompt_cache_dir)
     work_dir = os.path.join(*args.model_path.split('/')[:-2])
     work_dir = f'/{work_dir}' if args.model_path[0] == '/' else work_dir
 
-    # data setting
-    with open(args.txt_file, 'r') as f:
-        items = [item.strip() for item in f.readlines()]
-
     # img save setting
     try:
         epoch_name = re.search(r'.*epoch_(\d+).*.pth', args.model_path).group(1)
@@ -182,6 +364,21 @@ if __name__ == '__main__':
     os.umask(0o000)  # file permission: 666; dir permission: 777
     os.makedirs(img_save_dir, exist_ok=True)
 
-    save_root = os.path.join(img_save_dir, f"{datetime.now().date()}_{args.dataset}_epoch{epoch_name}_step{step_name}_scale{args.cfg_scale}_step{sample_steps}_size{args.image_size}_bs{args.bs}_samp{args.sampling_algo}_seed{seed}")
+    assert 0 <= args.shard_id < args.num_shards and not (args.job_dir and args.stream), 'bad --shard_id, or --job_dir with --stream'
+    save_root = args.job_dir or os.path.join(img_save_dir, f"{datetime.now().date()}_{args.dataset}_epoch{epoch_name}_step{step_name}_scale{args.cfg_scale}_step{sample_steps}_size{args.image_size}_bs{args.bs}_samp{args.sampling_algo}_seed{seed}")
     os.makedirs(save_root, exist_ok=True)
-    visualize(items, args.bs, sample_steps, args.cfg_scale)
\ No newline at end of file
+    guidance_stats = {'evals': 0, 'skipped': 0}
+    if args.job_dir is not None:
+        run_job(args.bs, sample_steps, args.cfg_scale)
+    elif args.stream:
+        stage_timer = StageTimer()
+        stream_visualize(args.bs, sample_steps, args.cfg_scale)
+    else:
+        # data setting
+        with open(args.txt_file, 'r') as f:
+            items = [item.strip() for item in f.readlines()]
+        visualize(items, args.bs, sample_steps, args.cfg_scale)
+    print(f'Prompt cache: {prompt_cache.stats()}')
+    if args.guidance_interval is not None:
+        print(f"Guidance interval {args.guidance_interval}: skipped {guidance_stats['skipped'] / max(guidance_stats['evals'] + guidance_stats['skipped'], 1):.1%} "
+              f"of the network evaluations per image")
\ No newline at end of file
@@ -14,11 +14,12 @@ from torchvision.utils import save_image
 from diffusers.models import AutoencoderKL
 
 from diffusion.model.utils import prepare_prompt_ar
-from tools.download import find_model
-from diffusion.model.nets import PixArtMS_XL_2, PixArt_XL_2
+from tools.download import find_model_path
+from diffusion.model.builder import build_model
 from diffusion.model.t5 import T5Embedder
 from diffusion.data.datasets import get_chunks
 from diffusion.lcm_scheduler import LCMScheduler
+from diffusion.utils.checkpoint import load_model_weights
 from diffusion.data.datasets import ASPECT_RATIO_512_TEST, ASPECT_RATIO_1024_TEST
 
 
@@ -117,17 +118,14 @@ if __name__ == '__main__':
     scheduler = LCMScheduler(beta_start=0.0001, beta_end=0.02, beta_schedule="linear", prediction_type="epsilon")
 
     # model setting
-    if args.image_size == 512:
-        model = PixArt_XL_2(input_size=latent_size, lewei_scale=lewei_scale[args.image_size]).to(device)
-    else:
-        model = PixArtMS_XL_2(input_size=latent_size, lewei_scale=lewei_scale[args.image_size]).to(device)
+    model = build_model('PixArt_XL_2' if args.image_size == 512 else 'PixArtMS_XL_2', init_weights=False, device='meta',
+                        input_size=latent_size, lewei_scale=lewei_scale[args.image_size])
 
     print(f"Generating sample from ckpt: {args.model_path}")
-    state_dict = find_model(args.model_path)
-    del state_dict['state_dict']['pos_embed']
-    missing, unexpected = model.load_state_dict(state_dict['state_dict'], strict=False)
+    missing, unexpected = load_model_weights(find_model_path(args.model_path), model)
     print('Missing keys: ', missing)
     print('Unexpected keys', unexpected)
+    model.to(device)
     model.eval()
     base_ratios = eval(f'ASPECT_RATIO_{args.image_size}_TEST')
 
@@ -9,15 +9,16 @@ import torch
 from torchvision.utils import save_image
 from diffusion import IDDPM, DPMS, SASolverSampler
 from diffusers.models import AutoencoderKL
-from tools.download import find_model
+from tools.download import find_model_path
 from datetime import datetime
 from typing import List, Union
 import gradio as gr
 import numpy as np
 from gradio.components import Textbox, Image
 from diffusion.model.utils import prepare_prompt_ar, resize_and_crop_tensor
-from diffusion.model.nets import PixArtMS_XL_2, PixArt_XL_2
+from diffusion.model.builder import build_model
 from diffusion.model.t5 import T5Embedder
+from diffusion.utils.checkpoint import load_model_weights
 from torchvision.utils import _log_api_usage_once, make_grid
 from diffusion.data.datasets import ASPECT_RATIO_512_TEST, ASPECT_RATIO_1024_TEST
 from asset.examples import examples
@@ -143,15 +144,13 @@ if __name__ == '__main__':
     lewei_scale = {512: 1, 1024: 2}
     latent_size = args.image_size // 8
     t5_device = {512: 'cuda', 1024: 'cuda'}
-    if args.image_size == 512:
-        model = PixArt_XL_2(input_size=latent_size, lewei_scale=lewei_scale[args.image_size]).to(device)
-    else:
-        model = PixArtMS_XL_2(input_size=latent_size, lewei_scale=lewei_scale[args.image_size]).to(device)
-    state_dict = find_model(args.model_path)
-    del state_dict['state_dict']['pos_embed']
-    missing, unexpected = model.load_state_dict(state_dict['state_dict'], strict=False)
+    # the weights are mapped from the checkpoint instead of being allocated and initialized first
+    model = build_model('PixArt_XL_2' if args.image_size == 512 else 'PixArtMS_XL_2', init_weights=False, device='meta',
+                        input_size=latent_size, lewei_scale=lewei_scale[args.image_size])
+    missing, unexpected = load_model_weights(find_model_path(args.model_path), model)
     logger.warning(f'Missing keys: {missing}')
     logger.warning(f'Unexpected keys: {unexpected}')
+    model.to(device)
     model.eval()
     base_ratios = eval(f'ASPECT_RATIO_{args.image_size}_TEST')
 
@@ -19,12 +19,14 @@ from torchvision.utils import _log_api_usage_once, make_grid, save_image
 from diffusion import IDDPM, DPMS, SASolverSampler
 from diffusion.data.datasets import *
 from diffusion.model.hed import HEDdetector
-from diffusion.model.nets import PixArtMS_XL_2, ControlPixArtHalf, ControlPixArtMSHalf
+from diffusion.model.builder import build_model
+from diffusion.model.nets import ControlPixArtHalf, ControlPixArtMSHalf
 from diffusion.model.t5 import T5Embedder
 from diffusion.model.utils import prepare_prompt_ar, resize_and_crop_tensor
+from diffusion.utils.checkpoint import load_model_weights
 from diffusion.utils.misc import read_config
 from diffusers.models import AutoencoderKL
-from tools.download import find_model
+from tools.download import find_model_path
 
 vae_scale = 0.18215
 
@@ -183,24 +185,20 @@ if __name__ == '__main__':
     weight_dtype = torch.float16
     print(f"Inference with {weight_dtype}")
 
-    model = PixArtMS_XL_2(input_size=latent_size, lewei_scale=lewei_scale[args.image_size])
+    # the base model and its copied blocks are filled straight from the checkpoint
+    model = build_model('PixArtMS_XL_2', init_weights=False, device='meta', input_size=latent_size, lewei_scale=lewei_scale[args.image_size])
     if config.image_size == 512:
         print('model architecture ControlPixArtHalf and image size is 512')
-        model = ControlPixArtHalf(model).to(device)
+        model = ControlPixArtHalf(model)
     elif config.image_size == 1024:
         print('model architecture ControlPixArtMSHalf and image size is 1024')
-        model = ControlPixArtMSHalf(model).to(device)
-
-    state_dict = find_model(args.model_path)['state_dict']
-    if 'pos_embed' in state_dict:
-        del state_dict['pos_embed']
-    elif 'base_model.pos_embed' in state_dict:
-        del state_dict['base_model.pos_embed']
-    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+        model = ControlPixArtMSHalf(model)
+
+    missing, unexpected = load_model_weights(find_model_path(args.model_path), model)
     print('Missing keys (missing pos_embed is normal): ', missing)
     print('Unexpected keys', unexpected)
     model.eval()
-    model.to(weight_dtype)
+    model.to(device, weight_dtype)
     display_model_info = f'model path: {args.model_path},\n base image size: {args.image_size}'
     base_ratios = eval(f'ASPECT_RATIO_{args.image_size}_TEST')
 
@@ -0,0 +1,114 @@
+"""
+Allocations and peak activation memory of one PixArtMS block on CPU, before and after fusing the adaLN-single
+modulation.
+
+"unfused" replays the previous block forward (separate norm, modulate, gate and residual ops); "fused" is
+`PixArtMSBlock.forward`, which runs norm+modulate and gate+residual in place outside autograd. Every tensor a
+block allocates is counted with a dispatch mode, which also tracks the peak of the live intermediates.
+
+Usage:
+    python tools/benchmarks/adaln_fusion.py --image_size 1024 --batch_size 2
+"""
+import argparse
+import sys
+import time
+import weakref
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from diffusion.model.nets import PixArtMSBlock
+from diffusion.model.nets.PixArt_blocks import t2i_modulate
+
+
+class AllocationTracker(TorchDispatchMode):
+    """Counts the new storages created by aten ops and the peak bytes of those alive at the same time."""
+    def __init__(self):
+        super().__init__()
+        self.count, self.live, self.peak = 0, 0, 0
+        self._refs = {}
+
+    def _release(self, ptr):
+        self._refs[ptr][0] -= 1
+        if self._refs[ptr][0] == 0:
+            self.live -= self._refs.pop(ptr)[1]
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            if not isinstance(t, torch.Tensor):
+                continue
+            ptr = t.untyped_storage().data_ptr()
+            if ptr not in inputs and ptr not in self._refs:
+                nbytes = t.untyped_storage().nbytes()
+                self._refs[ptr] = [0, nbytes]
+                self.count += 1
+                self.live += nbytes
+                self.peak = max(self.peak, self.live)
+            if ptr in self._refs:
+                self._refs[ptr][0] += 1
+                weakref.finalize(t, self._release, ptr)
+        return out
+
+
+def unfused_forward(block, x, y, t, mask=None):
+    B, N, C = x.shape
+    shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (block.scale_shift_table[None] + t.reshape(B, 6, -1)).chunk(6, dim=1)
+    x = x + block.drop_path(gate_msa * block.attn(t2i_modulate(block.norm1(x), shift_msa, scale_msa)))
+    x = x + block.cross_attn(x, y, mask)
+    x = x + block.drop_path(gate_mlp * block.mlp(t2i_modulate(block.norm2(x), shift_mlp, scale_mlp)))
+    return x
+
+
+def measure(fn, repeats):
+    tracker = AllocationTracker()
+    with tracker:
+        out = fn()
+    count, peak = tracker.count, tracker.peak
+    del out
+    t_best = float('inf')
+    for _ in range(repeats):
+        t = time.time()
+        fn()
+        t_best = min(t_best, time.time() - t)
+    return count, peak, t_best
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', default=1024, type=int)
+    parser.add_argument('--batch_size', default=2, type=int, help='e.g. 2 for one image with classifier-free guidance')
+    parser.add_argument('--hidden_size', default=1152, type=int)
+    parser.add_argument('--num_heads', default=16, type=int)
+    parser.add_argument('--caption_tokens', default=120, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(0)
+    num_tokens = (args.image_size // 8 // 2) ** 2
+    block = PixArtMSBlock(args.hidden_size, args.num_heads).eval()
+    x = torch.randn(args.batch_size, num_tokens, args.hidden_size)
+    y = torch.randn(1, args.batch_size * args.caption_tokens, args.hidden_size)
+    t = torch.randn(args.batch_size, 6 * args.hidden_size)
+    mask = [args.caption_tokens] * args.batch_size
+
+    with torch.inference_mode():
+        ref = unfused_forward(block, x, y, t, mask)
+        out = block(x, y, t, mask)
+        print(f'max abs diff fused vs unfused: {(out - ref).abs().max().item():.2e}')
+        del ref, out
+        results = {'unfused': measure(lambda: unfused_forward(block, x, y, t, mask), args.repeats),
+                   'fused': measure(lambda: block(x, y, t, mask), args.repeats)}
+
+    act_mb = x.numel() * x.element_size() / 2 ** 20
+    print(f'{args.batch_size}x{num_tokens} tokens x {args.hidden_size} channels, one (B, N, C) activation = {act_mb:.1f} MB')
+    for name, (count, peak, t_best) in results.items():
+        print(f'{name:>8}: {count:3d} allocations, peak {peak / 2 ** 20:8.1f} MB, {t_best * 1e3:8.1f} ms/block')
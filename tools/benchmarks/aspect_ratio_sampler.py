@@ -0,0 +1,90 @@
+"""
+Epoch-start latency of AspectRatioBatchSampler on a synthetic multi-scale index.
+
+"legacy" replays the previous per-sample loop (get_data_info + min() over the ratio keys) on a subset and
+extrapolates to the full size; "vectorized" runs the current sampler on the full index.
+
+Usage:
+    python tools/benchmarks/aspect_ratio_sampler.py --num_samples 50000000 --batch_size 12
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import numpy as np
+from torch.utils.data import RandomSampler
+
+from diffusion.data.datasets.utils import ASPECT_RATIO_1024, get_closest_ratio_ids, sorted_ratio_keys
+from diffusion.utils.data_sampler import AspectRatioBatchSampler
+
+
+class SyntheticIndex:
+    def __init__(self, num_samples, seed=0):
+        rng = np.random.default_rng(seed)
+        self.width = rng.integers(512, 2048, num_samples, dtype=np.int32)
+        self.height = (self.width * np.exp(rng.normal(0, 0.4, num_samples))).clip(256, 4096).astype(np.int32)
+        self._bucket_ids = {}
+
+    def __len__(self):
+        return len(self.width)
+
+    def get_data_info(self, idx):
+        return {'height': int(self.height[idx]), 'width': int(self.width[idx])}
+
+    def get_bucket_ids(self, aspect_ratios):
+        key = tuple(sorted_ratio_keys(aspect_ratios))
+        if key not in self._bucket_ids:
+            self._bucket_ids[key] = get_closest_ratio_ids(self.height, self.width, aspect_ratios)
+        return self._bucket_ids[key]
+
+
+def legacy_epoch(dataset, indices, batch_size, aspect_ratios):
+    buckets = {ratio: [] for ratio in aspect_ratios}
+    num_batches = 0
+    for idx in indices:
+        data_info = dataset.get_data_info(idx)
+        ratio = data_info['height'] / data_info['width']
+        closest_ratio = min(aspect_ratios.keys(), key=lambda r: abs(float(r) - ratio))
+        bucket = buckets[closest_ratio]
+        bucket.append(idx)
+        if len(bucket) == batch_size:
+            num_batches += 1
+            del bucket[:]
+    return num_batches
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_samples', default=50_000_000, type=int)
+    parser.add_argument('--legacy_samples', default=1_000_000, type=int, help='subset timed for the legacy loop')
+    parser.add_argument('--batch_size', default=12, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    t = time.time()
+    dataset = SyntheticIndex(args.num_samples)
+    print(f'synthetic index with {len(dataset):,} samples built in {time.time() - t:.2f}s')
+
+    ratio_nums = {float(k): 1 for k in ASPECT_RATIO_1024}
+    t = time.time()
+    sampler = AspectRatioBatchSampler(RandomSampler(dataset), dataset, args.batch_size, ASPECT_RATIO_1024,
+                                      drop_last=True, ratio_nums=ratio_nums)
+    t_init = time.time() - t
+    t = time.time()
+    batches = iter(sampler)
+    next(batches)
+    t_first = time.time() - t
+    num_batches = 1 + sum(1 for _ in batches)
+    t_epoch = time.time() - t
+    print(f'vectorized: bucket ids {t_init:.2f}s, first batch {t_first:.2f}s, full epoch {t_epoch:.2f}s ({num_batches:,} batches)')
+
+    subset = np.random.permutation(len(dataset))[:args.legacy_samples].tolist()
+    t = time.time()
+    legacy_epoch(dataset, subset, args.batch_size, ASPECT_RATIO_1024)
+    t_legacy = (time.time() - t) * len(dataset) / len(subset)
+    print(f'legacy: full epoch ~{t_legacy:.2f}s (extrapolated from {len(subset):,} samples)')
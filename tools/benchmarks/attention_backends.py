@@ -0,0 +1,72 @@
+"""
+Attention backends of the PixArt blocks: xformers, torch sdpa and the math fallback.
+
+Times the self-attention (`WindowAttention`) and the packed, variable-length caption cross-attention
+(`MultiHeadCrossAttention`) of one block with every backend available on the device, and checks their outputs
+against the math backend.
+
+Usage:
+    python tools/benchmarks/attention_backends.py --image_size 512 --batch_size 2 --device cpu
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import torch
+
+from diffusion.model.nets.PixArt_blocks import MultiHeadCrossAttention, WindowAttention, import_xformers, set_attention_backend
+
+
+def run(fn, device, repeats):
+    out = fn()
+    t_best = float('inf')
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t = time.time()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t_best = min(t_best, time.time() - t)
+    return out, t_best
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', default=512, type=int)
+    parser.add_argument('--batch_size', default=2, type=int)
+    parser.add_argument('--hidden_size', default=1152, type=int)
+    parser.add_argument('--num_heads', default=16, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--dtype', default='float32', type=str, choices=['float16', 'bfloat16', 'float32'])
+    parser.add_argument('--repeats', default=3, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    torch.manual_seed(0)
+    num_tokens = (args.image_size // 8 // 2) ** 2
+    attn = WindowAttention(args.hidden_size, num_heads=args.num_heads).to(device, dtype).eval()
+    cross_attn = MultiHeadCrossAttention(args.hidden_size, args.num_heads).to(device, dtype).eval()
+    x = torch.randn(args.batch_size, num_tokens, args.hidden_size, device=device, dtype=dtype)
+    y_lens = torch.randint(10, 121, (args.batch_size,)).tolist()     # captions of different lengths, packed
+    y = torch.randn(1, sum(y_lens), args.hidden_size, device=device, dtype=dtype)
+
+    backends = ['math', 'sdpa'] + (['xformers'] if import_xformers() is not None and device.type == 'cuda' else [])
+    print(f'{args.batch_size}x{num_tokens} tokens, {args.hidden_size} channels, {args.num_heads} heads, '
+          f'caption lengths {y_lens}, {args.dtype} on {device}')
+    ref = {}
+    with torch.inference_mode():
+        for backend in backends:
+            set_attention_backend(backend)
+            out_self, t_self = run(lambda: attn(x), device, args.repeats)
+            out_cross, t_cross = run(lambda: cross_attn(x, y, y_lens), device, args.repeats)
+            ref = ref or {'self': out_self, 'cross': out_cross}
+            err = max((out_self - ref['self']).abs().max().item(), (out_cross - ref['cross']).abs().max().item())
+            print(f'{backend:>9}: self-attn {t_self * 1e3:8.1f} ms, cross-attn {t_cross * 1e3:8.1f} ms, '
+                  f'max abs diff vs math {err:.2e}')
@@ -0,0 +1,203 @@
+"""
+Throughput and exactness of the precompiled caption cleaning in `diffusion.model.t5`.
+
+"legacy" is the previous implementation (re-compiling lookups, BeautifulSoup and ftfy on every caption), applied
+twice like `T5Embedder.text_preprocessing` did; "precompiled" is `preprocess_caption`, also timed through the
+process-pool batch API `clean_captions`. Every output must equal the legacy one.
+
+Usage:
+    python tools/benchmarks/caption_cleaning.py --captions data/InternData/partition/data_info.json --num_workers 8
+"""
+import argparse
+import html
+import json
+import re
+import sys
+import time
+import urllib.parse as ul
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import ftfy
+from bs4 import BeautifulSoup
+
+from diffusion.model.t5 import clean_captions, preprocess_caption
+
+LEGACY_BAD_PUNCT_REGEX = re.compile(r'['+'#®•©™&@·º½¾¿¡§~'+'\)'+'\('+'\]'+'\['+'\}'+'\{'+'\|'+'\\'+'\/'+'\*' + r']{1,}')  # noqa
+SAMPLE_CAPTIONS = [
+    'A photo of a <person> walking a dog, https://example.com/img_01.jpg',
+    'Visit www.shop.net/sale for FREE SHIPPING!!! #123 @artist_name',
+    '“Sunset” over the sea — oil painting, 4K, 3840x2160, page 12',
+    'this-is-my-cute-cat_in_the_garden',
+    '<b>Bold</b> &amp; beautiful &quot;flowers&quot; in a vase...',
+    '山水画 landscape with mountains and a river, 192.168.0.1',
+    'jc6640 jc6640vc 6640vc231 j2d1a2a product photo, download free png images',
+    "'Caféteria' in Paris, ﬁne art print, click for more",
+    'An astronaut riding a horse on the moon, highly detailed, 8k',
+    '   ***AUSVERKAUFT***   ',
+]
+
+
+def legacy_basic_clean(text):
+    text = ftfy.fix_text(text)
+    text = html.unescape(html.unescape(text))
+    return text.strip()
+
+
+def legacy_clean_caption(caption):
+    caption = str(caption)
+    caption = ul.unquote_plus(caption)
+    caption = caption.strip().lower()
+    caption = re.sub('<person>', 'person', caption)
+    # urls:
+    caption = re.sub(
+        r'\b((?:https?:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))',  # noqa
+        '', caption)  # regex for urls
+    caption = re.sub(
+        r'\b((?:www:(?:\/{1,3}|[a-zA-Z0-9%])|[a-zA-Z0-9.\-]+[.](?:com|co|ru|net|org|edu|gov|it)[\w/-]*\b\/?(?!@)))',  # noqa
+        '', caption)  # regex for urls
+    # html:
+    caption = BeautifulSoup(caption, features='html.parser').text
+
+    # @<nickname>
+    caption = re.sub(r'@[\w\d]+\b', '', caption)
+
+    # 31C0—31EF CJK Strokes
+    # 31F0—31FF Katakana Phonetic Extensions
+    # 3200—32FF Enclosed CJK Letters and Months
+    # 3300—33FF CJK Compatibility
+    # 3400—4DBF CJK Unified Ideographs Extension A
+    # 4DC0—4DFF Yijing Hexagram Symbols
+    # 4E00—9FFF CJK Unified Ideographs
+    caption = re.sub(r'[\u31c0-\u31ef]+', '', caption)
+    caption = re.sub(r'[\u31f0-\u31ff]+', '', caption)
+    caption = re.sub(r'[\u3200-\u32ff]+', '', caption)
+    caption = re.sub(r'[\u3300-\u33ff]+', '', caption)
+    caption = re.sub(r'[\u3400-\u4dbf]+', '', caption)
+    caption = re.sub(r'[\u4dc0-\u4dff]+', '', caption)
+    caption = re.sub(r'[\u4e00-\u9fff]+', '', caption)
+    #######################################################
+
+    # все виды тире / all types of dash --> "-"
+    caption = re.sub(
+        r'[\u002D\u058A\u05BE\u1400\u1806\u2010-\u2015\u2E17\u2E1A\u2E3A\u2E3B\u2E40\u301C\u3030\u30A0\uFE31\uFE32\uFE58\uFE63\uFF0D]+',  # noqa
+        '-', caption)
+
+    # кавычки к одному стандарту
+    caption = re.sub(r'[`´«»“”¨]', '"', caption)
+    caption = re.sub(r'[‘’]', "'", caption)
+
+    # &quot;
+    caption = re.sub(r'&quot;?', '', caption)
+    # &amp
+    caption = re.sub(r'&amp', '', caption)
+
+    # ip adresses:
+    caption = re.sub(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', ' ', caption)
+
+    # article ids:
+    caption = re.sub(r'\d:\d\d\s+$', '', caption)
+
+    # \n
+    caption = re.sub(r'\\n', ' ', caption)
+
+    # "#123"
+    caption = re.sub(r'#\d{1,3}\b', '', caption)
+    # "#12345.."
+    caption = re.sub(r'#\d{5,}\b', '', caption)
+    # "123456.."
+    caption = re.sub(r'\b\d{6,}\b', '', caption)
+    # filenames:
+    caption = re.sub(r'[\S]+\.(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)', '', caption)
+
+    #
+    caption = re.sub(r'[\"\']{2,}', r'"', caption)  # """AUSVERKAUFT"""
+    caption = re.sub(r'[\.]{2,}', r' ', caption)  # """AUSVERKAUFT"""
+
+    caption = re.sub(LEGACY_BAD_PUNCT_REGEX, r' ', caption)  # ***AUSVERKAUFT***, #AUSVERKAUFT
+    caption = re.sub(r'\s+\.\s+', r' ', caption)  # " . "
+
+    # this-is-my-cute-cat / this_is_my_cute_cat
+    regex2 = re.compile(r'(?:\-|\_)')
+    if len(re.findall(regex2, caption)) > 3:
+        caption = re.sub(regex2, ' ', caption)
+
+    caption = legacy_basic_clean(caption)
+
+    caption = re.sub(r'\b[a-zA-Z]{1,3}\d{3,15}\b', '', caption)  # jc6640
+    caption = re.sub(r'\b[a-zA-Z]+\d+[a-zA-Z]+\b', '', caption)  # jc6640vc
+    caption = re.sub(r'\b\d+[a-zA-Z]+\d+\b', '', caption)  # 6640vc231
+
+    caption = re.sub(r'(worldwide\s+)?(free\s+)?shipping', '', caption)
+    caption = re.sub(r'(free\s)?download(\sfree)?', '', caption)
+    caption = re.sub(r'\bclick\b\s(?:for|on)\s\w+', '', caption)
+    caption = re.sub(r'\b(?:png|jpg|jpeg|bmp|webp|eps|pdf|apk|mp4)(\simage[s]?)?', '', caption)
+    caption = re.sub(r'\bpage\s+\d+\b', '', caption)
+
+    caption = re.sub(r'\b\d*[a-zA-Z]+\d+[a-zA-Z]+\d+[a-zA-Z\d]*\b', r' ', caption)  # j2d1a2a...
+
+    caption = re.sub(r'\b\d+\.?\d*[xх×]\d+\.?\d*\b', '', caption)
+
+    caption = re.sub(r'\b\s+\:\s+', r': ', caption)
+    caption = re.sub(r'(\D[,\./])\b', r'\1 ', caption)
+    caption = re.sub(r'\s+', ' ', caption)
+
+    caption.strip()
+
+    caption = re.sub(r'^[\"\']([\w\W]+)[\"\']$', r'\1', caption)
+    caption = re.sub(r'^[\'\_,\-\:;]', r'', caption)
+    caption = re.sub(r'[\'\_,\-\:\-\+]$', r'', caption)
+    caption = re.sub(r'^\.\S+$', '', caption)
+
+    return caption.strip()
+
+
+def legacy_preprocess_caption(caption):
+    return legacy_clean_caption(legacy_clean_caption(caption))
+
+
+def load_captions(path):
+    if path is None:
+        return SAMPLE_CAPTIONS
+    if path.endswith('.json'):
+        return [item['prompt'] for item in json.load(open(path, 'r'))]
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--captions', default=None, type=str, help='data_info json (with "prompt") or a txt file with one caption per line')
+    parser.add_argument('--max_captions', default=100_000, type=int)
+    parser.add_argument('--repeat', default=1000, type=int, help='repetitions of the built-in samples without --captions')
+    parser.add_argument('--num_workers', default=8, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    captions = load_captions(args.captions)[:args.max_captions]
+    if args.captions is None:
+        captions = captions * args.repeat
+    captions = [caption.strip() for caption in captions]
+
+    t = time.time()
+    legacy = [legacy_preprocess_caption(caption) for caption in captions]
+    t_legacy = time.time() - t
+    t = time.time()
+    precompiled = [preprocess_caption(caption) for caption in captions]
+    t_precompiled = time.time() - t
+    t = time.time()
+    pooled = clean_captions(captions, num_workers=args.num_workers)
+    t_pooled = time.time() - t
+
+    mismatches = [i for i, (a, b, c) in enumerate(zip(legacy, precompiled, pooled)) if not a == b == c]
+    for i in mismatches[:10]:
+        print(f'mismatch: {captions[i]!r}\n  legacy:      {legacy[i]!r}\n  precompiled: {precompiled[i]!r}\n  pooled:      {pooled[i]!r}')
+    n = len(captions)
+    print(f'{n:,} captions, {len(mismatches)} mismatches')
+    print(f'legacy:      {n / t_legacy:10.1f} captions/s')
+    print(f'precompiled: {n / t_precompiled:10.1f} captions/s ({t_legacy / t_precompiled:.2f}x)')
+    print(f'pool x{args.num_workers}:     {n / t_pooled:10.1f} captions/s ({t_legacy / t_pooled:.2f}x)')
+    sys.exit(1 if mismatches else 0)
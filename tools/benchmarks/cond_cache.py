@@ -0,0 +1,84 @@
+"""
+Timestep-invariant conditioning cache of PixArtMS on CPU.
+
+Times the conditioning work the forward pass used to redo at every solver step -- caption embedding, mask packing,
+size/aspect-ratio embeddings and the cross-attention kv_linear of every block -- against a `cond_cache` hit, and
+counts the FLOPs a sampling call saves.
+
+Usage:
+    python tools/benchmarks/cond_cache.py --steps 20 --batch_size 1 --depth 28
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import torch
+
+from diffusion.model.nets import PixArtMS
+from diffusion.model.utils import cached_condition
+
+
+def conditioning(model, y, mask, data_info, bs, cond_cache):
+    size = cached_condition(cond_cache, 'size', (data_info['img_hw'], data_info['aspect_ratio'], bs),
+                            lambda: model.embed_size(data_info['img_hw'], data_info['aspect_ratio'], bs))
+    y, y_lens, blocks_kwargs = cached_condition(cond_cache, 'caption', (y, mask), lambda: model.embed_caption(y, mask, True))
+    return size, y, y_lens, blocks_kwargs
+
+
+def conditioning_flops(model, num_tokens, bs):
+    hidden = model.pos_embed.shape[-1]
+    y_proj = model.y_embedder.y_proj
+    caption = 2 * model.y_embedder.y_embedding.shape[0] * bs * (y_proj.fc1.in_features * y_proj.fc1.out_features + y_proj.fc2.in_features * y_proj.fc2.out_features)
+    kv = 2 * num_tokens * hidden * 2 * hidden * len(model.blocks)
+    size = 2 * 2 * bs * 2 * (model.csize_embedder.frequency_embedding_size * model.csize_embedder.outdim + model.csize_embedder.outdim ** 2)
+    return caption + kv + size
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--batch_size', default=1, type=int, help='images per call, doubled for classifier-free guidance')
+    parser.add_argument('--depth', default=28, type=int)
+    parser.add_argument('--caption_tokens', default=60, type=int, help='valid T5 tokens per caption')
+    parser.add_argument('--repeats', default=3, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(0)
+    model = PixArtMS(input_size=128, depth=args.depth, lewei_scale=2.0).eval()
+    bs = 2 * args.batch_size
+    y = torch.randn(bs, 1, 120, 4096)
+    mask = torch.zeros(bs, 120, dtype=torch.long)
+    mask[:, :args.caption_tokens] = 1
+    data_info = {'img_hw': torch.tensor([[1024., 1024.]]), 'aspect_ratio': torch.tensor([[1.]])}
+
+    with torch.no_grad():
+        ref = conditioning(model, y, mask, data_info, bs, None)
+        cond_cache = {}
+        conditioning(model, y, mask, data_info, bs, cond_cache)
+        cached = conditioning(model, y, mask, data_info, bs, cond_cache)
+        assert torch.equal(ref[0], cached[0]) and torch.equal(ref[1], cached[1]) and ref[2] == cached[2]
+        assert all(torch.equal(block.cross_attn.kv_linear(ref[1]), kw['cross_kv']) for block, kw in zip(model.blocks, cached[3]))
+
+        t_uncached = t_cached = float('inf')
+        for _ in range(args.repeats):
+            t = time.time()
+            for _ in range(args.steps):
+                conditioning(model, y, mask, data_info, bs, None)
+            t_uncached = min(t_uncached, time.time() - t)
+            t = time.time()
+            cond_cache = {}
+            for _ in range(args.steps):
+                conditioning(model, y, mask, data_info, bs, cond_cache)
+            t_cached = min(t_cached, time.time() - t)
+
+    flops = conditioning_flops(model, bs * args.caption_tokens, bs)
+    print(f'depth {args.depth}, {args.batch_size} image(s) with CFG, {args.caption_tokens} caption tokens, {args.steps} steps')
+    print(f'conditioning per step: {flops / 1e9:.2f} GFLOPs, saved per call: {flops * (args.steps - 1) / 1e9:.2f} GFLOPs')
+    print(f'uncached: {t_uncached / args.batch_size * 1e3:8.1f} ms/image')
+    print(f'cached:   {t_cached / args.batch_size * 1e3:8.1f} ms/image (one computation per call)')
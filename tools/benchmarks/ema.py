@@ -0,0 +1,79 @@
+"""
+Per-step EMA cost on the CPU for a PixArt-XL-sized parameter set.
+
+"legacy" replays the per-script `ema_update` (name dict per call, then `mul_`/`add_` per parameter); "foreach" is
+`diffusion.utils.ema.EMA`, which pairs the parameters once and runs one `torch._foreach_lerp_`; "every N" is its
+amortized per-step cost with `update_every=N`. All variants are checked to produce the same EMA weights.
+
+Usage:
+    python tools/benchmarks/ema.py --depth 28 --steps 5 --update_every 4
+"""
+import argparse
+import sys
+import time
+from copy import deepcopy
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import torch
+import torch.nn as nn
+
+from diffusion.model.nets import PixArtMS
+from diffusion.utils.ema import EMA
+
+
+def legacy_ema_update(model_dest: nn.Module, model_src: nn.Module, rate):
+    param_dict_src = dict(model_src.named_parameters())
+    for p_name, p_dest in model_dest.named_parameters():
+        p_src = param_dict_src[p_name]
+        assert p_src is not p_dest
+        p_dest.data.mul_(rate).add_((1 - rate) * p_src.data)
+
+
+def time_steps(fn, steps):
+    t = time.time()
+    for _ in range(steps):
+        fn()
+    return (time.time() - t) / steps
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', default=28, type=int, help='28 is PixArt-XL/2, about 600M parameters')
+    parser.add_argument('--steps', default=5, type=int)
+    parser.add_argument('--rate', default=0.9999, type=float)
+    parser.add_argument('--update_every', default=4, type=int)
+    parser.add_argument('--threads', default=None, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = PixArtMS(input_size=128, depth=args.depth, lewei_scale=2.0)
+    model_ema = deepcopy(model)
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * 1e-3)
+    num_params = sum(p.numel() for p in model.parameters())
+    print(f'{num_params / 1e6:.0f}M parameters in {len(list(model.parameters()))} tensors, {torch.get_num_threads()} threads')
+
+    ref_ema = deepcopy(model_ema)
+    legacy_ema_update(ref_ema, model, args.rate)
+    check_ema = deepcopy(model_ema)
+    EMA(check_ema, model, args.rate).step()
+    err = max((a - b).abs().max().item() for a, b in zip(ref_ema.parameters(), check_ema.parameters()))
+    print(f'max abs diff foreach vs legacy after one step: {err:.2e}')
+    del ref_ema, check_ema
+
+    t_legacy = time_steps(lambda: legacy_ema_update(model_ema, model, args.rate), args.steps)
+    ema = EMA(model_ema, model, args.rate)
+    t_foreach = time_steps(ema.step, args.steps)
+    ema = EMA(model_ema, model, args.rate, update_every=args.update_every)
+    t_every = time_steps(ema.step, args.steps * args.update_every)
+    print(f'legacy:   {t_legacy * 1e3:8.1f} ms/step')
+    print(f'foreach:  {t_foreach * 1e3:8.1f} ms/step')
+    print(f'every {args.update_every}:  {t_every * 1e3:8.1f} ms/step (amortized)')
@@ -0,0 +1,59 @@
+"""
+Per-step pos-embed overhead of PixArtMS on CPU.
+
+"numpy" replays the previous forward-pass code (numpy grid, from_numpy, copy to the device and dtype) on every step;
+"cached" is `PixArt.get_pos_embed`. The torch generator behind the cache is also checked against the numpy one on
+every bucket of ASPECT_RATIO_1024.
+
+Usage:
+    python tools/benchmarks/pos_embed.py --steps 40 --image_size 1024
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import torch
+
+from diffusion.data.datasets.utils import ASPECT_RATIO_1024
+from diffusion.model.nets import PixArtMS
+from diffusion.model.nets.PixArt import get_2d_sincos_pos_embed, get_2d_sincos_pos_embed_torch
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', default=1024, type=int)
+    parser.add_argument('--steps', default=40, type=int, help='forward passes per image, e.g. 20 DPM-Solver steps with CFG')
+    parser.add_argument('--dtype', default='float16', type=str, choices=['float16', 'bfloat16', 'float32'])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    dtype = getattr(torch, args.dtype)
+    latent_size = args.image_size // 8
+    model = PixArtMS(input_size=latent_size, depth=1, lewei_scale={512: 1, 1024: 2}.get(args.image_size, 1)).eval()
+    device, embed_dim = torch.device('cpu'), model.pos_embed.shape[-1]
+
+    max_err = 0.
+    for ratio, (height, width) in ASPECT_RATIO_1024.items():
+        h, w = int(height) // 8 // model.patch_size, int(width) // 8 // model.patch_size
+        ref = get_2d_sincos_pos_embed(embed_dim, (h, w), lewei_scale=model.lewei_scale, base_size=model.base_size)
+        out = get_2d_sincos_pos_embed_torch(embed_dim, (h, w), lewei_scale=model.lewei_scale, base_size=model.base_size)
+        max_err = max(max_err, (out - torch.from_numpy(ref)).abs().max().item())
+    print(f'torch vs numpy over {len(ASPECT_RATIO_1024)} buckets: max abs err {max_err:.2e}')
+
+    h = w = latent_size // model.patch_size
+    t = time.time()
+    for _ in range(args.steps):
+        pos_embed = torch.from_numpy(get_2d_sincos_pos_embed(embed_dim, (h, w), lewei_scale=model.lewei_scale, base_size=model.base_size)).unsqueeze(0).to(device).to(dtype)
+    t_numpy = (time.time() - t) / args.steps
+    t = time.time()
+    for _ in range(args.steps):
+        pos_embed = model.get_pos_embed(h, w, device, dtype)
+    t_cached = (time.time() - t) / args.steps
+    print(f'{h}x{w} grid, {embed_dim} channels, {args.dtype}, {args.steps} steps')
+    print(f'numpy:  {t_numpy * 1e3:8.3f} ms/step')
+    print(f'cached: {t_cached * 1e3:8.3f} ms/step (first step builds the entry)')
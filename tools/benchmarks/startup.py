@@ -0,0 +1,114 @@
+"""
+Startup time and peak RSS of building a PixArt model and loading its checkpoint, as the entry points do it.
+
+"legacy" is the former path of `scripts/inference.py`, `scripts/interface.py`, `scripts/inference_lcm.py` and the
+ControlNet app/interface: build the model with its full weight initialization, `torch.load` the whole checkpoint and
+copy the weights in. "meta" is the current one: `build_model(..., init_weights=False, device='meta')` and
+`load_model_weights`, which maps the checkpoint and assigns its tensors to the model. Every variant runs in a fresh
+process (imports excluded from the times) so that its peak RSS is its own.
+
+Without `--ckpt`, a random checkpoint with `state_dict` and `state_dict_ema` is written to `--work_dir` first.
+
+Usage:
+    python tools/benchmarks/startup.py --model PixArtMS_XL_2 --image_size 1024 --controlnet
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import torch
+
+from diffusion.model.builder import build_model
+from diffusion.model.nets import ControlPixArtHalf, ControlPixArtMSHalf
+from diffusion.utils.checkpoint import load_model_weights
+
+VARIANTS = ('legacy', 'meta')
+
+
+def model_kwargs(args):
+    return dict(input_size=args.image_size // 8, lewei_scale={512: 1, 1024: 2}[args.image_size], depth=args.depth)
+
+
+def wrap_controlnet(args, model):
+    if not args.controlnet:
+        return model
+    return ControlPixArtHalf(model) if args.model == 'PixArt_XL_2' else ControlPixArtMSHalf(model)
+
+
+def run_legacy(args):
+    t = time.time()
+    model = wrap_controlnet(args, build_model(args.model, **model_kwargs(args))).to(args.device)
+    t_build = time.time() - t
+    t = time.time()
+    state_dict = torch.load(args.ckpt, map_location='cpu')['state_dict']
+    for key in ('pos_embed', 'base_model.pos_embed'):
+        state_dict.pop(key, None)
+    model.load_state_dict(state_dict, strict=False)
+    return model, t_build, time.time() - t
+
+
+def run_meta(args):
+    t = time.time()
+    model = wrap_controlnet(args, build_model(args.model, init_weights=False, device='meta', **model_kwargs(args)))
+    t_build = time.time() - t
+    t = time.time()
+    load_model_weights(args.ckpt, model)
+    model.to(args.device)
+    return model, t_build, time.time() - t
+
+
+def make_checkpoint(args):
+    torch.manual_seed(0)
+    model = wrap_controlnet(args, build_model(args.model, **model_kwargs(args)))
+    state_dict = model.state_dict()
+    os.makedirs(args.work_dir, exist_ok=True)
+    torch.save(dict(state_dict=state_dict, state_dict_ema={k: v.clone() for k, v in state_dict.items()}), args.ckpt)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='PixArtMS_XL_2', type=str, choices=['PixArt_XL_2', 'PixArtMS_XL_2'])
+    parser.add_argument('--image_size', default=1024, type=int, choices=[512, 1024])
+    parser.add_argument('--depth', default=28, type=int)
+    parser.add_argument('--controlnet', action='store_true', help='wrap the model like app/app_controlnet.py')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--ckpt', default=None, type=str, help='checkpoint matching the model arguments')
+    parser.add_argument('--work_dir', default='output/benchmarks/startup', type=str)
+    parser.add_argument('--variants', default=VARIANTS, nargs='+', choices=VARIANTS)
+    parser.add_argument('--run', default=None, choices=VARIANTS, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.run is not None:
+        model, t_build, t_load = {'legacy': run_legacy, 'meta': run_meta}[args.run](args)
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024   # KiB on Linux
+        print(json.dumps(dict(build=t_build, load=t_load, max_rss=max_rss)))
+        sys.exit()
+
+    if args.ckpt is None:
+        args.ckpt = os.path.join(args.work_dir, f'{args.model}_d{args.depth}{"_control" if args.controlnet else ""}.pth')
+        if not os.path.exists(args.ckpt):
+            print(f'writing a random checkpoint to {args.ckpt}')
+            make_checkpoint(args)
+    print(f'{args.model}{" + ControlNet" if args.controlnet else ""}, depth {args.depth}, {args.image_size}px, '
+          f'{args.device}, checkpoint {os.path.getsize(args.ckpt) / 2 ** 30:.2f} GiB')
+    for variant in args.variants:
+        cmd = [sys.executable, str(current_file_path), '--run', variant, '--model', args.model,
+               '--image_size', str(args.image_size), '--depth', str(args.depth), '--device', args.device, '--ckpt', args.ckpt]
+        if args.controlnet:
+            cmd.append('--controlnet')
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"{variant:>7}: build {result['build']:6.2f} s, load {result['load']:6.2f} s, "
+              f"total {result['build'] + result['load']:6.2f} s, peak RSS {result['max_rss']:8.0f} MiB")
@@ -0,0 +1,83 @@
+"""
+Quality versus speed of token merging (ToMe) with a tiny random-weight PixArtMS on CPU.
+
+Samples the same latents with DPM-Solver++ once without merging and then for every merge ratio (all blocks, or the
+`--blocks` range, for timesteps in `--timesteps`), and reports the time per sample and how far the merged
+samples are from the unmerged ones (PSNR of the latents in [-1, 1] units and cosine similarity). With random
+weights the absolute numbers only exercise the harness; point `--ckpt` at real weights for meaningful quality.
+
+Usage:
+    python tools/benchmarks/token_merging.py --image_size 512 --ratios 0.25 0.5 0.75 --steps 5
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent.parent))
+import torch
+import torch.nn.functional as F
+
+from diffusion import DPMS
+from diffusion.model.nets import PixArtMS
+from diffusion.model.utils import StackedRandomGenerator
+from tools.download import find_model
+
+
+def sample(model, z, y, mask, data_info, steps):
+    null_y = model.y_embedder.y_embedding[None].repeat(len(z), 1, 1)[:, None]
+    dpm_solver = DPMS(model.forward_with_dpmsolver, condition=y, uncondition=null_y, cfg_scale=4.5,
+                      model_kwargs=dict(data_info=data_info, mask=mask))
+    return dpm_solver.sample(z, steps=steps, order=2, skip_type="time_uniform", method="multistep")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', default=512, type=int)
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--depth', default=4, type=int)
+    parser.add_argument('--hidden_size', default=384, type=int)
+    parser.add_argument('--num_heads', default=6, type=int)
+    parser.add_argument('--steps', default=5, type=int)
+    parser.add_argument('--ratios', default=[0.25, 0.5, 0.75], type=float, nargs='+')
+    parser.add_argument('--blocks', default=None, type=int, nargs=2, metavar=('START', 'END'), help='merge in blocks [START, END)')
+    parser.add_argument('--timesteps', default=None, type=float, nargs=2, metavar=('MIN', 'MAX'), help='merge for model timesteps in [MIN, MAX)')
+    parser.add_argument('--ckpt', default=None, type=str, help='optional PixArtMS checkpoint matching the size arguments')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(0)
+    latent_size = args.image_size // 8
+    model = PixArtMS(input_size=latent_size, depth=args.depth, hidden_size=args.hidden_size, num_heads=args.num_heads,
+                     caption_channels=64, lewei_scale={512: 1, 1024: 2}.get(args.image_size, 1)).eval()
+    if args.ckpt is not None:
+        print(model.load_state_dict(find_model(args.ckpt)['state_dict'], strict=False))
+    bs = args.batch_size
+    z = StackedRandomGenerator('cpu', range(bs)).randn((bs, 4, latent_size, latent_size))
+    y = torch.randn(bs, 1, 120, 64)
+    mask = torch.zeros(bs, 120, dtype=torch.long)
+    mask[:, :60] = 1
+    data_info = {'img_hw': torch.tensor([[args.image_size, args.image_size]], dtype=torch.float).repeat(bs, 1),
+                 'aspect_ratio': torch.tensor([[1.]]).repeat(bs, 1)}
+
+    print(f'{args.image_size}px ({(latent_size // 2) ** 2} tokens), depth {args.depth}, hidden {args.hidden_size}, '
+          f'{args.steps} steps, blocks {args.blocks or "all"}, timesteps {args.timesteps or "all"}')
+    with torch.inference_mode():
+        t = time.time()
+        ref = sample(model, z, y, mask, data_info, args.steps)
+        t_ref = time.time() - t
+        print(f'ratio 0.00: {t_ref / bs:7.2f} s/sample')
+        for ratio in args.ratios:
+            model.set_token_merging([dict(ratio=ratio, blocks=args.blocks, timesteps=args.timesteps)])
+            t = time.time()
+            out = sample(model, z, y, mask, data_info, args.steps)
+            t_merge = time.time() - t
+            mse = F.mse_loss(out, ref).item()
+            psnr = 10 * torch.log10(torch.tensor(4. / max(mse, 1e-12))).item()
+            cos = F.cosine_similarity(out.flatten(1), ref.flatten(1)).mean().item()
+            print(f'ratio {ratio:.2f}: {t_merge / bs:7.2f} s/sample (x{t_ref / t_merge:.2f}), '
+                  f'PSNR vs unmerged {psnr:6.2f} dB, cosine {cos:.4f}')
+        model.set_token_merging(None)
@@ -0,0 +1,53 @@
+"""
+Build the columnar, memory-mapped metadata index read by `InternalData(meta_index=...)` / `InternalDataMS(meta_index=...)`.
+
+The partition json files are parsed once here instead of in every training process. Items with ratio > 4 are
+dropped exactly like the datasets do, and aspect-ratio bucket ids are precomputed for the ASPECT_RATIO_* tables.
+
+Usage:
+    python tools/build_meta_index.py --root data/InternData --partition_dir partition_filter \
+        --image_list_json data_info.json --out meta_index
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent))
+import numpy as np
+
+from diffusion.data.packed import build_meta_index
+from diffusion.data.datasets.utils import file_md5, get_closest_ratio_ids, ASPECT_RATIO_256, ASPECT_RATIO_512, ASPECT_RATIO_1024
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', required=True, type=str, help='dataset root, e.g. data/InternData')
+    parser.add_argument('--partition_dir', default='partition', type=str, help="'partition' for InternalData, 'partition_filter' for InternalDataMS")
+    parser.add_argument('--image_list_json', nargs='+', default=['data_info.json'], type=str)
+    parser.add_argument('--out', default='meta_index', type=str, help='output directory, relative to root')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    meta_data_clean, ori_imgs_nums, sources = [], 0, {}
+    for json_file in args.image_list_json:
+        json_path = os.path.join(args.root, args.partition_dir, json_file)
+        with open(json_path, 'r') as f:
+            meta_data = json.load(f)
+        ori_imgs_nums += len(meta_data)
+        meta_data_clean.extend([item for item in meta_data if item['ratio'] <= 4])
+        sources[json_file] = file_md5(json_path)
+        print(f'{json_file}: {len(meta_data)} items')
+
+    height = np.array([item['height'] for item in meta_data_clean])
+    width = np.array([item['width'] for item in meta_data_clean])
+    bucket_ids = {name: get_closest_ratio_ids(height, width, ratios) for name, ratios in
+                  (('ASPECT_RATIO_256', ASPECT_RATIO_256), ('ASPECT_RATIO_512', ASPECT_RATIO_512), ('ASPECT_RATIO_1024', ASPECT_RATIO_1024))}
+    out_dir = os.path.join(args.root, args.out)
+    build_meta_index(meta_data_clean, out_dir, ori_imgs_nums=ori_imgs_nums, bucket_ids=bucket_ids,
+                     extra_meta={'partition_dir': args.partition_dir, 'sources': sources})
+    print(f'Wrote {len(meta_data_clean)}/{ori_imgs_nums} items to {out_dir}')
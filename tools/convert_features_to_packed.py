@@ -0,0 +1,70 @@
+"""
+Convert per-sample feature files (as written by tools/extract_features.py) into the packed, memory-mapped
+stores read by `InternalData` / `InternalDataMS`.
+
+caption: `.npz` T5 features -> `packed_txt_feat=...`. Only the valid tokens of every caption (attention_mask == 1)
+         are kept, so the store is several times smaller than the zero-padded 120x4096 features and no zlib
+         decompression is needed at training time.
+vae:     `.npy` [mean, std] latents -> `packed_vae_feat=...`. Single-scale (`img_vae_features_*/noflip`) and
+         multi-scale (`img_vae_fatures_*_multiscale/ms`) trees share one layout: fp16 2CxHxW arrays keyed by file stem.
+
+Usage:
+    python tools/convert_features_to_packed.py --kind caption --src data/InternData/caption_feature_wmask \
+        --dst data/InternData/caption_feature_packed
+    python tools/convert_features_to_packed.py --kind vae --src data/InternData/img_vae_fatures_1024_multiscale/ms \
+        --dst data/InternData/img_vae_features_1024_packed
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+current_file_path = Path(__file__).resolve()
+sys.path.insert(0, str(current_file_path.parent.parent))
+import numpy as np
+from tqdm import tqdm
+
+from diffusion.data.packed import PackedFeatureWriter
+
+
+def load_caption_feature(path):
+    with np.load(path) as txt_info:
+        feature = txt_info['caption_feature']
+        feature = feature.reshape(-1, feature.shape[-1])   # 1xTxC -> TxC
+        if 'attention_mask' in txt_info.keys():
+            length = int(txt_info['attention_mask'].sum())
+            feature = feature[:length]
+    return Path(path).stem, feature
+
+
+def load_vae_feature(path):
+    feature = np.load(path)
+    if feature.ndim == 4:
+        feature = feature.squeeze(0)    # 1x2CxHxW -> 2CxHxW
+    return Path(path).stem, feature
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kind', default='caption', type=str, choices=['caption', 'vae'])
+    parser.add_argument('--src', required=True, type=str, help='directory of .npz caption features or .npy vae features')
+    parser.add_argument('--dst', required=True, type=str, help='output directory of the packed store')
+    parser.add_argument('--dtype', default='float16', type=str, choices=['float16', 'float32'])
+    parser.add_argument('--shard_size', default=1 << 30, type=int, help='shard size in bytes')
+    parser.add_argument('--num_workers', default=16, type=int, help='threads for reading (and decompressing) feature files')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    ext, ndim, load_fn = ('.npz', 2, load_caption_feature) if args.kind == 'caption' else ('.npy', 3, load_vae_feature)
+    files = sorted(os.path.join(args.src, f) for f in os.listdir(args.src) if f.endswith(ext))
+    with PackedFeatureWriter(args.dst, ndim=ndim, dtype=args.dtype, shard_size=args.shard_size) as writer:
+        done = writer.done_keys()
+        files = [f for f in files if Path(f).stem not in done]
+        print(f'Converting {len(files)} files, {len(done)} already packed.')
+        with ThreadPoolExecutor(args.num_workers) as pool:
+            for key, feature in tqdm(pool.map(load_fn, files), total=len(files)):
+                writer.add(key, feature)
+    print('done')
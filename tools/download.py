@@ -8,7 +8,6 @@
 Functions for downloading pre-trained PixArt models
 """
 from torchvision.datasets.utils import download_url
-import torch
 import os
 import argparse
 
@@ -29,24 +28,40 @@ t5_models = {
 def find_model(model_name):
     """
     Finds a pre-trained G.pt model, downloading it if necessary. Alternatively, loads a model from a local path.
+    The tensors are memory-mapped, so only the parts of the checkpoint that are used are read.
+    """
+    from diffusion.utils.checkpoint import read_checkpoint
+
+    return read_checkpoint(find_model_path(model_name))
+
+
+def find_model_path(model_name):
+    """
+    Local path of a pre-trained PixArt model, downloading it if necessary, or of a local checkpoint.
     """
     if model_name in pretrained_models:
-        return download_model(model_name)
-    assert os.path.isfile(model_name), f'Could not find PixArt checkpoint at {model_name}'
-    return torch.load(model_name, map_location=lambda storage, loc: storage)
+        return download_model_path(model_name)
+    assert os.path.exists(model_name), f'Could not find PixArt checkpoint at {model_name}'
+    return model_name
 
 
 def download_model(model_name):
     """
     Downloads a pre-trained PixArt model from the web.
     """
+    from diffusion.utils.checkpoint import torch_load_mmap
+
+    return torch_load_mmap(download_model_path(model_name))
+
+
+def download_model_path(model_name):
     assert model_name in pretrained_models
     local_path = f'output/pretrained_models/{model_name}'
     if not os.path.isfile(local_path):
         os.makedirs('output/pretrained_models', exist_ok=True)
         web_path = f'https://huggingface.co/PixArt-alpha/PixArt-alpha/resolve/main/{model_name}'
         download_url(web_path, 'output/pretrained_models')
-    return torch.load(local_path, map_location=lambda storage, loc: storage)
+    return local_path
 
 
 def download_other(model_name, model_zoo, output_dir):
@@ -75,5 +90,5 @@ if __name__ == "__main__":
     for vae_model in vae_models:
         download_other(vae_model, vae_models, 'output/pretrained_models/')
     for model in model_names:
-        download_model(model)    # for vae_model in vae_models:
+        download_model_path(model)    # for vae_model in vae_models:
     print('Done.')
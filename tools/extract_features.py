@@ -10,15 +10,19 @@ import numpy as np
 import json
 from tqdm import tqdm
 import argparse
+import multiprocessing
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
-from pathlib import Path
 from torch.utils.data import DataLoader, RandomSampler
 from accelerate import Accelerator
 from torchvision.transforms.functional import InterpolationMode
 from torchvision.datasets.folder import default_loader
 
-from diffusion.model.t5 import T5Embedder
+from transformers import T5Config
+from diffusion.model.t5 import T5Embedder, TINY_T5_CONFIG, clean_captions
+from diffusion.data.packed import PackedFeatureWriter
 from diffusers.models import AutoencoderKL
 from diffusion.data.datasets.InternalData import InternalData
 from diffusion.utils.misc import SimpleTimer
@@ -113,62 +117,121 @@ class DatasetMS(InternalData):
         return {'height': data_info['height'], 'width': data_info['width']}
 
 
-def extract_caption_t5_do(q):
-    while not q.empty():
-        item = q.get()
-        extract_caption_t5_job(item)
-        q.task_done()
-
-
-def extract_caption_t5_job(item):
-    global mutex
-    global t5
-    global t5_save_dir
-
+def build_t5():
+    if args.t5_config is None:
+        return T5Embedder(device=device, local_cache=True, cache_dir=f'{args.pretrained_models_dir}/t5_ckpts', model_max_length=args.max_length)
+    # random weights from a config: exercises the pipeline without the T5-XXL checkpoint, e.g. on a CPU-only box
+    config = T5Config(**TINY_T5_CONFIG) if args.t5_config == 'tiny' else T5Config.from_pretrained(args.t5_config)
+    tokenizer_path = args.tokenizer_path or f'{args.pretrained_models_dir}/t5_ckpts/t5-v1_1-xxl'
+    return T5Embedder.from_config(config, tokenizer_path, device=device, model_max_length=args.max_length)
+
+
+def read_caption_batches(t5, items, batch_size, sort_window, clean_pool=None):
+    """Reader stage: clean and tokenize captions, then sort every window of `sort_window` batches by token length,
+    so each batch holds captions of similar length and is padded to its own longest caption only.
+    `clean_pool` is an optional process pool for the caption cleaning."""
+    window = batch_size * sort_window
+    for start in range(0, len(items), window):
+        chunk = items[start:start + window]
+        texts = [item['prompt'].strip() for item in chunk]
+        if clean_pool is not None and t5.use_text_preprocessing:
+            texts = clean_captions(texts, pool=clean_pool, chunksize=64)
+        else:
+            texts = [t5.text_preprocessing(text) for text in texts]
+        input_ids = t5.tokenizer(texts, max_length=t5.model_max_length, truncation=True, add_special_tokens=True)['input_ids']
+        order = sorted(range(len(chunk)), key=lambda i: len(input_ids[i]))
+        for b in range(0, len(order), batch_size):
+            batch = order[b:b + batch_size]
+            yield [Path(chunk[i]['path']).stem for i in batch], [input_ids[i] for i in batch]
+
+
+def reader_worker(t5, items, batch_size, sort_window, q, clean_pool=None):
+    try:
+        for batch in read_caption_batches(t5, items, batch_size, sort_window, clean_pool):
+            q.put(batch)
+    finally:
+        q.put(None)
+
+
+def encode_caption_batch(t5, input_ids):
+    """Model stage: one padded forward pass. T5 uses relative positions, so the valid tokens do not depend on the padding."""
+    tokens = t5.tokenizer.pad({'input_ids': input_ids}, padding='longest', pad_to_multiple_of=8, return_attention_mask=True, return_tensors='pt')
     with torch.no_grad():
-        caption = item['prompt'].strip()
-        if isinstance(caption, str):
-            caption = [caption]
-
-        save_path = os.path.join(t5_save_dir, Path(item['path']).stem)
-        if os.path.exists(f"{save_path}.npz"):
-            return
-        try:
-            mutex.acquire()
-            caption_emb, emb_mask = t5.get_text_embeddings(caption)
-            mutex.release()
-            emb_dict = {
-                'caption_feature': caption_emb.float().cpu().data.numpy(),
-                'attention_mask': emb_mask.cpu().data.numpy(),
-            }
-            np.savez_compressed(save_path, **emb_dict)
-        except Exception as e:
-            print(e)
+        caption_emb = t5.model(
+            input_ids=tokens['input_ids'].to(t5.device),
+            attention_mask=tokens['attention_mask'].to(t5.device),
+        )['last_hidden_state']
+    return caption_emb.float().cpu(), [len(ids) for ids in input_ids]
+
+
+def write_caption_batch(keys, caption_emb, lengths, writer, lock):
+    """Writer stage: packed shards keep only the valid tokens; npz files keep the original zero-padded layout."""
+    caption_emb = caption_emb.numpy()
+    if writer is not None:
+        features = [caption_emb[i, :length].astype(writer.dtype) for i, length in enumerate(lengths)]
+        with lock:
+            for key, feature in zip(keys, features):
+                writer.add(key, feature)
+        return
+    max_length = args.max_length
+    for i, (key, length) in enumerate(zip(keys, lengths)):
+        feature = np.zeros((1, max_length, caption_emb.shape[-1]), dtype=np.float32)
+        feature[0, :length] = caption_emb[i, :length]
+        attention_mask = np.zeros((1, max_length), dtype=np.int64)
+        attention_mask[0, :length] = 1
+        np.savez_compressed(os.path.join(args.t5_save_root, key), caption_feature=feature, attention_mask=attention_mask)
 
 
 def extract_caption_t5():
-    global t5
-    global t5_save_dir
-    # global images_extension
-    t5 = T5Embedder(device="cuda", local_cache=True, cache_dir=f'{args.pretrained_models_dir}/t5_ckpts', model_max_length=120)
+    """Streaming caption feature extraction: reader thread -> single model worker (this thread) -> writer pool.
+
+    With `--t5_save_format packed` the features go to the packed shard store read by `packed_txt_feat`. Shards are
+    committed as they fill up, so an interrupted run resumes from its last complete shard.
+    """
+    t5 = build_t5()
     t5_save_dir = args.t5_save_root
     os.makedirs(t5_save_dir, exist_ok=True)
 
     train_data_json = json.load(open(args.json_path, 'r'))
-    train_data = train_data_json[args.start_index: args.end_index]
+    train_data = list({Path(item['path']).stem: item for item in train_data_json[args.start_index: args.end_index]}.values())
 
-    global mutex
-    mutex = threading.Lock()
-    jobs = Queue()
-
-    for item in tqdm(train_data):
-        jobs.put(item)
-
-    for _ in range(20):
-        worker = threading.Thread(target=extract_caption_t5_do, args=(jobs,))
-        worker.start()
-
-    jobs.join()
+    writer = None
+    if args.t5_save_format == 'packed':
+        writer = PackedFeatureWriter(t5_save_dir, ndim=2, dtype=args.t5_dtype, shard_size=args.shard_size)
+        done = writer.done_keys()
+    else:
+        done = {Path(f).stem for f in os.listdir(t5_save_dir) if f.endswith('.npz')}
+    train_data = [item for item in train_data if Path(item['path']).stem not in done]
+    print(f'Extracting T5 features of {len(train_data)} captions, {len(done)} already done.')
+
+    batches = Queue(maxsize=args.prefetch_batches)
+    clean_pool = multiprocessing.Pool(args.num_cleaners) if args.num_cleaners > 0 else None
+    reader = threading.Thread(target=reader_worker, args=(t5, train_data, args.t5_batch_size, args.sort_window, batches, clean_pool),
+                              daemon=True)
+    reader.start()
+    lock, pending, num_captions = threading.Lock(), [], 0
+    t = time.time()
+    with ThreadPoolExecutor(args.num_writers) as pool, tqdm(total=len(train_data), unit='caption') as pbar:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            keys, input_ids = batch
+            caption_emb, lengths = encode_caption_batch(t5, input_ids)
+            pending.append(pool.submit(write_caption_batch, keys, caption_emb, lengths, writer, lock))
+            while len(pending) > 2 * args.num_writers:      # bound the features held in memory
+                pending.pop(0).result()
+            num_captions += len(keys)
+            pbar.update(len(keys))
+            pbar.set_postfix(captions_per_sec=f'{num_captions / (time.time() - t):.1f}')
+        for future in pending:
+            future.result()
+    if clean_pool is not None:
+        clean_pool.close()
+    if writer is not None:
+        writer.close()
+    elapsed = time.time() - t
+    print(f'Extracted {num_captions} captions in {elapsed:.1f}s ({num_captions / max(elapsed, 1e-6):.1f} captions/s)')
 
 
 def extract_img_vae_do(q):
@@ -302,6 +365,19 @@ def get_args():
     
     parser.add_argument('--json_path', type=str)
     parser.add_argument('--t5_save_root', default='data/data_toy/caption_feature_wmask', type=str)
+    parser.add_argument('--t5_save_format', default='npz', type=str, choices=['npz', 'packed'],
+                        help="'npz': one file per caption; 'packed': shard store read with `packed_txt_feat`")
+    parser.add_argument('--t5_dtype', default='float16', type=str, choices=['float16', 'float32'], help='storage dtype of packed features')
+    parser.add_argument('--shard_size', default=1 << 30, type=int, help='packed shard size in bytes')
+    parser.add_argument('--t5_batch_size', default=64, type=int)
+    parser.add_argument('--sort_window', default=64, type=int, help='batches per window that is sorted by token length')
+    parser.add_argument('--prefetch_batches', default=8, type=int, help='tokenized batches queued ahead of the model')
+    parser.add_argument('--num_writers', default=4, type=int)
+    parser.add_argument('--num_cleaners', default=0, type=int, help='processes cleaning captions for the reader; 0: clean in the reader thread')
+    parser.add_argument('--max_length', default=120, type=int, help='T5 max token length')
+    parser.add_argument('--t5_config', default=None, type=str, help="'tiny' or a T5 config.json: random weights, for testing the pipeline")
+    parser.add_argument('--tokenizer_path', default=None, type=str, help='tokenizer used with --t5_config')
+    parser.add_argument('--t5_only', action='store_true', default=False, help='skip vae feature extraction')
     parser.add_argument('--vae_save_root', default='data/data_toy/img_vae_features', type=str)
     parser.add_argument('--dataset_root', default='data/data_toy', type=str)
     parser.add_argument('--pretrained_models_dir', default='output/pretrained_models', type=str)
@@ -321,7 +397,9 @@ if __name__ == '__main__':
     extract_caption_t5()
 
     # prepare extracted image vae features for training
-    if args.multi_scale:
+    if args.t5_only:
+        pass
+    elif args.multi_scale:
         print(f'Extracting Multi-scale Image Resolution based on {image_resize}')
         extract_img_vae_multiscale(bs=1)    # recommend bs = 1 for AspectRatioBatchSampler
     else:
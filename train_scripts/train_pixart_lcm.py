@@ -10,24 +10,23 @@ import time
 import warnings
 warnings.filterwarnings("ignore")  # ignore warning
 import torch
-import torch.nn as nn
 from accelerate import Accelerator, InitProcessGroupKwargs
 from accelerate.utils import DistributedType
 from diffusers.models import AutoencoderKL
 from torch.utils.data import RandomSampler
-from mmcv.runner import LogBuffer
 from copy import deepcopy
 import numpy as np
 import torch.nn.functional as F
 from tqdm import tqdm
 
 from diffusion import IDDPM
-from diffusion.utils.checkpoint import save_checkpoint, load_checkpoint
-from diffusion.utils.dist_utils import synchronize, get_world_size, clip_grad_norm_
+from diffusion.utils.checkpoint import AsyncCheckpointWriter, load_checkpoint
+from diffusion.utils.ema import EMA
+from diffusion.utils.dist_utils import get_world_size, clip_grad_norm_
 from diffusion.data.builder import build_dataset, build_dataloader, set_data_root
 from diffusion.model.builder import build_model
 from diffusion.utils.logger import get_root_logger
-from diffusion.utils.misc import set_random_seed, read_config, init_random_seed, DebugUnderflowOverflow
+from diffusion.utils.misc import set_random_seed, read_config, init_random_seed, DebugUnderflowOverflow, MetricsAccumulator, StageTimer
 from diffusion.utils.optimizer import build_optimizer, auto_scale_lr
 from diffusion.utils.lr_scheduler import build_lr_scheduler
 from diffusion.utils.data_sampler import AspectRatioBatchSampler, BalancedAspectRatioBatchSampler
@@ -42,13 +41,6 @@ def set_fsdp_env():
     os.environ["FSDP_TRANSFORMER_CLS_TO_WRAP"] = 'PixArtBlock'
 
 
-def ema_update(model_dest: nn.Module, model_src: nn.Module, rate):
-    param_dict_src = dict(model_src.named_parameters())
-    for p_name, p_dest in model_dest.named_parameters():
-        p_src = param_dict_src[p_name]
-        assert p_src is not p_dest
-        p_dest.data.mul_(rate).add_((1 - rate) * p_src.data)
-
 
 def append_dims(x, target_dims):
     """Appends dimensions to the end of a tensor until it has target_dims dimensions."""
@@ -135,7 +127,11 @@ def train():
         DebugUnderflowOverflow(model)
         logger.info('NaN debugger registered. Start to detect overflow during training.')
     time_start, last_tic = time.time(), time.time()
-    log_buffer = LogBuffer()
+    # the losses stay on the device until `log_interval`; the step time is broken down into the stages below
+    metrics = MetricsAccumulator(accelerator)
+    step_timer = StageTimer()
+    # checkpoints are written in the background; `wait` before exiting so that the last one is committed
+    checkpointer = AsyncCheckpointWriter(keep_last=config.get('keep_last_checkpoints', None))
 
     start_step = start_epoch * len(train_dataloader)
     global_step = 0
@@ -148,10 +144,9 @@ def train():
 
     # Now you train the model
     for epoch in range(start_epoch + 1, config.num_epochs + 1):
-        data_time_start= time.time()
-        data_time_all = 0
+        step_timer.lap()
         for step, batch in enumerate(train_dataloader):
-            data_time_all += time.time() - data_time_start
+            step_timer.lap('data')
             if load_vae_feat:
                 z = batch[0]
             else:
@@ -230,6 +225,7 @@ def train():
 
                 # Backpropagation on the online student model (`model`)
                 accelerator.backward(loss)
+                step_timer.lap('forward_backward')
                 if accelerator.sync_gradients:
                     grad_norm = accelerator.clip_grad_norm_(model.parameters(), config.gradient_clip)
                 optimizer.step()
@@ -237,63 +233,51 @@ def train():
                 optimizer.zero_grad(set_to_none=True)
 
                 if accelerator.sync_gradients:
-                    ema_update(model_ema, model, config.ema_decay)
+                    ema.step()
+                step_timer.lap('optimizer')
 
             lr = lr_scheduler.get_last_lr()[0]
-            logs = {"loss": accelerator.gather(loss).mean().item()}
-            if grad_norm is not None:
-                logs.update(grad_norm=accelerator.gather(grad_norm).mean().item())
-            log_buffer.update(logs)
+            metrics.update(loss=loss, grad_norm=grad_norm)
             if (step + 1) % config.log_interval == 0 or (step + 1) == 1:
+                logs = metrics.reduce()
                 t = (time.time() - last_tic) / config.log_interval
-                t_d = data_time_all / config.log_interval
                 avg_time = (time.time() - time_start) / (global_step + 1)
                 eta = str(datetime.timedelta(seconds=int(avg_time * (total_steps - start_step - global_step - 1))))
                 eta_epoch = str(datetime.timedelta(seconds=int(avg_time * (len(train_dataloader) - step - 1))))
-                # avg_loss = sum(loss_buffer) / len(loss_buffer)
-                log_buffer.average()
                 info = f"Step/Epoch [{(epoch-1)*len(train_dataloader)+step+1}/{epoch}][{step + 1}/{len(train_dataloader)}]:total_eta: {eta}, " \
-                       f"epoch_eta:{eta_epoch}, time_all:{t:.3f}, time_data:{t_d:.3f}, lr:{lr:.3e}, s:({data_info['resolution'][0][0].item()}, {data_info['resolution'][0][1].item()}), "
-                info += ', '.join([f"{k}:{v:.4f}" for k, v in log_buffer.output.items()])
+                       f"epoch_eta:{eta_epoch}, time_all:{t:.3f}, lr:{lr:.3e}, s:({data_info['resolution'][0][0].item()}, {data_info['resolution'][0][1].item()}), "
+                info += ', '.join([f"time_{k}:{v:.3f}" for k, v in step_timer.pop_means().items()]) + ', '
+                info += ', '.join([f"{k}:{v:.4f}" for k, v in logs.items()])
                 logger.info(info)
+                accelerator.log(dict(logs, lr=lr), step=global_step + start_step)
                 last_tic = time.time()
-                log_buffer.clear()
-                data_time_all = 0
-            logs.update(lr=lr)
-            accelerator.log(logs, step=global_step + start_step)
+            step_timer.lap('log')
 
             global_step += 1
-            data_time_start= time.time()
-
-            synchronize()
-            torch.cuda.empty_cache()
-            if accelerator.is_main_process:
-                # log_validation(model_ema, step, model.device)
-                if ((epoch - 1) * len(train_dataloader) + step + 1) % config.save_model_steps == 0:
-                    os.umask(0o000)
-                    save_checkpoint(os.path.join(config.work_dir, 'checkpoints'),
-                                    epoch=epoch,
-                                    step=(epoch - 1) * len(train_dataloader) + step + 1,
-                                    model=accelerator.unwrap_model(model),
-                                    model_ema=accelerator.unwrap_model(model_ema),
-                                    optimizer=optimizer,
-                                    lr_scheduler=lr_scheduler
-                                    )
-            synchronize()
-
-        synchronize()
-        if accelerator.is_main_process:
-            if epoch % config.save_model_epochs == 0 or epoch == config.num_epochs:
+
+            if ((epoch - 1) * len(train_dataloader) + step + 1) % config.save_model_steps == 0:
                 os.umask(0o000)
-                save_checkpoint(os.path.join(config.work_dir, 'checkpoints'),
-                                epoch=epoch,
-                                step=(epoch - 1) * len(train_dataloader) + step + 1,
-                                model=accelerator.unwrap_model(model),
-                                model_ema=accelerator.unwrap_model(model_ema),
-                                optimizer=optimizer,
-                                lr_scheduler=lr_scheduler
-                                )
-        synchronize()
+                checkpointer.save(os.path.join(config.work_dir, 'checkpoints'),
+                                  epoch=epoch,
+                                  step=(epoch - 1) * len(train_dataloader) + step + 1,
+                                  model=accelerator.unwrap_model(model),
+                                  model_ema=accelerator.unwrap_model(model_ema),
+                                  optimizer=optimizer,
+                                  lr_scheduler=lr_scheduler
+                                  )
+                step_timer.lap('checkpoint')
+
+        if epoch % config.save_model_epochs == 0 or epoch == config.num_epochs:
+            os.umask(0o000)
+            checkpointer.save(os.path.join(config.work_dir, 'checkpoints'),
+                              epoch=epoch,
+                              step=(epoch - 1) * len(train_dataloader) + step + 1,
+                              model=accelerator.unwrap_model(model),
+                              model_ema=accelerator.unwrap_model(model_ema),
+                              optimizer=optimizer,
+                              lr_scheduler=lr_scheduler
+                              )
+    checkpointer.wait()
 
 
 def parse_args():
@@ -457,6 +441,9 @@ if __name__ == '__main__':
     # There is no specific order to remember, you just need to unpack the
     # objects in the same order you gave them to the prepare method.
     model, model_ema, model_teacher = accelerator.prepare(model, model_ema, model_teacher)
+    # no CPU offload: model_ema also predicts the targets
+    ema = EMA(accelerator.unwrap_model(model_ema), accelerator.unwrap_model(model), config.ema_decay,
+              update_every=config.get('ema_update_every', 1))
     # model, model_ema = accelerator.prepare(model, model_ema)
     optimizer, train_dataloader, lr_scheduler = accelerator.prepare(optimizer, train_dataloader, lr_scheduler)
     train()